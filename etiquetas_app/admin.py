@@ -1,3 +1,24 @@
 from django.contrib import admin
+from .models import ArchivoGenerado, MetricaEtapa
 
-# Register your models here.
+
+class MetricaEtapaInline(admin.TabularInline):
+    model = MetricaEtapa
+    fields = ('etapa', 'segundos', 'llamadas', 'pico_rss', 'pico_python')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivoGenerado)
+class ArchivoGeneradoAdmin(admin.ModelAdmin):
+    list_display = ('id', 'usuario', 'estado', 'etiquetas', 'duracion_segundos', 'fecha_creacion')
+    list_filter = ('estado',)
+    readonly_fields = (
+        'fecha_creacion', 'fecha_inicio', 'fecha_fin', 'etiquetas', 'duracion_segundos', 'resumen', 'error',
+        'clave_contenido', 'memoria_estimada',
+    )
+    inlines = [MetricaEtapaInline]
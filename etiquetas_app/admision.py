@@ -0,0 +1,121 @@
+"""Control de admisión de los trabajos de generación.
+
+Al subir los archivos, un trabajo se rechaza enseguida si la cola o los
+trabajos pendientes del usuario ya están llenos. Los que se aceptan esperan
+en cola hasta que un trabajador puede empezarlos sin superar las
+generaciones simultáneas, las del mismo usuario ni la memoria estimada de
+todas ellas. Los trabajadores deciden con la fila de ColaGeneracion
+bloqueada, así que los límites se cumplen aunque haya varios procesos o
+nodos trabajando sobre la misma base de datos.
+
+Un trabajo en proceso cuyo trabajador deja de renovar el latido durante
+TRABAJO_LATIDO_MAX_SEGUNDOS se considera interrumpido.
+"""
+from collections import Counter
+from datetime import timedelta
+from django.db.models import Q, Sum
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+from .models import ArchivoGenerado, ColaGeneracion
+
+PENDIENTES = (ArchivoGenerado.EN_COLA, ArchivoGenerado.PROCESANDO)
+
+
+def queue_error(usuario, trabajos_sesion, opciones):
+    """Motivo por el que no se acepta un trabajo nuevo, o None."""
+    pendientes = ArchivoGenerado.objects.filter(estado__in=PENDIENTES)
+    limite = opciones['COLA_MAX_TRABAJOS']
+    if limite is not None and pendientes.count() >= limite:
+        return "Hay demasiados documentos en cola. Vuelve a intentarlo en unos minutos."
+    limite = opciones['COLA_MAX_POR_USUARIO']
+    if limite is not None:
+        # Los usuarios anónimos se cuentan por sesión
+        if usuario.is_authenticated:
+            propios = pendientes.filter(usuario=usuario)
+        else:
+            propios = pendientes.filter(pk__in=trabajos_sesion)
+        if propios.count() >= limite:
+            return (
+                f"Ya tienes {limite} documento{'s' if limite != 1 else ''} en cola o generándose. "
+                "Espera a que termine alguno antes de subir otro."
+            )
+    return None
+
+
+def memory_error(memoria, opciones):
+    """Motivo por el que un trabajo no cabe nunca en la memoria permitida, o None."""
+    limite = opciones['GENERACION_MEMORIA_MAX_BYTES']
+    if limite is None or memoria <= limite:
+        return None
+    return (
+        f"El documento necesitaría unos {filesizeformat(memoria)} de memoria y el máximo por "
+        f"generación es {filesizeformat(limite)}. Divide el Excel en varios archivos."
+    )
+
+
+def stale_jobs(opciones):
+    """Trabajos en proceso cuyo trabajador ya no renueva el latido."""
+    en_proceso = ArchivoGenerado.objects.filter(estado=ArchivoGenerado.PROCESANDO)
+    caducado = _lease_expired(opciones)
+    return en_proceso.none() if caducado is None else en_proceso.filter(caducado)
+
+
+def live_jobs(opciones):
+    """Trabajos en proceso cuyo trabajador sigue renovando el latido."""
+    en_proceso = ArchivoGenerado.objects.filter(estado=ArchivoGenerado.PROCESANDO)
+    caducado = _lease_expired(opciones)
+    return en_proceso if caducado is None else en_proceso.exclude(caducado)
+
+
+def _lease_expired(opciones):
+    if opciones['TRABAJO_LATIDO_MAX_SEGUNDOS'] is None:
+        return None
+    limite = timezone.now() - timedelta(seconds=opciones['TRABAJO_LATIDO_MAX_SEGUNDOS'])
+    # Sin latido, los trabajos empezados antes de que existiera el campo
+    return Q(latido__lt=limite) | Q(latido=None, fecha_inicio__lt=limite)
+
+
+def lock_queue():
+    # Bloquea la fila de la cola hasta el final de la transacción en curso. Se
+    # bloquea con un update, que a diferencia de select_for_update también
+    # bloquea en SQLite
+    if ColaGeneracion.objects.filter(pk=1).update(actualizada=timezone.now()):
+        return
+    # La fila no existe (base de datos vaciada, fixtures recargadas...); sin
+    # ella no se bloquearía nada
+    ColaGeneracion.objects.get_or_create(pk=1)
+    if not ColaGeneracion.objects.filter(pk=1).update(actualizada=timezone.now()):
+        raise RuntimeError("No se pudo bloquear la cola de generación")
+
+
+def next_admissible(opciones):
+    """Trabajo en cola más antiguo que puede empezar ya, o None.
+
+    Hay que llamarla con la cola bloqueada. Si el trabajo más antiguo no
+    cabe en la memoria libre se espera a que termine otro en lugar de
+    adelantarlo con trabajos más pequeños, para que no espere indefinidamente;
+    el límite por usuario sí deja pasar a los trabajos de otros usuarios.
+    Los trabajos cuyo trabajador murió no ocupan sitio.
+    """
+    en_proceso = live_jobs(opciones)
+    if opciones['GENERACION_MAX_SIMULTANEAS'] is not None and en_proceso.count() >= opciones['GENERACION_MAX_SIMULTANEAS']:
+        return None
+    por_usuario = Counter(en_proceso.exclude(usuario=None).values_list('usuario_id', flat=True))
+    memoria_libre = None
+    if opciones['GENERACION_MEMORIA_MAX_BYTES'] is not None:
+        en_uso = en_proceso.aggregate(total=Sum('memoria_estimada'))['total'] or 0
+        memoria_libre = opciones['GENERACION_MEMORIA_MAX_BYTES'] - en_uso
+
+    en_cola = ArchivoGenerado.objects.filter(estado=ArchivoGenerado.EN_COLA).order_by('fecha_creacion', 'pk')
+    for trabajo in en_cola:
+        maximo_usuario = opciones['GENERACION_MAX_POR_USUARIO']
+        if maximo_usuario is not None and trabajo.usuario_id is not None and por_usuario[trabajo.usuario_id] >= maximo_usuario:
+            continue
+        if memoria_libre is not None:
+            if trabajo.memoria_estimada is None:
+                # Recién subido y aún sin estimar; se estima en la siguiente vuelta
+                continue
+            if trabajo.memoria_estimada > memoria_libre:
+                return None
+        return trabajo
+    return None
@@ -0,0 +1,21 @@
+"""Almacenamiento de los documentos generados.
+
+Los documentos se localizan por el trabajo (ArchivoGenerado) y se leen a
+través de un Storage de Django, así que cualquier nodo puede servir
+cualquier trabajo. El almacenamiento es el alias 'resultados' de
+settings.STORAGES; sin él se usa el predeterminado (MEDIA_ROOT). La
+implementación local es FileSystemStorage sobre un directorio, que en
+varios nodos debe ser un montaje compartido (NFS, SMB...). El generador
+escribe en la ruta local del documento, así que el almacenamiento tiene
+que implementar path().
+"""
+from django.core.files.storage import InvalidStorageError, default_storage, storages
+
+ALIAS = 'resultados'
+
+
+def result_storage():
+    try:
+        return storages[ALIAS]
+    except InvalidStorageError:
+        return default_storage
@@ -0,0 +1,27 @@
+"""Escritura de los archivos que comparten varios trabajos a la vez: la
+caché de QR, el registro de rendimiento y los manifiestos."""
+import os
+import uuid
+
+
+def write_atomic(ruta, datos):
+    """Escribe los bytes datos en ruta de forma atómica.
+
+    Se escriben en un temporal del mismo directorio que luego sustituye a
+    ruta, así que quien la lea a la vez ve el archivo anterior o el nuevo
+    completo, nunca uno a medias. Si la escritura falla, el temporal se borra.
+    """
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    ruta_temporal = f'{ruta}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(ruta_temporal, 'wb') as archivo:
+            archivo.write(datos)
+        os.replace(ruta_temporal, ruta)
+    except BaseException:
+        try:
+            os.remove(ruta_temporal)
+        except OSError:
+            pass
+        raise
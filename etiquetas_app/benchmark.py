@@ -0,0 +1,234 @@
+"""Banco de pruebas de rendimiento de generate_word_document.
+
+Genera un Excel y un ZIP de imágenes sintéticos y reproducibles (misma
+semilla, mismos archivos), mide la generación completa y por etapas, y
+calcula una firma del texto y la estructura de las etiquetas para comprobar
+que una optimización no cambia el documento. Se usa desde el comando
+benchmark_etiquetas.
+"""
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from openpyxl import Workbook
+from PIL import Image
+from .escritura import DOCUMENT_XML
+from .metricas import rss_peak
+from .utils import generate_word_document
+
+# Firmas de referencia de los escenarios, versionadas junto al código
+REFERENCIA = os.path.join(os.path.dirname(__file__), 'benchmark_referencia.json')
+
+# Escenarios predefinidos; los valores que falten se toman de ESCENARIO_BASE
+ESCENARIO_BASE = {
+    'etiquetas': 100,
+    # Cajas por fila: cada fila pide entre 1 y cajas_max etiquetas
+    'cajas_max': 3,
+    # Proporción de filas que repiten el CODIGO de una fila anterior
+    'proporcion_duplicados': 0.1,
+    # Columnas que no usa la etiqueta, para medir el coste de ignorarlas
+    'columnas_extra': 10,
+    'imagenes': 50,
+    'resolucion': (1600, 1200),
+    'formatos': ('jpg', 'png'),
+    # Proporción de imágenes guardadas en subcarpetas anidadas del ZIP
+    'proporcion_anidadas': 0.25,
+    # Proporción de filas cuya IMAGEN no está en el ZIP
+    'proporcion_faltantes': 0.02,
+    # Imágenes corruptas del ZIP, para recorrer el camino del error
+    'imagenes_corruptas': 1,
+    'semilla': 1,
+}
+
+ESCENARIOS = {
+    '100': {'etiquetas': 100, 'imagenes': 40},
+    '1k': {'etiquetas': 1000, 'imagenes': 300},
+    '10k': {'etiquetas': 10000, 'imagenes': 1500},
+}
+
+FECHA = re.compile(r'\d{2}/\d{2}/\d{4}')
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+WP = '{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}'
+# Elementos que definen la estructura de la etiqueta en la firma
+ETIQUETAS_ESTRUCTURA = {
+    f'{W}tbl', f'{W}tr', f'{W}tc', f'{W}p', f'{W}br', f'{W}gridSpan', f'{W}vMerge', f'{WP}extent',
+}
+
+
+def build_scenario(nombre, **cambios):
+    escenario = dict(ESCENARIO_BASE)
+    escenario.update(ESCENARIOS.get(nombre, {}))
+    escenario.update(cambios)
+    return escenario
+
+
+def generate_fixture_excel(excel_path, escenario):
+    """Escribe un Excel cuyas CONTEO_CAJAS suman exactamente escenario['etiquetas']."""
+    aleatorio = random.Random(escenario['semilla'])
+    nombres_imagen = [f'IMG{numero:05d}' for numero in range(escenario['imagenes'])]
+    nombres_imagen += [f'CORRUPTA{numero}' for numero in range(escenario['imagenes_corruptas'])]
+    columnas_extra = [f'EXTRA_{numero}' for numero in range(escenario['columnas_extra'])]
+
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet('Productos')
+    hoja.append(['CODIGO', 'DESCRIPCION', 'CANTIDAD', 'CONTEO_CAJAS', 'IMAGEN'] + columnas_extra)
+
+    codigos = []
+    restantes = escenario['etiquetas']
+    while restantes > 0:
+        cajas = min(restantes, aleatorio.randint(1, escenario['cajas_max']))
+        restantes -= cajas
+        if codigos and aleatorio.random() < escenario['proporcion_duplicados']:
+            codigo = aleatorio.choice(codigos)
+        else:
+            codigo = f'SKU{len(codigos):06d}'
+            codigos.append(codigo)
+
+        if aleatorio.random() < escenario['proporcion_faltantes']:
+            imagen = f'FALTA{len(codigos):05d}'
+        else:
+            imagen = aleatorio.choice(nombres_imagen)
+            # Mezcla referencias con y sin extensión, y con espacios alrededor
+            if aleatorio.random() < 0.5:
+                imagen = f' {imagen} '
+        hoja.append(
+            [codigo, f'Producto {codigo}', aleatorio.randint(1, 500), cajas, imagen]
+            + [aleatorio.random() for _ in columnas_extra]
+        )
+    libro.save(excel_path)
+
+
+def generate_fixture_zip(zip_path, escenario):
+    aleatorio = random.Random(escenario['semilla'])
+    ancho, alto = escenario['resolucion']
+    formatos = escenario['formatos']
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as destino:
+        for numero in range(escenario['imagenes']):
+            formato = formatos[numero % len(formatos)]
+            carpeta = ''
+            if aleatorio.random() < escenario['proporcion_anidadas']:
+                carpeta = f'lote{numero % 7}/sub{numero % 3}/'
+            destino.writestr(
+                f'{carpeta}IMG{numero:05d}.{formato}', _synthetic_image(aleatorio, ancho, alto, formato)
+            )
+        for numero in range(escenario['imagenes_corruptas']):
+            destino.writestr(f'CORRUPTA{numero}.jpg', b'no es una imagen')
+
+
+def _synthetic_image(aleatorio, ancho, alto, formato):
+    # Degradado con ruido: se comprime de forma parecida a una foto real
+    base = Image.linear_gradient('L').resize((ancho, alto))
+    ruido = Image.effect_noise((ancho, alto), aleatorio.randint(10, 60))
+    fondo = Image.new('L', (ancho, alto), aleatorio.randint(0, 255))
+    imagen = Image.merge('RGB', (base, ruido, fondo))
+    salida = io.BytesIO()
+    if formato == 'png':
+        # Compresión mínima: la fixture no necesita un PNG óptimo y se genera mucho antes
+        imagen.save(salida, format='PNG', compress_level=1)
+    else:
+        imagen.save(salida, format='JPEG', quality=90)
+    return salida.getvalue()
+
+
+def label_signature(docx_path):
+    """Firma SHA-256 del texto y la estructura de las etiquetas de un .docx.
+
+    No depende de la numeración de relaciones ni de formas, del contenido
+    de las imágenes ni de la fecha de recepción, así que coincide entre los
+    distintos escritores y entre la generación secuencial y la paralela.
+    """
+    firma = hashlib.sha256()
+    with zipfile.ZipFile(docx_path) as paquete, paquete.open(DOCUMENT_XML) as origen:
+        for evento, elemento in etree.iterparse(origen, events=('start', 'end')):
+            if evento == 'start':
+                if elemento.tag in ETIQUETAS_ESTRUCTURA:
+                    firma.update(etree.QName(elemento).localname.encode())
+                    for nombre in ('cx', 'cy', f'{W}val'):
+                        if elemento.get(nombre) is not None:
+                            firma.update(f'{nombre}={elemento.get(nombre)}'.encode())
+                continue
+            if elemento.tag == f'{W}t':
+                firma.update(b't:' + FECHA.sub('FECHA', elemento.text or '').encode('utf-8'))
+            if elemento.tag in (f'{W}tbl', f'{W}p') and elemento.getparent().tag == f'{W}body':
+                # Liberar cada bloque del cuerpo ya procesado
+                elemento.clear()
+                while elemento.getprevious() is not None:
+                    del elemento.getparent()[0]
+    return firma.hexdigest()
+
+
+def run_scenario(nombre, escenario, directorio, opciones=None):
+    """Genera las fixtures del escenario y mide una generación completa.
+
+    Salvo que se indique otra cosa en opciones, la caché de QR empieza vacía
+    y el rendimiento medido no se registra para las estimaciones reales.
+    """
+    opciones = dict(
+        {'QR_CACHE_DIR': os.path.join(directorio, f'{nombre}_qr'), 'RENDIMIENTO_ARCHIVO': None},
+        **(opciones or {}),
+    )
+    excel_path = os.path.join(directorio, f'{nombre}.xlsx')
+    zip_path = os.path.join(directorio, f'{nombre}.zip')
+    output_path = os.path.join(directorio, f'{nombre}.docx')
+    generate_fixture_excel(excel_path, escenario)
+    generate_fixture_zip(zip_path, escenario)
+
+    pico_inicial = rss_peak()
+    inicio = time.perf_counter()
+    resumen = generate_word_document(excel_path, zip_path, output_path, opciones)
+    segundos = time.perf_counter() - inicio
+    return {
+        'escenario': nombre,
+        'parametros': escenario,
+        'opciones': opciones,
+        'etiquetas': resumen['etiquetas'],
+        'segundos': round(segundos, 3),
+        'etiquetas_por_segundo': round(resumen['etiquetas'] / segundos, 1) if segundos else None,
+        'pico_rss': rss_peak(),
+        'pico_rss_inicial': pico_inicial,
+        'tamano_salida': os.path.getsize(output_path),
+        'firma': label_signature(output_path),
+        'etapas': resumen['metricas'],
+    }
+
+
+def run_isolated(nombre, escenario, directorio, opciones=None):
+    # Cada escenario en un proceso nuevo, para que el pico de RSS sea solo suyo
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as executor:
+        return executor.submit(_run_in_child, nombre, escenario, directorio, opciones).result()
+
+
+def _run_in_child(nombre, escenario, directorio, opciones):
+    import django
+    from django.conf import settings
+    if not settings.configured:
+        django.setup()
+    return run_scenario(nombre, escenario, directorio, opciones)
+
+
+def load_reference(ruta):
+    try:
+        with open(ruta, encoding='utf-8') as archivo:
+            return json.load(archivo)
+    except FileNotFoundError:
+        return {}
+
+
+def save_reference(ruta, referencia):
+    with open(ruta, 'w', encoding='utf-8') as archivo:
+        json.dump(referencia, archivo, indent=2, sort_keys=True)
+        archivo.write('\n')
+
+
+def reference_key(nombre, escenario):
+    # La firma solo es comparable con la del mismo escenario y los mismos parámetros
+    parametros = json.dumps(escenario, sort_keys=True)
+    return f'{nombre}:{hashlib.sha256(parametros.encode()).hexdigest()[:12]}'
@@ -0,0 +1,124 @@
+from django.conf import settings
+
+# Valores por defecto de las opciones de generación. Se pueden sobrescribir
+# con el diccionario ETIQUETAS de settings.py o al llamar a
+# generate_word_document(..., opciones={...})
+DEFAULTS = {
+    # Máximo de cajas (etiquetas) que puede pedir una sola fila del Excel; None sin límite
+    'MAX_CAJAS_POR_FILA': None,
+    # Trata como error, y no como advertencia, una IMAGEN que no está en el ZIP
+    'IMAGENES_FALTANTES_ERROR': False,
+    # Resolución con la que se reescalan las fotos para el recuadro de la etiqueta
+    'IMAGEN_DPI': 200,
+    # Calidad de recodificación JPEG (1-95)
+    'IMAGEN_CALIDAD_JPEG': 85,
+    # Activa la optimización del compresor PNG (más lenta, archivos menores)
+    'IMAGEN_PNG_OPTIMIZAR': True,
+    # Hilos para preparar imágenes; None usa el valor por defecto de Python
+    'PREPARACION_HILOS': None,
+    # Resolución del QR impreso; se redondea a un número entero de píxeles por módulo
+    'QR_DPI': 150,
+    # Nivel de corrección de errores del QR: 'L', 'M', 'Q' o 'H'
+    'QR_CORRECCION': 'M',
+    # Módulos de margen blanco alrededor del QR (4 es el mínimo del estándar)
+    'QR_BORDE': 4,
+    # Directorio de la caché de códigos QR entre trabajos; None la desactiva
+    'QR_CACHE_DIR': None,
+    # Tamaño máximo de la caché de QR en disco antes de expulsar los menos usados
+    'QR_CACHE_MAX_BYTES': 64 * 1024 * 1024,
+    # Escribe word/document.xml de forma incremental con memoria acotada en
+    # lugar de construir todo el documento en memoria
+    'ESCRITURA_STREAMING': False,
+    # Procesos que generan en paralelo bloques de filas que luego se unen en un
+    # solo documento; 1 genera todo en el proceso actual y None usa uno por CPU
+    'GENERACION_PROCESOS': 1,
+    # Archivo JSON donde se registra el rendimiento medido de cada etapa para
+    # estimar los próximos trabajos; None no registra nada
+    'RENDIMIENTO_ARCHIVO': None,
+    # Mide también con tracemalloc el pico de memoria de Python de cada etapa
+    # (además del pico de RSS); hace la generación bastante más lenta
+    'METRICAS_TRACEMALLOC': False,
+    # Horas durante las que un documento generado se reutiliza para una subida
+    # idéntica (mismo Excel, ZIP, plantilla, opciones y fecha); None desactiva
+    # la caché de resultados. El documento de un trabajo caducado no se borra:
+    # sigue descargándose hasta que lo borre limpiar_media
+    'CACHE_RESULTADOS_HORAS': None,
+    # Divide la salida en volúmenes (un .docx independiente cada uno, entregados
+    # juntos en un ZIP) de como máximo este número de etiquetas...
+    'VOLUMEN_ETIQUETAS': None,
+    # ...o de este tamaño estimado en bytes; None en ambos genera un solo documento
+    'VOLUMEN_MAX_BYTES': None,
+    # Tamaño máximo en bytes del Excel y del ZIP subidos; None sin límite. Se
+    # comprueba mientras se recibe la subida, sin esperar a que termine
+    'SUBIDA_MAX_BYTES_EXCEL': None,
+    'SUBIDA_MAX_BYTES_ZIP': None,
+    # Milisegundos máximos que puede tardar en importarse el arranque de Django
+    # según el comando medir_importacion; None solo comprueba que no se cargue
+    # la generación
+    'IMPORTACION_MAX_MS': None,
+    # Segundos sin latido tras los que un trabajo en proceso se da por
+    # interrumpido (el trabajador murió por falta de memoria, SIGKILL, un
+    # despliegue...) y se marca como fallido. El trabajador renueva el latido
+    # cada tercio de este plazo; None no interrumpe nunca
+    'TRABAJO_LATIDO_MAX_SEGUNDOS': 120,
+    # Generaciones que pueden ejecutarse a la vez entre todos los trabajadores,
+    # y de ellas, las de un mismo usuario; None sin límite
+    'GENERACION_MAX_SIMULTANEAS': None,
+    'GENERACION_MAX_POR_USUARIO': None,
+    # Memoria estimada en bytes que pueden sumar las generaciones en curso; los
+    # trabajos que no caben esperan en cola y los que no caben nunca se rechazan
+    'GENERACION_MEMORIA_MAX_BYTES': None,
+    # Trabajos pendientes (en cola o generándose) a partir de los cuales se
+    # rechazan las subidas nuevas, en total y por usuario o sesión; None sin límite
+    'COLA_MAX_TRABAJOS': None,
+    'COLA_MAX_POR_USUARIO': None,
+    # Retención de media que aplica el comando limpiar_media (ver limpieza.py):
+    # horas que se conservan las subidas y los documentos de los trabajos
+    # terminados, tamaño máximo del conjunto de documentos y horas tras las
+    # que un archivo sin trabajo o un temporal se considera abandonado. None
+    # conserva sin límite
+    'RETENCION_SUBIDAS_HORAS': None,
+    'RETENCION_DOCUMENTOS_HORAS': None,
+    'RETENCION_DOCUMENTOS_MAX_BYTES': None,
+    'RETENCION_TEMPORALES_HORAS': None,
+    # Cede el envío de los documentos al servidor web: 'x-accel-redirect'
+    # (nginx) o 'x-sendfile' (Apache, lighttpd); None los envía Django
+    'DESCARGA_DELEGADA': None,
+    # Location interna de nginx que sirve el almacenamiento de resultados, para
+    # X-Accel-Redirect
+    'DESCARGA_PREFIJO_INTERNO': '/resultados-internos/',
+    # Directorio para los archivos temporales de la generación; None usa el del sistema
+    'DIRECTORIO_TEMPORAL': None,
+}
+
+# Opciones que cambian el documento generado; las demás (escritura en
+# streaming, procesos...) producen el mismo resultado
+OPCIONES_SALIDA = (
+    'IMAGEN_DPI',
+    'IMAGEN_CALIDAD_JPEG',
+    'IMAGEN_PNG_OPTIMIZAR',
+    'QR_DPI',
+    'QR_CORRECCION',
+    'QR_BORDE',
+    'VOLUMEN_ETIQUETAS',
+    'VOLUMEN_MAX_BYTES',
+)
+
+# Versión del diseño de la etiqueta (plantilla.LabelTemplate); hay que
+# incrementarla al cambiar el esqueleto para que la caché de resultados y los
+# manifiestos no reutilicen documentos antiguos. Está aquí y no en plantilla.py
+# para que la caché no tenga que importar python-docx
+VERSION_PLANTILLA = 1
+
+
+def get_opciones(**overrides):
+    opciones = dict(DEFAULTS)
+    if settings.configured:
+        opciones.update(getattr(settings, 'ETIQUETAS', {}))
+    opciones.update(overrides)
+    return opciones
+
+
+def splits_volumes(opciones):
+    # Si la salida es un ZIP de volúmenes en lugar de un solo .docx
+    return bool(opciones['VOLUMEN_ETIQUETAS'] or opciones['VOLUMEN_MAX_BYTES'])
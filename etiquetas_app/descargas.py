@@ -0,0 +1,124 @@
+"""Envío de los documentos generados.
+
+Los documentos no cambian una vez generados, así que se validan con ETag y
+Last-Modified y admiten peticiones Range de un solo intervalo para reanudar
+una descarga cortada. Con DESCARGA_DELEGADA la vista solo comprueba el
+acceso y el servidor web (nginx con X-Accel-Redirect, Apache o lighttpd con
+X-Sendfile) envía el archivo, rangos y validaciones incluidos.
+"""
+import hashlib
+import re
+from urllib.parse import quote
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+TIPOS_CONTENIDO = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.zip': 'application/zip',
+}
+
+# Un único intervalo: "bytes=inicio-fin", "bytes=inicio-" o "bytes=-sufijo"
+RANGO = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Bytes que se leen y envían de cada vez en una respuesta parcial
+BLOQUE = 1024 * 1024
+
+
+def document_response(request, almacen, nombre_almacen, nombre_descarga, opciones):
+    """Respuesta que descarga nombre_almacen de almacen como nombre_descarga."""
+    tipo = TIPOS_CONTENIDO.get(nombre_descarga[nombre_descarga.rfind('.'):], 'application/octet-stream')
+    if opciones['DESCARGA_DELEGADA']:
+        respuesta = _delegated_response(almacen, nombre_almacen, tipo, opciones)
+        return _attachment(respuesta, nombre_descarga)
+
+    tamano = almacen.size(nombre_almacen)
+    modificado = int(almacen.get_modified_time(nombre_almacen).timestamp())
+    etag = quote_etag(hashlib.sha1(f'{nombre_almacen}:{tamano}:{modificado}'.encode()).hexdigest())
+
+    # If-None-Match, If-Modified-Since, If-Match e If-Unmodified-Since
+    respuesta = get_conditional_response(request, etag=etag, last_modified=modificado)
+    if respuesta is None:
+        rango = _requested_range(request, tamano, etag, modificado)
+        if rango is None:
+            respuesta = FileResponse(almacen.open(nombre_almacen, 'rb'), content_type=tipo)
+        elif rango is False:
+            respuesta = HttpResponse(status=416)
+            respuesta['Content-Range'] = f'bytes */{tamano}'
+        else:
+            inicio, fin = rango
+            respuesta = StreamingHttpResponse(
+                _iter_range(almacen, nombre_almacen, inicio, fin - inicio + 1),
+                status=206, content_type=tipo,
+            )
+            respuesta['Content-Length'] = str(fin - inicio + 1)
+            respuesta['Content-Range'] = f'bytes {inicio}-{fin}/{tamano}'
+    respuesta['Accept-Ranges'] = 'bytes'
+    respuesta['ETag'] = etag
+    respuesta['Last-Modified'] = http_date(modificado)
+    # El documento es del usuario: ningún proxy compartido debe guardarlo
+    respuesta['Cache-Control'] = 'private'
+    return _attachment(respuesta, nombre_descarga)
+
+
+def _requested_range(request, tamano, etag, modificado):
+    """Intervalo (inicio, fin) pedido con Range, ambos incluidos.
+
+    None si hay que enviar el documento completo (sin Range, con varios
+    intervalos o con un If-Range que ya no corresponde al documento) y False
+    si el intervalo no se puede satisfacer.
+    """
+    cabecera = request.headers.get('Range')
+    if not cabecera or request.method not in ('GET', 'HEAD'):
+        return None
+    si_rango = request.headers.get('If-Range')
+    if si_rango and si_rango != etag and parse_http_date_safe(si_rango) != modificado:
+        return None
+    coincidencia = RANGO.match(cabecera.strip())
+    if coincidencia is None:
+        return None
+    inicio, fin = coincidencia.groups()
+    if not inicio:
+        if not fin:
+            return None
+        # Los últimos N bytes
+        if int(fin) == 0:
+            return False
+        return max(0, tamano - int(fin)), tamano - 1
+    inicio = int(inicio)
+    if fin and int(fin) < inicio:
+        # Intervalo mal formado: se ignora
+        return None
+    if inicio >= tamano:
+        return False
+    return inicio, min(int(fin), tamano - 1) if fin else tamano - 1
+
+
+def _iter_range(almacen, nombre_almacen, inicio, longitud):
+    # El archivo se abre al empezar a enviar la respuesta: si nunca se llega
+    # a recorrer, no queda ningún archivo abierto
+    with almacen.open(nombre_almacen, 'rb') as archivo:
+        archivo.seek(inicio)
+        while longitud > 0:
+            bloque = archivo.read(min(BLOQUE, longitud))
+            if not bloque:
+                break
+            longitud -= len(bloque)
+            yield bloque
+
+
+def _delegated_response(almacen, nombre_almacen, tipo, opciones):
+    respuesta = HttpResponse(content_type=tipo)
+    if opciones['DESCARGA_DELEGADA'] == 'x-accel-redirect':
+        # nginx resuelve la ruta en una location internal que apunta al almacenamiento
+        respuesta['X-Accel-Redirect'] = opciones['DESCARGA_PREFIJO_INTERNO'] + quote(nombre_almacen)
+    elif opciones['DESCARGA_DELEGADA'] == 'x-sendfile':
+        respuesta['X-Sendfile'] = almacen.path(nombre_almacen)
+    else:
+        raise ValueError(f"DESCARGA_DELEGADA desconocida: {opciones['DESCARGA_DELEGADA']!r}")
+    return respuesta
+
+
+def _attachment(respuesta, nombre_descarga):
+    respuesta['Content-Disposition'] = f'attachment; filename="{nombre_descarga}"'
+    return respuesta
@@ -0,0 +1,343 @@
+import contextlib
+import hashlib
+import io
+import itertools
+import posixpath
+import shutil
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from docx import Document
+from docx.image.image import Image as DocxImage
+from docx.opc.constants import NAMESPACE, RELATIONSHIP_TYPE
+from docx.oxml.ns import qn
+from docx.shared import Emu
+from lxml import etree
+from .plantilla import configure_margins
+
+ImagenRegistrada = namedtuple('ImagenRegistrada', ['rId', 'filename', 'cx', 'cy'])
+
+# Lo que el escritor en streaming recuerda de cada imagen ya escrita en el
+# ZIP: su relación y su tamaño nativo, sin el contenido
+ImagenEscrita = namedtuple('ImagenEscrita', ['rId', 'filename', 'width', 'height'])
+
+# Tipos de contenido de las imágenes que se pueden incrustar en el paquete
+TIPOS_IMAGEN = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+    'tiff': 'image/tiff',
+    'tif': 'image/tiff',
+}
+
+DOCUMENT_XML = 'word/document.xml'
+DOCUMENT_RELS = 'word/_rels/document.xml.rels'
+CONTENT_TYPES = '[Content_Types].xml'
+
+
+def register_picture(story_part, image_stream, width=None, height=None):
+    # Añade la imagen al paquete (o recupera la ya existente) y calcula su tamaño una sola vez
+    rId, image = story_part.get_or_add_image(image_stream)
+    cx, cy = image.scaled_dimensions(width, height)
+    return ImagenRegistrada(rId, image.filename, cx, cy)
+
+
+def new_label_document():
+    # Documento vacío con los márgenes de las etiquetas
+    doc = Document()
+    configure_margins(doc)
+    return doc
+
+
+class InMemoryDocxWriter:
+    """Construye el documento completo en memoria con python-docx."""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.doc = new_label_document()
+        # Las etiquetas se insertan antes de las propiedades de sección del cuerpo
+        self._fin_cuerpo = self.doc.element.body.sectPr
+        self.ids_formas = itertools.count(self.doc.part.next_id)
+
+    def register_picture(self, blob, width=None, height=None):
+        return register_picture(self.doc.part, io.BytesIO(blob), width, height)
+
+    def add_image(self, blob):
+        return self.doc.part.get_or_add_image(io.BytesIO(blob))[0]
+
+    def append(self, elemento):
+        self._fin_cuerpo.addprevious(elemento)
+
+    def save(self):
+        self.doc.save(self.output_path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StreamingDocxWriter:
+    """Escribe el .docx de forma incremental con memoria acotada.
+
+    Cada etiqueta se serializa con el xmlfile incremental de lxml en cuanto
+    se añade y se descarta, y cada imagen se escribe en el ZIP de salida la
+    primera vez que se registra; de ella solo se recuerda la relación y el
+    tamaño, así que la memoria no crece con las imágenes distintas. Como un
+    ZipFile solo admite un miembro abierto para escritura, word/document.xml
+    se acumula en un archivo temporal en disco y se copia al ZIP por bloques
+    al guardar.
+    """
+
+    def __init__(self, output_path, directorio_temporal=None):
+        self.output_path = output_path
+        self.ids_formas = itertools.count(1)
+        self._imagenes = {}
+        # Dos pilas: el ZIP y el temporal viven hasta el final; el xmlfile se
+        # cierra antes para completar document.xml y poder copiarlo
+        self._pila = contextlib.ExitStack()
+        self._pila_xml = contextlib.ExitStack()
+        try:
+            self._abrir(directorio_temporal)
+        except Exception:
+            self.close()
+            raise
+
+    def _abrir(self, directorio_temporal):
+        # El resto de partes (estilos, ajustes, tema...) sale de un documento vacío
+        base_buffer = io.BytesIO()
+        new_label_document().save(base_buffer)
+        base = zipfile.ZipFile(base_buffer)
+
+        self.zip = self._pila.enter_context(
+            zipfile.ZipFile(self.output_path, 'w', zipfile.ZIP_DEFLATED)
+        )
+
+        # Los tipos de contenido se escriben primero, declarando ya todas las
+        # extensiones de imagen posibles
+        tipos = etree.fromstring(base.read(CONTENT_TYPES))
+        extensiones = {default.get('Extension') for default in tipos.iter(f'{{{NAMESPACE.OPC_CONTENT_TYPES}}}Default')}
+        for extension, content_type in TIPOS_IMAGEN.items():
+            if extension not in extensiones:
+                etree.SubElement(
+                    tipos,
+                    f'{{{NAMESPACE.OPC_CONTENT_TYPES}}}Default',
+                    Extension=extension,
+                    ContentType=content_type,
+                )
+        self.zip.writestr(CONTENT_TYPES, _serialize(tipos))
+
+        for info in base.infolist():
+            if info.filename not in (CONTENT_TYPES, DOCUMENT_XML, DOCUMENT_RELS):
+                self.zip.writestr(info, base.read(info))
+
+        self.rels = etree.fromstring(base.read(DOCUMENT_RELS))
+        self._rids = itertools.count(1 + max(
+            int(rel.get('Id')[3:]) for rel in self.rels if rel.get('Id', '').startswith('rId')
+        ))
+
+        documento = etree.fromstring(base.read(DOCUMENT_XML))
+        self.sectPr = documento.find(qn('w:body')).find(qn('w:sectPr'))
+
+        # word/document.xml se escribe de forma incremental en el archivo temporal
+        self.spool = self._pila.enter_context(tempfile.TemporaryFile(dir=directorio_temporal))
+        self._xf = self._pila_xml.enter_context(etree.xmlfile(self.spool, encoding='UTF-8'))
+        self._xf.write_declaration(standalone=True)
+        self._pila_xml.enter_context(
+            self._xf.element(documento.tag, attrib=dict(documento.attrib), nsmap=documento.nsmap)
+        )
+        self._pila_xml.enter_context(self._xf.element(qn('w:body')))
+
+    def register_picture(self, blob, width=None, height=None):
+        imagen = self._add_image(blob)
+        cx, cy = _scaled_dimensions(imagen, width, height)
+        return ImagenRegistrada(imagen.rId, imagen.filename, cx, cy)
+
+    def add_image(self, blob):
+        # Añade la imagen sin calcular su tamaño y devuelve solo la relación
+        return self._add_image(blob).rId
+
+    def _add_image(self, blob):
+        # Igual que python-docx, las imágenes idénticas comparten una sola parte
+        sha1 = hashlib.sha1(blob).hexdigest()
+        imagen = self._imagenes.get(sha1)
+        if imagen is None:
+            docx_image = DocxImage.from_blob(blob)
+            nombre_parte = f'media/image{len(self._imagenes) + 1}.{docx_image.ext}'
+            self.zip.writestr(f'word/{nombre_parte}', blob)
+            rId = f'rId{next(self._rids)}'
+            etree.SubElement(
+                self.rels,
+                f'{{{NAMESPACE.OPC_RELATIONSHIPS}}}Relationship',
+                Id=rId,
+                Type=RELATIONSHIP_TYPE.IMAGE,
+                Target=nombre_parte,
+            )
+            # El contenido ya está en el ZIP; docx_image y su blob se descartan
+            imagen = ImagenEscrita(rId, docx_image.filename, docx_image.width, docx_image.height)
+            self._imagenes[sha1] = imagen
+        return imagen
+
+    def append(self, elemento):
+        self._xf.write(elemento)
+
+    def save(self):
+        self._xf.write(self.sectPr)
+        # Cierra w:body, w:document y el xmlfile
+        self._pila_xml.close()
+
+        # Con el tamaño conocido, ZipFile decide por sí mismo si necesita ZIP64
+        info = zipfile.ZipInfo(DOCUMENT_XML, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.file_size = self.spool.tell()
+        self.spool.seek(0)
+        with self.zip.open(info, 'w') as destino:
+            shutil.copyfileobj(self.spool, destino, 1024 * 1024)
+        self.zip.writestr(DOCUMENT_RELS, _serialize(self.rels))
+        self.close()
+
+    def close(self):
+        try:
+            self._pila_xml.close()
+        finally:
+            self._pila.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _scaled_dimensions(imagen, width, height):
+    # Igual que docx.image.image.Image.scaled_dimensions: la dimensión que
+    # falta se escala conservando la proporción
+    if width is None and height is None:
+        return imagen.width, imagen.height
+    if width is None:
+        width = round(imagen.width * float(height) / float(imagen.height))
+    if height is None:
+        height = round(imagen.height * float(width) / float(imagen.width))
+    return Emu(width), Emu(height)
+
+
+def append_shard(documento, shard_path):
+    """Copia el cuerpo de un .docx parcial al final de documento.
+
+    Las imágenes del parcial se vuelven a registrar en documento (las que ya
+    estaban se deduplican por contenido), se renumeran sus relaciones y los
+    identificadores de forma, y los elementos del cuerpo se copian uno a uno
+    con iterparse para no cargar el parcial completo en memoria.
+    """
+    with zipfile.ZipFile(shard_path) as shard:
+        nuevos_rids = {
+            rId: documento.add_image(shard.read(ruta)) for rId, ruta in _image_rels(shard).items()
+        }
+        for elemento in _iter_body(shard, (qn('w:tbl'), qn('w:p'))):
+            _relink(elemento, documento, nuevos_rids.__getitem__)
+            documento.append(elemento)
+
+
+class ReusableLabels:
+    """Etiquetas de un documento anterior que se copian tal cual en otro.
+
+    Solo se conservan las tablas de las posiciones pedidas, serializadas y
+    comprimidas, y cada imagen del documento anterior se registra en el
+    nuevo la primera vez que una etiqueta copiada la usa.
+    """
+
+    def __init__(self, docx_path, posicion_por_huella):
+        self.posicion_por_huella = posicion_por_huella
+        posiciones = set(posicion_por_huella.values())
+        self._tablas = {}
+        self._nuevos_rids = {}
+        # El paquete queda abierto para leer las imágenes a medida que se copian
+        self.paquete = zipfile.ZipFile(docx_path)
+        try:
+            self._rutas_imagen = _image_rels(self.paquete)
+            for posicion, tabla in enumerate(_iter_body(self.paquete, qn('w:tbl'))):
+                if posicion in posiciones:
+                    self._tablas[posicion] = zlib.compress(etree.tostring(tabla))
+        except Exception:
+            self.close()
+            raise
+
+    def __contains__(self, huella):
+        return self.posicion_por_huella.get(huella) in self._tablas
+
+    def copy(self, documento, huella):
+        tabla = etree.fromstring(zlib.decompress(self._tablas[self.posicion_por_huella[huella]]))
+        _relink(tabla, documento, lambda rId: self._new_rid(documento, rId))
+        return tabla
+
+    def _new_rid(self, documento, rId):
+        if rId not in self._nuevos_rids:
+            self._nuevos_rids[rId] = documento.add_image(self.paquete.read(self._rutas_imagen[rId]))
+        return self._nuevos_rids[rId]
+
+    def close(self):
+        self.paquete.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _image_rels(paquete):
+    # Ruta dentro del paquete de la imagen de cada relación de word/document.xml
+    rels = etree.fromstring(paquete.read(DOCUMENT_RELS))
+    return {
+        rel.get('Id'): posixpath.join('word', rel.get('Target'))
+        for rel in rels if rel.get('Type') == RELATIONSHIP_TYPE.IMAGE
+    }
+
+
+def _iter_body(paquete, etiquetas):
+    # Elementos de primer nivel del cuerpo, uno a uno con iterparse
+    cuerpo = qn('w:body')
+    with paquete.open(DOCUMENT_XML) as origen:
+        for evento, elemento in etree.iterparse(origen, tag=etiquetas):
+            padre = elemento.getparent()
+            if padre.tag != cuerpo:
+                continue
+            # Separarlo del árbol libera lo ya recorrido; además, sin limpiar los
+            # espacios de nombres, cada elemento repetiría las declaraciones
+            # de la raíz del documento
+            padre.remove(elemento)
+            etree.cleanup_namespaces(elemento)
+            yield elemento
+
+
+def _relink(elemento, documento, nuevo_rid):
+    # Apunta las imágenes a las relaciones de documento y renumera las formas
+    embed = qn('r:embed')
+    for blip in elemento.iter(qn('a:blip')):
+        blip.set(embed, nuevo_rid(blip.get(embed)))
+    for doc_pr in elemento.iter(qn('wp:docPr')):
+        doc_pr.set('id', str(next(documento.ids_formas)))
+
+
+def document_xml_size(docx_path):
+    # Bytes comprimidos del cuerpo del documento dentro del .docx
+    with zipfile.ZipFile(docx_path) as paquete:
+        return paquete.getinfo(DOCUMENT_XML).compress_size
+
+
+def _serialize(elemento):
+    return etree.tostring(elemento, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+
+def open_writer(output_path, opciones):
+    if opciones['ESCRITURA_STREAMING']:
+        return StreamingDocxWriter(output_path, opciones['DIRECTORIO_TEMPORAL'])
+    return InMemoryDocxWriter(output_path)
@@ -0,0 +1,143 @@
+import json
+import os
+from .archivos import write_atomic
+
+# Rendimiento supuesto mientras no haya ningún trabajo medido
+RENDIMIENTO_INICIAL = {
+    'etiquetas_por_segundo': 100.0,
+    'imagenes_por_segundo': 30.0,
+    'qr_por_segundo': 150.0,
+    # Bytes comprimidos de word/document.xml por etiqueta
+    'bytes_por_etiqueta': 300.0,
+    'bytes_por_qr': 450.0,
+    # Tamaño de la foto ya preparada respecto al archivo original. Las fotos
+    # de cámara se reducen al hueco de la etiqueta, así que quedan en
+    # alrededor de un 6 % de su tamaño
+    'proporcion_imagenes': 0.06,
+}
+
+# Estilos, tema y demás partes fijas de un .docx vacío
+BYTES_BASE_DOCX = 40 * 1024
+
+# Memoria residente de un proceso que genera (intérprete, pandas, python-docx,
+# imágenes preparadas) y, con el documento en memoria, bytes de memoria por
+# byte comprimido del XML de las etiquetas: el árbol lxml ocupa mucho más que
+# el XML comprimido, mientras que las imágenes se guardan tal cual. Medido con
+# benchmark_etiquetas: en memoria, 1k etiquetas (264 KB de XML) ocupan 450 MB
+# más que en streaming (unos 260 MB) y 600 etiquetas (159 KB), 290 MB más
+MEMORIA_BASE_PROCESO = 256 * 1024 * 1024
+EXPANSION_DOCUMENTO_MEMORIA = 1800
+
+# Peso de la última medición en la media móvil exponencial
+PESO_MEDIDA_NUEVA = 0.3
+
+
+def load_throughput(ruta):
+    rendimiento = dict(RENDIMIENTO_INICIAL)
+    rendimiento.update(_load_measured(ruta))
+    return rendimiento
+
+
+def _load_measured(ruta):
+    if ruta:
+        try:
+            with open(ruta, encoding='utf-8') as archivo:
+                return json.load(archivo)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def record_throughput(ruta, medidas):
+    """Actualiza el rendimiento registrado con las medidas de un trabajo real.
+
+    Cada etapa (imágenes, QR y el resto del trabajo por etiqueta) se mide
+    por separado; en la generación en paralelo el tiempo de cada etapa ya
+    viene repartido entre los procesos que la ejecutaron.
+    """
+    if not ruta:
+        return
+    segundos_imagenes = medidas['segundos_imagenes']
+    segundos_qr = medidas['segundos_qr']
+    segundos_etiquetas = medidas['segundos'] - segundos_imagenes - segundos_qr
+
+    nuevas = {}
+    _ratio(nuevas, 'etiquetas_por_segundo', medidas['etiquetas'], segundos_etiquetas)
+    _ratio(nuevas, 'imagenes_por_segundo', medidas['imagenes'], segundos_imagenes)
+    _ratio(nuevas, 'qr_por_segundo', medidas['qr_generados'], segundos_qr)
+    _ratio(nuevas, 'bytes_por_etiqueta', medidas['bytes_documento'], medidas['etiquetas'])
+    _ratio(nuevas, 'bytes_por_qr', medidas['bytes_qr'], medidas['qr_registrados'])
+    _ratio(nuevas, 'proporcion_imagenes', medidas['bytes_imagenes'], medidas['bytes_imagenes_origen'])
+    if not nuevas:
+        return
+
+    # Solo se guardan valores medidos: la primera medida de cada etapa
+    # sustituye al valor inicial en lugar de promediarse con él
+    rendimiento = _load_measured(ruta)
+    for nombre, valor in nuevas.items():
+        anterior = rendimiento.get(nombre)
+        if anterior is not None:
+            valor = (1 - PESO_MEDIDA_NUEVA) * anterior + PESO_MEDIDA_NUEVA * valor
+        rendimiento[nombre] = valor
+
+    # Escritura atómica: varios trabajadores pueden registrar a la vez
+    try:
+        write_atomic(ruta, json.dumps(rendimiento, indent=2).encode('utf-8'))
+    except OSError:
+        pass
+
+
+def _ratio(nuevas, nombre, numerador, denominador):
+    # Las etapas vacías o demasiado cortas para medirse no cambian el registro
+    if numerador > 0 and denominador > 0.01:
+        nuevas[nombre] = numerador / denominador
+
+
+def estimate_document(df, imagen_por_fila, fuente_imagenes, opciones):
+    """Estima el documento de una hoja ya validada sin generar nada.
+
+    Solo usa el número de cajas de cada fila, los tamaños de las imágenes que
+    figuran en el índice de la fuente (sin descomprimirlas) y el rendimiento
+    registrado por los trabajos anteriores. Cada etiqueta ocupa una página.
+    """
+    rendimiento = load_throughput(opciones['RENDIMIENTO_ARCHIVO'])
+
+    etiquetas = int(df['CONTEO_CAJAS'].sum())
+    claves = {ruta for ruta in imagen_por_fila.values() if ruta}
+    bytes_imagenes_origen = sum(fuente_imagenes.size(clave) for clave in claves)
+    # Sin mirar la caché, se supone que hay que generar todos los QR
+    codigos = df['CODIGO'].nunique()
+
+    bytes_xml = etiquetas * rendimiento['bytes_por_etiqueta']
+    bytes_imagenes = codigos * rendimiento['bytes_por_qr'] + bytes_imagenes_origen * rendimiento['proporcion_imagenes']
+    tamano = BYTES_BASE_DOCX + bytes_xml + bytes_imagenes
+    segundos = (
+        etiquetas / rendimiento['etiquetas_por_segundo']
+        + len(claves) / rendimiento['imagenes_por_segundo']
+        + codigos / rendimiento['qr_por_segundo']
+    )
+    procesos = max(1, min(opciones['GENERACION_PROCESOS'] or os.cpu_count() or 1, len(df)))
+    segundos /= procesos
+
+    memoria = procesos * MEMORIA_BASE_PROCESO
+    memoria_documento = int(bytes_xml * EXPANSION_DOCUMENTO_MEMORIA + bytes_imagenes)
+    # Si el documento en memoria no cabe en la memoria permitida, se genera
+    # con el escritor en streaming, cuya memoria no crece con el documento
+    escritura_streaming = opciones['ESCRITURA_STREAMING'] or (
+        opciones['GENERACION_MEMORIA_MAX_BYTES'] is not None
+        and memoria + memoria_documento > opciones['GENERACION_MEMORIA_MAX_BYTES']
+    )
+    if not escritura_streaming:
+        memoria += memoria_documento
+
+    return {
+        'filas': len(df),
+        'etiquetas': etiquetas,
+        'paginas': etiquetas,
+        'imagenes': len(claves),
+        'codigos_qr': codigos,
+        'tamano_bytes': int(tamano),
+        'segundos': round(segundos, 1),
+        'memoria_bytes': memoria,
+        'escritura_streaming': escritura_streaming,
+    }
@@ -11,6 +11,12 @@ class UploadForm(forms.Form):
         help_text='Sube un archivo ZIP que contenga todas las imágenes de los productos.',
         widget=forms.FileInput(attrs={'class': 'form-control'})
     )
+    solo_estimar = forms.BooleanField(
+        label='Solo estimar',
+        required=False,
+        help_text='Calcula las páginas, el tamaño y el tiempo aproximados sin generar el documento.',
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
     
     def clean_excel_file(self):
         file = self.cleaned_data.get('excel_file')
@@ -0,0 +1,239 @@
+import io
+import os
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, UnidentifiedImageError
+
+# Extensiones de imagen soportadas para la búsqueda por nombre base
+EXTENSIONES_IMAGEN = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp')
+
+
+def _prioridad(ruta_relativa):
+    # Desempate entre archivos con el mismo nombre en distintas subcarpetas:
+    # gana el menos anidado y, a igual profundidad, el primero en orden alfabético
+    ruta_normalizada = ruta_relativa.replace('\\', '/')
+    return (ruta_normalizada.count('/'), ruta_normalizada.lower())
+
+
+class ImageIndex:
+    """Índice de imágenes construido una sola vez por trabajo.
+
+    Mapea el nombre completo en minúsculas y el nombre base en minúsculas
+    (solo para las extensiones soportadas) a la ruta de la imagen, de modo
+    que cada fila del Excel se resuelve con una búsqueda O(1).
+    """
+
+    def __init__(self, rutas):
+        self.por_nombre = {}
+        self.por_nombre_base = {}
+        for ruta in sorted(rutas, key=_prioridad):
+            nombre_archivo = os.path.basename(ruta.replace('\\', '/'))
+            nombre_base, extension = os.path.splitext(nombre_archivo)
+            # setdefault conserva la primera ruta según la prioridad de desempate
+            self.por_nombre.setdefault(nombre_archivo.lower(), ruta)
+            if extension.lower() in EXTENSIONES_IMAGEN:
+                self.por_nombre_base.setdefault(nombre_base.lower(), ruta)
+
+    def resolve(self, imagen_nombre):
+        # Devuelve la ruta de la imagen referenciada en la columna IMAGEN o None
+        imagen_nombre = imagen_nombre.strip().lower()
+        if not imagen_nombre:
+            return None
+        # Sin extensión se busca por nombre base; con extensión, el archivo exacto
+        if '.' not in imagen_nombre:
+            return self.por_nombre_base.get(imagen_nombre)
+        return self.por_nombre.get(imagen_nombre)
+
+    def __len__(self):
+        return len(self.por_nombre)
+
+
+def build_image_index(images_dir):
+    # Recorre el directorio de imágenes una única vez
+    rutas = []
+    for root, dirs, files_in_current_dir in os.walk(images_dir):
+        for file_name in files_in_current_dir:
+            rutas.append(os.path.join(root, file_name))
+    # Todas las rutas comparten el prefijo images_dir, así que el desempate
+    # sobre la ruta absoluta equivale al de la ruta relativa
+    return ImageIndex(rutas)
+
+
+class DirectoryImageSource:
+    """Fuente de imágenes sobre un directorio ya extraído en disco."""
+
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+        self.indice = build_image_index(images_dir)
+
+    def resolve(self, imagen_nombre):
+        return self.indice.resolve(imagen_nombre)
+
+    def open(self, clave):
+        return open(clave, 'rb')
+
+    def size(self, clave):
+        return os.path.getsize(clave)
+
+    def fingerprint(self, clave):
+        # Cambia si el archivo cambia, sin tener que leerlo
+        estado = os.stat(clave)
+        return f'{estado.st_size}-{estado.st_mtime_ns}'
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ZipImageSource:
+    """Fuente de imágenes que lee los miembros directamente del ZIP subido.
+
+    El índice se construye a partir del directorio central del ZIP, sin
+    extraer nada a disco; solo se descomprimen los miembros que el Excel
+    referencia, en el momento en que se usan.
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.zip_ref = zipfile.ZipFile(zip_path, 'r')
+        try:
+            miembros = [info.filename for info in self.zip_ref.infolist() if not info.is_dir()]
+            self.indice = ImageIndex(miembros)
+        except Exception:
+            self.zip_ref.close()
+            raise
+
+    def resolve(self, imagen_nombre):
+        return self.indice.resolve(imagen_nombre)
+
+    def open(self, clave):
+        # Se lee el miembro completo a memoria para obtener un stream con seek
+        # barato, ya que Pillow y python-docx lo recorren más de una vez
+        return io.BytesIO(self.zip_ref.read(clave))
+
+    def size(self, clave):
+        # Tamaño sin comprimir, leído del directorio central sin descomprimir nada
+        return self.zip_ref.getinfo(clave).file_size
+
+    def fingerprint(self, clave):
+        # CRC y tamaño del directorio central: identifican el contenido sin descomprimirlo
+        info = self.zip_ref.getinfo(clave)
+        return f'{info.CRC:08x}-{info.file_size}'
+
+    def close(self):
+        self.zip_ref.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_image_source(images_source):
+    # Acepta un directorio de imágenes o la ruta del ZIP subido
+    if os.path.isdir(images_source):
+        return DirectoryImageSource(images_source)
+    return ZipImageSource(images_source)
+
+
+# Recuadro reservado para la foto del producto en la etiqueta
+ANCHO_IMAGEN_PULGADAS = 2.5
+ALTO_MAXIMO_IMAGEN_PULGADAS = 3.0
+
+ImagenPreparada = namedtuple('ImagenPreparada', ['blob', 'width_inches', 'height_inches'])
+
+
+def fit_to_label_box(width_orig, height_orig):
+    ratio = height_orig / width_orig
+
+    # Ancho fijo y altura proporcional
+    width_inches = ANCHO_IMAGEN_PULGADAS
+    height_inches = width_inches * ratio
+
+    # Si la altura calculada excede el máximo, ajustar proporcionalmente
+    if height_inches > ALTO_MAXIMO_IMAGEN_PULGADAS:
+        height_inches = ALTO_MAXIMO_IMAGEN_PULGADAS
+        width_inches = height_inches / ratio
+    return width_inches, height_inches
+
+
+def prepare_image(imagen_stream, dpi, calidad_jpeg, png_optimizar):
+    # Reescala la imagen a la resolución de impresión del recuadro y la recodifica
+    blob_original = imagen_stream.read()
+    with Image.open(io.BytesIO(blob_original)) as img:
+        formato_original = img.format
+        width_inches, height_inches = fit_to_label_box(*img.size)
+        tamano_destino = (
+            max(1, round(width_inches * dpi)),
+            max(1, round(height_inches * dpi)),
+        )
+        requiere_reescalado = img.size[0] > tamano_destino[0] or img.size[1] > tamano_destino[1]
+
+        # Los JPEG/PNG que ya caben en el recuadro se incrustan tal cual
+        if not requiere_reescalado and formato_original in ('JPEG', 'PNG'):
+            return ImagenPreparada(blob_original, width_inches, height_inches)
+
+        # Se conserva el EXIF (orientación incluida) al recodificar en JPEG
+        exif = img.info.get('exif', b'')
+        if formato_original == 'JPEG':
+            # Decodifica directamente a una escala reducida cuando es posible
+            img.draft('RGB', tamano_destino)
+        img = img.convert('RGBA') if _has_alpha(img) else img.convert('RGB')
+        if requiere_reescalado:
+            img = img.resize(tamano_destino, Image.LANCZOS)
+
+        salida = io.BytesIO()
+        if img.mode == 'RGBA':
+            img.save(salida, format='PNG', optimize=png_optimizar, dpi=(dpi, dpi))
+        else:
+            img.save(salida, format='JPEG', quality=calidad_jpeg, optimize=True, dpi=(dpi, dpi), exif=exif)
+    return ImagenPreparada(salida.getvalue(), width_inches, height_inches)
+
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def iter_prepared_images(fuente_imagenes, claves, opciones):
+    """Prepara cada imagen referenciada una única vez por trabajo.
+
+    Produce pares (clave, ImagenPreparada) en el mismo orden que `claves`,
+    o (clave, excepción) si esa imagen no se pudo procesar. El trabajo se
+    reparte en un pool de hilos (Pillow libera el GIL al decodificar,
+    reescalar y codificar) y solo se adelanta una ventana acotada de
+    imágenes, para que la memoria no crezca con el tamaño del catálogo.
+    """
+    def preparar(clave):
+        try:
+            with fuente_imagenes.open(clave) as imagen_stream:
+                return prepare_image(
+                    imagen_stream,
+                    opciones['IMAGEN_DPI'],
+                    opciones['IMAGEN_CALIDAD_JPEG'],
+                    opciones['IMAGEN_PNG_OPTIMIZAR'],
+                )
+        except UnidentifiedImageError:
+            # Se informa la ruta de la imagen en lugar del stream en memoria
+            return UnidentifiedImageError(f"cannot identify image file '{clave}'")
+        except Exception as e:
+            return e
+
+    hilos = opciones['PREPARACION_HILOS'] or min(32, (os.cpu_count() or 1) + 4)
+    ventana = 2 * hilos
+    with ThreadPoolExecutor(max_workers=hilos) as executor:
+        pendientes = deque()
+        for clave in claves:
+            pendientes.append((clave, executor.submit(preparar, clave)))
+            if len(pendientes) >= ventana:
+                clave_lista, futuro = pendientes.popleft()
+                yield clave_lista, futuro.result()
+        while pendientes:
+            clave_lista, futuro = pendientes.popleft()
+            yield clave_lista, futuro.result()
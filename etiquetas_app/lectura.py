@@ -0,0 +1,275 @@
+import posixpath
+import zipfile
+from functools import partial
+import pandas as pd
+from lxml import etree
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import MAC_EPOCH, WINDOWS_EPOCH, from_excel, from_ISO8601
+from .validacion import Incidencia, ValidacionError
+
+# Columnas del Excel que usa la etiqueta; el resto de columnas no se lee
+COLUMNAS_OBLIGATORIAS = ('CODIGO', 'DESCRIPCION', 'CANTIDAD')
+COLUMNAS_OPCIONALES = ('CONTEO_CAJAS', 'IMAGEN')
+COLUMNAS_ETIQUETA = COLUMNAS_OBLIGATORIAS + COLUMNAS_OPCIONALES
+
+NS_HOJA = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_RELACIONES = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_PAQUETE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+REL_DOCUMENTO = f'{NS_RELACIONES}/officeDocument'
+REL_CADENAS = f'{NS_RELACIONES}/sharedStrings'
+REL_ESTILOS = f'{NS_RELACIONES}/styles'
+
+FILA = f'{{{NS_HOJA}}}row'
+CELDA = f'{{{NS_HOJA}}}c'
+VALOR = f'{{{NS_HOJA}}}v'
+TEXTO = f'{{{NS_HOJA}}}t'
+TEXTO_ENRIQUECIDO = f'{{{NS_HOJA}}}r'
+TEXTO_EN_LINEA = f'{{{NS_HOJA}}}is'
+
+
+def read_label_sheet(excel_path):
+    """Lee del Excel solo las columnas que usa la etiqueta.
+
+    La primera hoja se recorre en streaming con iterparse directamente sobre
+    el XML del .xlsx: de cada fila solo se convierten las celdas de las
+    columnas de COLUMNAS_ETIQUETA y la fila se libera en cuanto se lee, sin
+    crear objetos para el resto de columnas ni cargar la hoja en memoria.
+    Se usan los valores calculados de las fórmulas y, como openpyxl (y con él
+    pd.read_excel), los números con formato de fecha u hora se convierten a
+    datetime, time o timedelta. Devuelve un DataFrame con las columnas ya
+    normalizadas, indexado por el número de fila en el Excel; si falta alguna
+    columna obligatoria lanza ValidacionError.
+    """
+    with zipfile.ZipFile(excel_path) as libro:
+        ruta_libro = _rel_target(libro, '', REL_DOCUMENTO)
+        workbook = etree.fromstring(libro.read(ruta_libro))
+        ruta_hoja = _first_sheet(libro, ruta_libro, workbook)
+        ruta_cadenas = _rel_target(libro, ruta_libro, REL_CADENAS)
+        cadenas = _read_shared_strings(libro, ruta_cadenas) if ruta_cadenas else []
+        ruta_estilos = _rel_target(libro, ruta_libro, REL_ESTILOS)
+        fechas = _read_date_styles(libro, ruta_estilos, _epoch(workbook)) if ruta_estilos else {}
+        with libro.open(ruta_hoja) as hoja:
+            columnas, numeros_fila = _read_columns(hoja, cadenas, fechas)
+
+    df = pd.DataFrame(columnas, index=pd.Index(numeros_fila, name='FILA'), dtype=object)
+    return _normalize(df)
+
+
+def _rels_path(ruta_parte):
+    carpeta, nombre = posixpath.split(ruta_parte)
+    return posixpath.join(carpeta, '_rels', f'{nombre}.rels')
+
+
+def _rel_target(libro, ruta_parte, tipo):
+    # Ruta dentro del ZIP de la primera relación de ese tipo que sale de la parte
+    try:
+        relaciones = etree.fromstring(libro.read(_rels_path(ruta_parte)))
+    except KeyError:
+        return None
+    for relacion in relaciones.iter(f'{{{NS_PAQUETE}}}Relationship'):
+        if relacion.get('Type') == tipo:
+            return _resolve_target(ruta_parte, relacion.get('Target'))
+    return None
+
+
+def _resolve_target(ruta_parte, destino):
+    if destino.startswith('/'):
+        return destino[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(ruta_parte), destino))
+
+
+def _first_sheet(libro, ruta_libro, workbook):
+    # Igual que pd.read_excel, se lee la primera hoja en el orden del libro
+    hoja = workbook.find(f'{{{NS_HOJA}}}sheets/{{{NS_HOJA}}}sheet')
+    if hoja is None:
+        raise ValueError("El Excel no contiene ninguna hoja")
+    rId = hoja.get(f'{{{NS_RELACIONES}}}id')
+    relaciones = etree.fromstring(libro.read(_rels_path(ruta_libro)))
+    for relacion in relaciones.iter(f'{{{NS_PAQUETE}}}Relationship'):
+        if relacion.get('Id') == rId:
+            return _resolve_target(ruta_libro, relacion.get('Target'))
+    raise ValueError("No se encontró la primera hoja del Excel")
+
+
+def _epoch(workbook):
+    # Los libros creados con Excel para Mac antiguo cuentan los días desde 1904
+    propiedades = workbook.find(f'{{{NS_HOJA}}}workbookPr')
+    if propiedades is not None and propiedades.get('date1904') in ('1', 'true'):
+        return MAC_EPOCH
+    return WINDOWS_EPOCH
+
+
+def _read_date_styles(libro, ruta_estilos, epoca):
+    """Conversión de cada estilo de celda (atributo s) con formato de fecha,
+    hora o duración, igual que la hace openpyxl al leer la celda."""
+    estilos = etree.fromstring(libro.read(ruta_estilos))
+    formatos = dict(BUILTIN_FORMATS)
+    for formato in estilos.iterfind(f'{{{NS_HOJA}}}numFmts/{{{NS_HOJA}}}numFmt'):
+        formatos[int(formato.get('numFmtId'))] = formato.get('formatCode')
+    fechas = {}
+    for indice, xf in enumerate(estilos.iterfind(f'{{{NS_HOJA}}}cellXfs/{{{NS_HOJA}}}xf')):
+        formato = formatos.get(int(xf.get('numFmtId', 0)))
+        if formato and is_date_format(formato):
+            fechas[str(indice)] = partial(from_excel, epoch=epoca, timedelta=is_timedelta_format(formato))
+    return fechas
+
+
+def _read_shared_strings(libro, ruta_cadenas):
+    cadenas = []
+    with libro.open(ruta_cadenas) as origen:
+        for evento, elemento in etree.iterparse(origen, tag=f'{{{NS_HOJA}}}si'):
+            cadenas.append(_rich_text(elemento))
+            elemento.clear()
+    return cadenas
+
+
+def _rich_text(elemento):
+    # Texto de un <si> o <is>: un <t> simple o varios tramos <r><t>; las
+    # anotaciones fonéticas (<rPh>) no forman parte del valor
+    partes = []
+    for hijo in elemento:
+        if hijo.tag == TEXTO:
+            partes.append(hijo.text or '')
+        elif hijo.tag == TEXTO_ENRIQUECIDO:
+            partes.append(hijo.findtext(TEXTO) or '')
+    return ''.join(partes)
+
+
+def _column_index(referencia):
+    # 'AB12' -> 27 (columnas numeradas desde 0)
+    indice = 0
+    for caracter in referencia:
+        if caracter.isdigit():
+            break
+        indice = indice * 26 + ord(caracter.upper()) - 64
+    return indice - 1
+
+
+def _cell_value(celda, cadenas, fechas):
+    tipo = celda.get('t', 'n')
+    if tipo == 'inlineStr':
+        en_linea = celda.find(TEXTO_EN_LINEA)
+        return _rich_text(en_linea) if en_linea is not None else None
+    valor = celda.findtext(VALOR)
+    if valor is None or valor == '':
+        return None
+    if tipo == 's':
+        return cadenas[int(valor)]
+    if tipo == 'b':
+        return valor == '1'
+    if tipo == 'n':
+        # Igual que openpyxl: los números sin parte decimal se leen como enteros
+        if '.' in valor or 'E' in valor or 'e' in valor:
+            numero = float(valor)
+        else:
+            numero = int(valor)
+        conversion = fechas.get(celda.get('s'))
+        if conversion is None:
+            return numero
+        try:
+            return conversion(numero)
+        except (OverflowError, ValueError):
+            # Fuera del rango de fechas: se deja el número
+            return numero
+    if tipo == 'd':
+        return from_ISO8601(valor)
+    # 'str' (resultado de fórmula) y 'e' (error) se dejan como texto
+    return valor
+
+
+def _read_columns(hoja, cadenas, fechas):
+    cabecera = None
+    indices = {}
+    ultima_columna = -1
+    columnas = {}
+    numeros_fila = []
+    numero_fila = 0
+
+    for evento, fila in etree.iterparse(hoja, tag=FILA):
+        # El atributo r de filas y celdas es opcional; si falta, se cuenta
+        numero_fila = int(fila.get('r') or numero_fila + 1)
+        valores = {}
+        posicion = -1
+        for celda in fila.iterchildren(CELDA):
+            referencia = celda.get('r')
+            posicion = _column_index(referencia) if referencia else posicion + 1
+            if cabecera is not None and posicion > ultima_columna:
+                # Las celdas vienen en orden de columna: el resto de la fila no se usa
+                break
+            if cabecera is None or posicion in indices:
+                valores[posicion] = _cell_value(celda, cadenas, fechas)
+
+        # Liberar la fila ya leída y las anteriores
+        fila.clear()
+        while fila.getprevious() is not None:
+            del fila.getparent()[0]
+
+        if cabecera is None:
+            # La primera fila es la cabecera, igual que en pd.read_excel
+            cabecera = {}
+            for posicion, nombre in sorted(valores.items()):
+                if nombre is not None:
+                    cabecera.setdefault(str(nombre).strip(), posicion)
+            _check_columns(cabecera, numero_fila)
+            indices = {
+                cabecera[columna]: columna for columna in COLUMNAS_ETIQUETA if columna in cabecera
+            }
+            ultima_columna = max(indices)
+            columnas = {columna: [] for columna in indices.values()}
+            continue
+
+        # Las filas sin ningún valor en las columnas de la etiqueta se ignoran
+        if all(valores.get(posicion) is None for posicion in indices):
+            continue
+        numeros_fila.append(numero_fila)
+        for posicion, columna in indices.items():
+            columnas[columna].append(valores.get(posicion))
+
+    if cabecera is None:
+        _check_columns({}, 1)
+    return columnas, numeros_fila
+
+
+def _check_columns(cabecera, numero_fila):
+    errores = [
+        Incidencia(numero_fila, columna, None, f"Falta la columna {columna}")
+        for columna in COLUMNAS_OBLIGATORIAS
+        if columna not in cabecera
+    ]
+    if errores:
+        raise ValidacionError(errores)
+
+
+def _normalize(df):
+    # Normalización vectorizada, una sola vez para toda la hoja
+    for columna in ('CODIGO', 'DESCRIPCION', 'CANTIDAD'):
+        df[columna] = _as_text(df[columna])
+
+    if 'IMAGEN' in df:
+        df['IMAGEN'] = _as_text(df['IMAGEN']).str.strip()
+    else:
+        df['IMAGEN'] = ''
+
+    # CONTEO_CAJAS se convierte a entero al validar la hoja
+    if 'CONTEO_CAJAS' not in df:
+        df['CONTEO_CAJAS'] = 1
+    return df[list(COLUMNAS_ETIQUETA)]
+
+
+def _as_text(columna):
+    # Los enteros guardados como número en Excel se muestran sin decimales
+    return columna.map(_cell_text)
+
+
+def _cell_text(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+def iter_label_rows(df):
+    # Tuplas ligeras (Index es el número de fila en el Excel, seguido de
+    # CODIGO, DESCRIPCION, ...) en lugar de una Series por fila como iterrows
+    return df.itertuples(name='FilaEtiqueta')
@@ -0,0 +1,225 @@
+"""Retención de los archivos de media: subidas, documentos y temporales.
+
+- Subidas: se borran las de los trabajos terminados hace más de
+  RETENCION_SUBIDAS_HORAS; las de los trabajos en cola o en proceso nunca.
+- Documentos: se borran los de los trabajos terminados hace más de
+  RETENCION_DOCUMENTOS_HORAS y, si los que quedan superan
+  RETENCION_DOCUMENTOS_MAX_BYTES, los más antiguos. Con ellos se borra su
+  manifiesto, y el trabajo se queda sin documento y fuera de la caché de
+  resultados. Los documentos parciales de trabajos fallidos se borran siempre.
+- Huérfanos: archivos de uploads y output que no son de ningún trabajo, y
+  lo que haya en DIRECTORIO_TEMPORAL (generaciones interrumpidas), cuando
+  llevan más de RETENCION_TEMPORALES_HORAS sin modificarse. El margen evita
+  borrar una subida que aún se está recibiendo o una generación en curso.
+
+Los trabajos se recorren por páginas de LOTE filas y se actualizan con un
+update() por página, sin cargarlos todos en memoria.
+"""
+import logging
+import os
+import shutil
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .almacenamiento import result_storage
+from .manifiesto import manifest_path
+from .models import ArchivoGenerado
+from .subidas import DESTINOS
+
+logger = logging.getLogger(__name__)
+
+# Trabajos que se leen y actualizan (o archivos que se buscan) en cada consulta
+LOTE = 500
+
+TERMINADOS = (ArchivoGenerado.COMPLETADO, ArchivoGenerado.FALLIDO)
+
+CATEGORIAS = ('subidas', 'documentos', 'huerfanos', 'temporales')
+
+SUFIJO_MANIFIESTO = '.manifiesto.json'
+
+
+def sweep_media(opciones, simular=False):
+    """Borra lo caducado y lo huérfano. Devuelve, por categoría, los
+    archivos borrados y los bytes liberados; con simular solo los cuenta."""
+    informe = {categoria: {'archivos': 0, 'bytes': 0} for categoria in CATEGORIAS}
+    ahora = timezone.now()
+    if opciones['RETENCION_SUBIDAS_HORAS'] is not None:
+        _sweep_uploads(ahora - timedelta(hours=opciones['RETENCION_SUBIDAS_HORAS']), informe, simular)
+    _sweep_documents(ahora, opciones, informe, simular)
+    if opciones['RETENCION_TEMPORALES_HORAS'] is not None:
+        limite = time.time() - opciones['RETENCION_TEMPORALES_HORAS'] * 3600
+        _sweep_orphans(limite, informe, simular)
+        if opciones['DIRECTORIO_TEMPORAL']:
+            _sweep_temporary(opciones['DIRECTORIO_TEMPORAL'], limite, informe, simular)
+    return informe
+
+
+def _sweep_uploads(limite, informe, simular):
+    caducados = ArchivoGenerado.objects.filter(
+        estado__in=TERMINADOS, fecha_fin__lt=limite,
+    ).exclude(excel_original='', zip_original='')
+    for pagina in _pages(caducados, 'excel_original', 'zip_original'):
+        for pk, excel, zip_ in pagina:
+            for relativa in (excel, zip_):
+                if relativa:
+                    _remove_file(os.path.join(settings.MEDIA_ROOT, relativa), informe['subidas'], simular)
+        _update([pk for pk, *_ in pagina], simular, excel_original='', zip_original='')
+
+
+def _sweep_documents(ahora, opciones, informe, simular):
+    # Del trabajo más reciente al más antiguo, para que la cuota conserve los últimos
+    horas = opciones['RETENCION_DOCUMENTOS_HORAS']
+    limite = ahora - timedelta(hours=horas) if horas is not None else None
+    cuota = opciones['RETENCION_DOCUMENTOS_MAX_BYTES']
+    terminados = ArchivoGenerado.objects.filter(estado__in=TERMINADOS).exclude(documento_generado='')
+    almacen = result_storage()
+    ocupados = 0
+    for pagina in _pages(terminados, 'estado', 'documento_generado', 'fecha_fin'):
+        sin_documento = []
+        for pk, estado, nombre, fecha_fin in pagina:
+            if not almacen.exists(nombre):
+                # El documento ya no está (fallo sin salida, borrado por fuera...)
+                sin_documento.append(pk)
+                continue
+            tamano = almacen.size(nombre)
+            caducado = (
+                estado == ArchivoGenerado.FALLIDO
+                or (limite is not None and fecha_fin is not None and fecha_fin < limite)
+                or (cuota is not None and ocupados + tamano > cuota)
+            )
+            if not caducado:
+                ocupados += tamano
+                continue
+            for archivo in (nombre, manifest_path(nombre)):
+                if archivo != nombre and not almacen.exists(archivo):
+                    continue
+                informe['documentos']['archivos'] += 1
+                informe['documentos']['bytes'] += almacen.size(archivo)
+                if not simular:
+                    almacen.delete(archivo)
+            sin_documento.append(pk)
+        _update(sin_documento, simular, documento_generado='', clave_contenido='')
+
+
+def _sweep_orphans(limite, informe, simular):
+    # Subidas sin trabajo: la petición falló o se cortó antes de crearlo
+    for directorio in DESTINOS.values():
+        for lote in _batches(_old_files(os.path.join(settings.MEDIA_ROOT, directorio), limite)):
+            relativas = {os.path.join(directorio, entrada.name): entrada for entrada in lote}
+            conocidas = set(
+                ArchivoGenerado.objects.filter(excel_original__in=relativas).values_list('excel_original', flat=True)
+            ) | set(
+                ArchivoGenerado.objects.filter(zip_original__in=relativas).values_list('zip_original', flat=True)
+            )
+            for relativa, entrada in relativas.items():
+                if relativa not in conocidas:
+                    _remove_file(entrada.path, informe['huerfanos'], simular)
+
+    # Documentos y manifiestos sin trabajo, o de trabajos que ya no tienen documento
+    almacen = result_storage()
+    directorio = ArchivoGenerado._meta.get_field('documento_generado').upload_to
+    if not almacen.exists(directorio):
+        return
+    for lote in _batches(almacen.listdir(directorio)[1]):
+        # Documento al que pertenece cada archivo: él mismo o, si es un
+        # manifiesto, el documento del mismo nombre
+        duenos = {}
+        for nombre_archivo in lote:
+            nombre = f'{directorio}/{nombre_archivo}'
+            if almacen.get_modified_time(nombre).timestamp() >= limite:
+                continue
+            if nombre.endswith(SUFIJO_MANIFIESTO):
+                base = nombre[:-len(SUFIJO_MANIFIESTO)]
+                duenos[nombre] = [f'{base}.docx', f'{base}.zip']
+            else:
+                duenos[nombre] = [nombre]
+        candidatos = [documento for documentos in duenos.values() for documento in documentos]
+        conocidos = set(
+            ArchivoGenerado.objects.filter(documento_generado__in=candidatos).values_list('documento_generado', flat=True)
+        )
+        for nombre, documentos in duenos.items():
+            if conocidos.isdisjoint(documentos):
+                tamano = almacen.size(nombre)
+                if not simular:
+                    almacen.delete(nombre)
+                informe['huerfanos']['archivos'] += 1
+                informe['huerfanos']['bytes'] += tamano
+
+
+def _sweep_temporary(directorio, limite, informe, simular):
+    if not os.path.isdir(directorio):
+        return
+    for entrada in os.scandir(directorio):
+        if entrada.stat(follow_symlinks=False).st_mtime >= limite:
+            continue
+        if entrada.is_dir(follow_symlinks=False):
+            tamano = _tree_size(entrada.path)
+            if not simular:
+                shutil.rmtree(entrada.path, ignore_errors=True)
+            informe['temporales']['archivos'] += 1
+            informe['temporales']['bytes'] += tamano
+        else:
+            _remove_file(entrada.path, informe['temporales'], simular)
+
+
+def _pages(consulta, *campos):
+    # Páginas de (pk, *campos) de la más reciente a la más antigua; cada una se
+    # lee entera antes de actualizarla, sin dejar un cursor abierto
+    ultimo = None
+    while True:
+        pagina = consulta if ultimo is None else consulta.filter(pk__lt=ultimo)
+        filas = list(pagina.order_by('-pk').values_list('pk', *campos)[:LOTE])
+        if not filas:
+            return
+        yield filas
+        ultimo = filas[-1][0]
+
+
+def _old_files(directorio, limite):
+    if not os.path.isdir(directorio):
+        return
+    for entrada in os.scandir(directorio):
+        if entrada.is_file(follow_symlinks=False) and entrada.stat().st_mtime < limite:
+            yield entrada
+
+
+def _batches(elementos):
+    lote = []
+    for elemento in elementos:
+        lote.append(elemento)
+        if len(lote) >= LOTE:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def _remove_file(ruta, contador, simular):
+    try:
+        tamano = os.path.getsize(ruta)
+        if not simular:
+            os.remove(ruta)
+    except FileNotFoundError:
+        return
+    except OSError:
+        logger.warning("No se pudo borrar %s", ruta)
+        return
+    contador['archivos'] += 1
+    contador['bytes'] += tamano
+
+
+def _tree_size(ruta):
+    total = 0
+    for raiz, _, archivos in os.walk(ruta):
+        for archivo in archivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, archivo))
+            except OSError:
+                pass
+    return total
+
+
+def _update(pks, simular, **campos):
+    if pks and not simular:
+        ArchivoGenerado.objects.filter(pk__in=pks).update(**campos)
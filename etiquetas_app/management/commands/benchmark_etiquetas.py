@@ -0,0 +1,138 @@
+import json
+import os
+import platform
+import tempfile
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from etiquetas_app.benchmark import (
+    ESCENARIOS,
+    REFERENCIA,
+    build_scenario,
+    load_reference,
+    reference_key,
+    run_isolated,
+    save_reference,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide generate_word_document con un Excel y un ZIP sintéticos y comprueba "
+        "que el texto y la estructura de las etiquetas no cambian."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'escenarios',
+            nargs='*',
+            default=['100', '1k'],
+            help=f"Escenarios a medir: {', '.join(ESCENARIOS)} o un número de etiquetas.",
+        )
+        parser.add_argument('--salida', help="Archivo JSON donde guardar los resultados.")
+        parser.add_argument('--directorio', help="Directorio para las fixtures y los documentos generados.")
+        parser.add_argument(
+            '--parametro',
+            action='append',
+            default=[],
+            metavar='NOMBRE=VALOR',
+            help="Cambia un parámetro del escenario (p. ej. imagenes=500 o formatos='[\"png\"]').",
+        )
+        parser.add_argument(
+            '--opcion',
+            action='append',
+            default=[],
+            metavar='NOMBRE=VALOR',
+            help="Opción de generación (p. ej. ESCRITURA_STREAMING=true o GENERACION_PROCESOS=4).",
+        )
+        parser.add_argument(
+            '--actualizar-referencia',
+            action='store_true',
+            help="Guarda las firmas obtenidas como nueva referencia en lugar de compararlas.",
+        )
+
+    def handle(self, *args, **options):
+        parametros = _parse_pairs(options['parametro'])
+        opciones = _parse_pairs(options['opcion'])
+        referencia = load_reference(REFERENCIA)
+
+        with tempfile.TemporaryDirectory(dir=options['directorio']) as directorio:
+            resultados = []
+            for nombre in options['escenarios']:
+                if nombre not in ESCENARIOS and not nombre.isdigit():
+                    raise CommandError(f"Escenario desconocido: {nombre}")
+                cambios = dict(parametros)
+                if nombre.isdigit():
+                    cambios.setdefault('etiquetas', int(nombre))
+                escenario = build_scenario(nombre, **cambios)
+
+                self.stdout.write(f"Escenario {nombre}: {escenario['etiquetas']} etiquetas...")
+                resultado = run_isolated(nombre, escenario, directorio, opciones)
+                resultado['referencia'] = self._check_reference(
+                    referencia, reference_key(nombre, escenario), resultado, options['actualizar_referencia']
+                )
+                # Los escenarios predefinidos sin cambios tienen que tener firma de referencia
+                resultado['referencia_obligatoria'] = nombre in ESCENARIOS and not parametros
+                resultados.append(resultado)
+                self._print_result(resultado)
+
+        if options['actualizar_referencia']:
+            save_reference(REFERENCIA, referencia)
+            self.stdout.write(f"Referencia actualizada en {REFERENCIA}")
+
+        if options['salida']:
+            with open(options['salida'], 'w', encoding='utf-8') as archivo:
+                json.dump({
+                    'fecha': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'cpus': os.cpu_count(),
+                    'resultados': resultados,
+                }, archivo, indent=2)
+            self.stdout.write(f"Resultados guardados en {options['salida']}")
+
+        if any(resultado['referencia'] == 'distinta' for resultado in resultados):
+            raise CommandError("El texto o la estructura de las etiquetas ha cambiado respecto a la referencia")
+        sin_referencia = [
+            resultado['escenario'] for resultado in resultados
+            if resultado['referencia'] == 'sin_referencia' and resultado['referencia_obligatoria']
+        ]
+        if sin_referencia:
+            raise CommandError(
+                f"No hay firma de referencia para: {', '.join(sin_referencia)}. "
+                "Genérala con --actualizar-referencia."
+            )
+
+    def _check_reference(self, referencia, clave, resultado, actualizar):
+        if actualizar:
+            referencia[clave] = resultado['firma']
+            return 'actualizada'
+        if clave not in referencia:
+            return 'sin_referencia'
+        return 'igual' if referencia[clave] == resultado['firma'] else 'distinta'
+
+    def _print_result(self, resultado):
+        self.stdout.write(
+            f"  {resultado['segundos']} s, {resultado['etiquetas_por_segundo']} etiquetas/s, "
+            f"pico RSS {resultado['pico_rss'] // (1024 * 1024)} MB, "
+            f"salida {resultado['tamano_salida'] // 1024} KB"
+        )
+        for etapa in resultado['etapas']:
+            self.stdout.write(f"    {etapa['etapa']:<22} {etapa['segundos']:>9.3f} s  {etapa['llamadas']:>7} llamadas")
+        estilo = {
+            'igual': self.style.SUCCESS,
+            'distinta': self.style.ERROR,
+        }.get(resultado['referencia'], self.style.WARNING)
+        self.stdout.write(estilo(f"  Referencia: {resultado['referencia']}"))
+
+
+def _parse_pairs(pares):
+    # NOMBRE=VALOR, con el valor interpretado como JSON si es posible
+    valores = {}
+    for par in pares:
+        nombre, separador, valor = par.partition('=')
+        if not separador:
+            raise CommandError(f"Se esperaba NOMBRE=VALOR: {par}")
+        try:
+            valores[nombre] = json.loads(valor)
+        except ValueError:
+            valores[nombre] = valor
+    return valores
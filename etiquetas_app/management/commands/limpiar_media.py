@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+from etiquetas_app.conf import get_opciones
+from etiquetas_app.limpieza import CATEGORIAS, sweep_media
+
+
+class Command(BaseCommand):
+    help = (
+        "Borra de media las subidas y los documentos caducados, los archivos sin trabajo "
+        "y los temporales abandonados, según las opciones RETENCION_*."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--simular',
+            action='store_true',
+            help="Muestra lo que se borraría sin borrar nada.",
+        )
+        parser.add_argument(
+            '--opcion',
+            action='append',
+            default=[],
+            metavar='NOMBRE=VALOR',
+            help="Cambia una opción de retención numérica (p. ej. RETENCION_SUBIDAS_HORAS=48).",
+        )
+
+    def handle(self, *args, **options):
+        cambios = {}
+        for par in options['opcion']:
+            nombre, _, valor = par.partition('=')
+            try:
+                cambios[nombre.strip()] = None if valor.strip().lower() == 'none' else float(valor)
+            except ValueError:
+                raise CommandError(f"Valor no numérico en --opcion {par}")
+        informe = sweep_media(get_opciones(**cambios), simular=options['simular'])
+
+        total_archivos = 0
+        total_bytes = 0
+        for categoria in CATEGORIAS:
+            archivos = informe[categoria]['archivos']
+            tamano = informe[categoria]['bytes']
+            total_archivos += archivos
+            total_bytes += tamano
+            self.stdout.write(f"  {categoria:<12} {archivos:>6} archivos  {filesizeformat(tamano):>10}")
+        verbo = "Se liberarían" if options['simular'] else "Liberados"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verbo} {filesizeformat(total_bytes)} en {total_archivos} archivos"
+        ))
@@ -0,0 +1,99 @@
+import subprocess
+import sys
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from etiquetas_app.conf import get_opciones
+
+# Lo que carga un proceso web o un trabajador al arrancar: las apps, las URLs
+# (y con ellas las vistas) y la cola de trabajos
+ARRANQUE = (
+    "import django; django.setup(); "
+    "from django.conf import settings; from importlib import import_module; "
+    "import_module(settings.ROOT_URLCONF); import etiquetas_app.trabajos"
+)
+
+# Paquetes de la generación que solo deben importarse al generar un documento
+PAQUETES_GENERACION = ('pandas', 'numpy', 'docx', 'lxml', 'qrcode', 'PIL', 'openpyxl')
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide con python -X importtime lo que tarda en importarse el arranque de "
+        "Django y comprueba que no carga la generación ni supera el presupuesto."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--presupuesto',
+            type=float,
+            help="Milisegundos máximos de importación (por defecto, la opción IMPORTACION_MAX_MS).",
+        )
+        parser.add_argument(
+            '--repeticiones',
+            type=int,
+            default=3,
+            help="Veces que se mide el arranque; se toma la más rápida.",
+        )
+        parser.add_argument('--top', type=int, default=10, help="Paquetes más lentos que se muestran.")
+
+    def handle(self, *args, **options):
+        presupuesto = options['presupuesto']
+        if presupuesto is None:
+            presupuesto = get_opciones()['IMPORTACION_MAX_MS']
+
+        medidas = min(
+            (_measure_startup() for _ in range(max(1, options['repeticiones']))),
+            key=lambda medida: medida['total'],
+        )
+        total_ms = medidas['total'] / 1000
+        self.stdout.write(f"Importación del arranque: {total_ms:.0f} ms en {len(medidas['modulos'])} módulos")
+        for paquete, microsegundos in sorted(
+            medidas['paquetes'].items(), key=lambda item: item[1], reverse=True
+        )[:options['top']]:
+            self.stdout.write(f"  {paquete:<30} {microsegundos / 1000:8.1f} ms")
+
+        errores = []
+        cargados = sorted(
+            paquete for paquete in PAQUETES_GENERACION
+            if any(modulo == paquete or modulo.startswith(f'{paquete}.') for modulo in medidas['modulos'])
+        )
+        if cargados:
+            errores.append(f"El arranque importa paquetes de la generación: {', '.join(cargados)}")
+        if presupuesto is not None and total_ms > presupuesto:
+            errores.append(f"La importación del arranque ({total_ms:.0f} ms) supera el presupuesto de {presupuesto:.0f} ms")
+        if errores:
+            raise CommandError('\n'.join(errores))
+        self.stdout.write(self.style.SUCCESS("Importación del arranque dentro del presupuesto"))
+
+
+def _measure_startup():
+    """Importa el arranque en un proceso nuevo con -X importtime.
+
+    Devuelve el total en microsegundos, el tiempo propio sumado por paquete
+    de primer nivel y el conjunto de módulos importados.
+    """
+    # El proceso hereda DJANGO_SETTINGS_MODULE de manage.py
+    proceso = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', ARRANQUE],
+        capture_output=True, text=True, cwd=settings.BASE_DIR,
+    )
+    if proceso.returncode != 0:
+        raise CommandError(f"No se pudo importar el arranque:\n{proceso.stderr[-2000:]}")
+
+    total = 0
+    paquetes = defaultdict(int)
+    modulos = set()
+    # Formato de cada línea: "import time: propio | acumulado | módulo"
+    for linea in proceso.stderr.splitlines():
+        if not linea.startswith('import time:'):
+            continue
+        propio, _, modulo = linea[len('import time:'):].split('|')
+        if not propio.strip().isdigit():
+            # Cabecera de la tabla
+            continue
+        modulo = modulo.strip()
+        total += int(propio)
+        paquetes[modulo.split('.')[0]] += int(propio)
+        modulos.add(modulo)
+    return {'total': total, 'paquetes': paquetes, 'modulos': modulos}
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from etiquetas_app.trabajos import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Procesa la cola de trabajos de generación de etiquetas guardada en la base de datos."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--una-vez',
+            action='store_true',
+            help="Procesa los trabajos pendientes y termina en lugar de esperar nuevos.",
+        )
+        parser.add_argument(
+            '--intervalo',
+            type=float,
+            default=2.0,
+            help="Segundos de espera entre consultas cuando la cola está vacía.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Esperando trabajos de generación...")
+        while True:
+            close_old_connections()
+            trabajo = claim_next_job()
+            if trabajo is None:
+                if options['una_vez']:
+                    break
+                time.sleep(options['intervalo'])
+                continue
+
+            self.stdout.write(f"Procesando trabajo {trabajo.pk}")
+            run_job(trabajo)
+            if trabajo.estado == trabajo.COMPLETADO:
+                self.stdout.write(self.style.SUCCESS(f"Trabajo {trabajo.pk} completado"))
+            else:
+                self.stdout.write(self.style.ERROR(f"Trabajo {trabajo.pk} fallido: {trabajo.error}"))
@@ -0,0 +1,67 @@
+"""Manifiesto de las etiquetas de un documento generado.
+
+Junto a cada documento se guarda un JSON con la huella del contenido de
+cada etiqueta (código, descripción, cantidad, caja N de M e imagen), la
+fila del Excel de la que sale y su posición en el documento. Al regenerar
+a partir de un documento anterior, las etiquetas cuya huella ya estaba se
+copian de él en lugar de volver a generarse.
+"""
+import hashlib
+import json
+import os
+from .archivos import write_atomic
+from .conf import OPCIONES_SALIDA, VERSION_PLANTILLA
+
+# Versión del formato del manifiesto
+VERSION = 1
+
+
+def manifest_path(output_path):
+    return f'{os.path.splitext(output_path)[0]}.manifiesto.json'
+
+
+def manifest_header(fecha_recepcion, opciones):
+    # Lo que comparten todas las etiquetas; si cambia, no se puede reutilizar ninguna
+    return {
+        'version': VERSION,
+        'plantilla': VERSION_PLANTILLA,
+        'fecha_recepcion': fecha_recepcion,
+        'opciones': {nombre: opciones[nombre] for nombre in OPCIONES_SALIDA},
+    }
+
+
+def label_hashes(row, huella_imagen):
+    """Huella de cada una de las cajas de una fila, en orden."""
+    num_cajas = int(row.CONTEO_CAJAS)
+    base = json.dumps([row.CODIGO, row.DESCRIPCION, row.CANTIDAD, num_cajas, huella_imagen])
+    return [
+        hashlib.sha1(f'{base}{num_caja}'.encode('utf-8')).hexdigest()
+        for num_caja in range(1, num_cajas + 1)
+    ]
+
+
+def write_manifest(output_path, cabecera, etiquetas):
+    # etiquetas: (fila, caja, huella) de cada etiqueta en el orden del documento
+    manifiesto = dict(cabecera, etiquetas=[
+        {'fila': int(fila), 'caja': caja, 'huella': huella, 'posicion': posicion}
+        for posicion, (fila, caja, huella) in enumerate(etiquetas)
+    ])
+    write_atomic(manifest_path(output_path), json.dumps(manifiesto).encode('utf-8'))
+
+
+def reusable_labels(documento_base, cabecera):
+    """Posición en documento_base de cada huella reutilizable.
+
+    Vacío si el documento no tiene manifiesto o se generó con otra
+    plantilla, fecha u opciones de salida.
+    """
+    try:
+        with open(manifest_path(documento_base), encoding='utf-8') as archivo:
+            manifiesto = json.load(archivo)
+    except (OSError, ValueError):
+        return {}
+    if not os.path.exists(documento_base):
+        return {}
+    if any(manifiesto.get(nombre) != valor for nombre, valor in cabecera.items()):
+        return {}
+    return {etiqueta['huella']: etiqueta['posicion'] for etiqueta in manifiesto['etiquetas']}
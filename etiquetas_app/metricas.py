@@ -0,0 +1,146 @@
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Etapas de un trabajo, en el orden en que se muestran
+ETAPAS = (
+    'escritura_subida',
+    'indice_imagenes',
+    'lectura_excel',
+    'busqueda_imagenes',
+    'validacion',
+    'copia_etiquetas',
+    'carga_imagenes',
+    'generacion_qr',
+    'construccion_tablas',
+    'union_parciales',
+    'empaquetado',
+    'guardado',
+)
+
+
+def etapa_orden(nombre):
+    # Posición de la etapa en ETAPAS; las desconocidas van al final
+    return ETAPAS.index(nombre) if nombre in ETAPAS else len(ETAPAS)
+
+
+def rss_peak():
+    # Pico de memoria residente del proceso en bytes (ru_maxrss está en KB en Linux)
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Instrumentacion:
+    """Tiempo, número de llamadas y pico de memoria de cada etapa.
+
+    La memoria se toma del pico de RSS del proceso al terminar cada llamada,
+    que es prácticamente gratis. Con usar_tracemalloc=True se mide además el pico
+    de memoria asignada por Python dentro de cada etapa, a costa de hacer
+    bastante más lenta la generación.
+    """
+
+    def __init__(self, usar_tracemalloc=False):
+        self.etapas = {}
+        self.usar_tracemalloc = usar_tracemalloc
+        # Picos de tracemalloc de las etapas abiertas, para anidarlas
+        self._pila = []
+        self._detener_tracemalloc = usar_tracemalloc and not tracemalloc.is_tracing()
+        if self._detener_tracemalloc:
+            tracemalloc.start()
+
+    def close(self):
+        if self._detener_tracemalloc:
+            tracemalloc.stop()
+            self._detener_tracemalloc = False
+
+    @contextmanager
+    def etapa(self, nombre):
+        if self.usar_tracemalloc:
+            self._abrir_pico()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            segundos = time.perf_counter() - inicio
+            pico = self._cerrar_pico() if self.usar_tracemalloc else 0
+            self.add(nombre, segundos, pico_python=pico)
+
+    def add(self, nombre, segundos, llamadas=1, pico_python=0):
+        etapa = self.etapas.get(nombre)
+        if etapa is None:
+            etapa = self.etapas[nombre] = {
+                'segundos': 0.0, 'llamadas': 0, 'pico_rss': 0, 'pico_python': 0,
+            }
+        etapa['segundos'] += segundos
+        etapa['llamadas'] += llamadas
+        etapa['pico_rss'] = max(etapa['pico_rss'], rss_peak())
+        etapa['pico_python'] = max(etapa['pico_python'], pico_python)
+
+    def seconds(self, nombre):
+        return self.etapas.get(nombre, {}).get('segundos', 0.0)
+
+    def merge(self, resultados, procesos=1):
+        # Añade las etapas medidas en otro proceso; el tiempo se reparte entre
+        # los procesos que trabajaron en paralelo
+        for resultado in resultados:
+            self.add(resultado['etapa'], resultado['segundos'] / procesos, resultado['llamadas'])
+            etapa = self.etapas[resultado['etapa']]
+            etapa['pico_rss'] = max(etapa['pico_rss'], resultado['pico_rss'])
+            etapa['pico_python'] = max(etapa['pico_python'], resultado['pico_python'])
+
+    def results(self):
+        return [
+            dict(etapa=nombre, **valores)
+            for nombre, valores in sorted(self.etapas.items(), key=lambda item: etapa_orden(item[0]))
+        ]
+
+    def _abrir_pico(self):
+        # El pico de la etapa que la contiene se conserva antes de reiniciarlo
+        pico_actual = tracemalloc.get_traced_memory()[1]
+        if self._pila:
+            self._pila[-1] = max(self._pila[-1], pico_actual)
+        tracemalloc.reset_peak()
+        self._pila.append(0)
+
+    def _cerrar_pico(self):
+        pico = max(self._pila.pop(), tracemalloc.get_traced_memory()[1])
+        if self._pila:
+            self._pila[-1] = max(self._pila[-1], pico)
+        return pico
+
+
+class Avance:
+    """Etiquetas terminadas de un trabajo y etapa en curso.
+
+    Cada cambio se comunica a progreso(etapa, hechas, total); total es None
+    hasta que se ha validado el Excel. Sin función de progreso no hace nada.
+    """
+
+    def __init__(self, progreso=None):
+        self.progreso = progreso
+        self.total = None
+        self.hechas = 0
+
+    def etapa(self, nombre):
+        if self.progreso is not None:
+            self.progreso(nombre, self.hechas, self.total)
+
+    def add(self, etiquetas, etapa='construccion_tablas'):
+        self.hechas += etiquetas
+        self.etapa(etapa)
+
+
+def log_metrics(resultados, **contexto):
+    # Una línea JSON por etapa, fácil de filtrar y agregar desde los logs
+    for resultado in resultados:
+        logger.info(json.dumps(dict(evento='metrica_etapa', **contexto, **resultado)))
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+def marcar_existentes_completados(apps, schema_editor):
+    # Los registros anteriores a la cola ya tienen su documento generado
+    ArchivoGenerado = apps.get_model('etiquetas_app', 'ArchivoGenerado')
+    ArchivoGenerado.objects.update(estado='completado')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0002_alter_archivogenerado_documento_generado'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='estado',
+            field=models.CharField(choices=[('en_cola', 'En cola'), ('procesando', 'Procesando'), ('completado', 'Completado'), ('fallido', 'Fallido')], db_index=True, default='en_cola', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='fecha_fin',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='fecha_inicio',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='resumen',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(marcar_existentes_completados, migrations.RunPython.noop),
+    ]
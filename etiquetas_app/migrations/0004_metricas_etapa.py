@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0003_estado_trabajo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='duracion_segundos',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='etiquetas',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='MetricaEtapa',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('etapa', models.CharField(max_length=50)),
+                ('orden', models.PositiveSmallIntegerField(default=0)),
+                ('segundos', models.FloatField()),
+                ('llamadas', models.PositiveIntegerField()),
+                ('pico_rss', models.BigIntegerField(help_text='Pico de memoria residente del proceso, en bytes')),
+                ('pico_python', models.BigIntegerField(default=0, help_text='Pico de memoria de Python medido con tracemalloc, en bytes')),
+                ('archivo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metricas', to='etiquetas_app.archivogenerado')),
+            ],
+            options={
+                'ordering': ['archivo', 'orden'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0004_metricas_etapa'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='clave_contenido',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0005_clave_contenido'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='trabajo_base',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='etiquetas_app.archivogenerado'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0006_trabajo_base'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='etapa_actual',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='etiquetas_hechas',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
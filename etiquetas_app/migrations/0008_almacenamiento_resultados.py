@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:32
+
+import etiquetas_app.almacenamiento
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0007_progreso_trabajo'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivogenerado',
+            name='documento_generado',
+            field=models.FileField(storage=etiquetas_app.almacenamiento.result_storage, upload_to='output'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+def crear_cola(apps, schema_editor):
+    apps.get_model('etiquetas_app', 'ColaGeneracion').objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0008_almacenamiento_resultados'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ColaGeneracion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actualizada', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='memoria_estimada',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(crear_cola, migrations.RunPython.noop),
+    ]
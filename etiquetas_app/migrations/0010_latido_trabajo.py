@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('etiquetas_app', '0009_control_admision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivogenerado',
+            name='latido',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,13 +1,80 @@
 from django.db import models
 from django.db import models
 from django.contrib.auth.models import User
+from .almacenamiento import result_storage
+from .metricas import etapa_orden
 
 class ArchivoGenerado(models.Model):
+    # Estados del trabajo de generación en la cola
+    EN_COLA = 'en_cola'
+    PROCESANDO = 'procesando'
+    COMPLETADO = 'completado'
+    FALLIDO = 'fallido'
+    ESTADOS = [
+        (EN_COLA, 'En cola'),
+        (PROCESANDO, 'Procesando'),
+        (COMPLETADO, 'Completado'),
+        (FALLIDO, 'Fallido'),
+    ]
+
     usuario = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     excel_original = models.CharField(max_length=255)
     zip_original = models.CharField(max_length=255)
-    documento_generado = models.FileField(upload_to='output')
+    documento_generado = models.FileField(upload_to='output', storage=result_storage)
     fecha_creacion = models.DateTimeField(auto_now_add=True)
+    estado = models.CharField(max_length=20, choices=ESTADOS, default=EN_COLA, db_index=True)
+    error = models.TextField(blank=True)
+    # Resumen devuelto por generate_word_document (imágenes no encontradas, caché de QR...)
+    resumen = models.JSONField(default=dict, blank=True)
+    fecha_inicio = models.DateTimeField(null=True, blank=True)
+    fecha_fin = models.DateTimeField(null=True, blank=True)
+    # Tamaño y duración del trabajo, para comparar las métricas entre trabajos parecidos
+    etiquetas = models.PositiveIntegerField(null=True, blank=True)
+    duracion_segundos = models.FloatField(null=True, blank=True)
+    # Huella del contenido subido; los trabajos con la misma clave producen el
+    # mismo documento (ver resultados.py). Vacía si el documento ya no se reutiliza
+    clave_contenido = models.CharField(max_length=64, blank=True, db_index=True)
+    # Trabajo anterior del que se copian las etiquetas que no han cambiado
+    trabajo_base = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Avance mientras se procesa: etapa en curso y etiquetas terminadas de las
+    # del campo etiquetas
+    etapa_actual = models.CharField(max_length=50, blank=True)
+    etiquetas_hechas = models.PositiveIntegerField(default=0)
+    # Memoria que se estima que necesita la generación, para el control de
+    # admisión (ver admision.py); None mientras no se ha estimado
+    memoria_estimada = models.BigIntegerField(null=True, blank=True)
+    # Última vez que el trabajador que lo procesa dio señales de vida; un
+    # trabajo en proceso sin latido reciente se da por interrumpido
+    latido = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
-        return f"Documento generado el {self.fecha_creacion}"
\ No newline at end of file
+        return f"Documento generado el {self.fecha_creacion}"
+
+class ColaGeneracion(models.Model):
+    # Fila única que se bloquea mientras un trabajador decide qué trabajo
+    # puede empezar, para que los límites de admisión se cumplan entre procesos
+    actualizada = models.DateTimeField(auto_now=True)
+
+class MetricaEtapa(models.Model):
+    # Tiempo, llamadas y pico de memoria de una etapa de la generación
+    archivo = models.ForeignKey(ArchivoGenerado, on_delete=models.CASCADE, related_name='metricas')
+    etapa = models.CharField(max_length=50)
+    orden = models.PositiveSmallIntegerField(default=0)
+    segundos = models.FloatField()
+    llamadas = models.PositiveIntegerField()
+    pico_rss = models.BigIntegerField(help_text="Pico de memoria residente del proceso, en bytes")
+    pico_python = models.BigIntegerField(default=0, help_text="Pico de memoria de Python medido con tracemalloc, en bytes")
+
+    class Meta:
+        ordering = ['archivo', 'orden']
+
+    def __str__(self):
+        return f"{self.etapa}: {self.segundos:.2f} s"
+
+    @classmethod
+    def save_results(cls, archivo, resultados):
+        # resultados es la lista de Instrumentacion.results()
+        cls.objects.bulk_create(
+            cls(archivo=archivo, orden=etapa_orden(resultado['etapa']), **resultado)
+            for resultado in resultados
+        )
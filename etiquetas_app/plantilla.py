@@ -0,0 +1,307 @@
+import copy
+from docx import Document
+from docx.shared import Inches, Pt, RGBColor
+from docx.enum.table import WD_TABLE_ALIGNMENT
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.oxml.shape import CT_Inline
+from .conf import VERSION_PLANTILLA
+
+def set_table_borders(table):
+    # Tu código existente para configurar bordes
+    tbl = table._element
+    tblPr = tbl.xpath("w:tblPr")
+    if not tblPr:
+        tblPr = OxmlElement('w:tblPr')
+        tbl.insert(0, tblPr)
+    else:
+        tblPr = tblPr[0]
+    tblBorders = OxmlElement('w:tblBorders')
+    for border_name in ['top', 'left', 'bottom', 'right', 'insideH', 'insideV']:
+        border = OxmlElement(f'w:{border_name}')
+        border.set(qn('w:val'), 'single')
+        border.set(qn('w:sz'), '8')
+        border.set(qn('w:space'), '0')
+        border.set(qn('w:color'), '000000')
+        tblBorders.append(border)
+    tblPr.append(tblBorders)
+
+def remove_paragraph_spacing(paragraph):
+    # Tu código existente para eliminar espacios
+    if paragraph:
+        p = paragraph._p
+        pPr = p.get_or_add_pPr()
+        spacing = OxmlElement('w:spacing')
+        spacing.set(qn('w:before'), '20')
+        spacing.set(qn('w:after'), '20')
+        pPr.append(spacing)
+
+def adjust_cell_spacing(cell):
+    # Tu código existente para ajustar espacios en celdas
+    tcPr = cell._element.tcPr
+    if tcPr is None:
+        tcPr = OxmlElement('w:tcPr')
+        cell._element.append(tcPr)
+
+    tblCellMar = OxmlElement('w:tcMar')
+    margins = {'top': '40', 'left': '60', 'bottom': '40', 'right': '60'}
+    for margin, value in margins.items():
+        mar = OxmlElement(f'w:{margin}')
+        mar.set(qn('w:w'), value)
+        mar.set(qn('w:type'), 'dxa')
+        tblCellMar.append(mar)
+
+    existing_mar = tcPr.find(qn('w:tcMar'))
+    if existing_mar is not None:
+        tcPr.remove(existing_mar)
+    tcPr.append(tblCellMar)
+
+    tcVAlign = OxmlElement('w:vAlign')
+    tcVAlign.set(qn('w:val'), 'top')
+    tcPr.append(tcVAlign)
+
+    for paragraph in cell.paragraphs:
+        remove_paragraph_spacing(paragraph)
+
+def configure_margins(doc):
+    # Configurar márgenes del documento
+    for section in doc.sections:
+        section.top_margin = Inches(0.3)
+        section.bottom_margin = Inches(0.3)
+        section.left_margin = Inches(0.5)
+        section.right_margin = Inches(0.5)
+
+def _element_path(raiz, elemento):
+    # Ruta de índices de hijos desde la raíz hasta el elemento
+    indices = []
+    while elemento is not raiz:
+        padre = elemento.getparent()
+        indices.append(padre.index(elemento))
+        elemento = padre
+    return tuple(reversed(indices))
+
+def _follow_path(raiz, ruta):
+    for indice in ruta:
+        raiz = raiz[indice]
+    return raiz
+
+
+class LabelTemplate:
+    """Plantilla XML de la etiqueta de una caja.
+
+    El esqueleto de la etiqueta (tabla exterior 2x2, tabla de datos de 11
+    filas con sus celdas fusionadas y cuadrícula de registro 22x4) se
+    construye una sola vez por trabajo con python-docx. Cada caja se obtiene
+    con una copia profunda del XML en la que solo se rellenan los huecos
+    variables: código, QR, imagen, descripción, caja N de M y cantidad. La
+    fecha de recepción es la misma para todo el trabajo y queda fija en el
+    esqueleto.
+    """
+
+    # Versión del diseño de la etiqueta, ver conf.VERSION_PLANTILLA
+    VERSION = VERSION_PLANTILLA
+
+    def __init__(self, fecha_recepcion):
+        # El documento auxiliar debe tener los mismos márgenes que el de salida,
+        # ya que python-docx calcula el ancho de las celdas a partir de ellos
+        doc = Document()
+        configure_margins(doc)
+
+        # Crear tabla principal
+        table = doc.add_table(rows=2, cols=2)
+        table.alignment = WD_TABLE_ALIGNMENT.CENTER
+        table.autofit = False
+        table.columns[0].width = Inches(3)
+        table.columns[1].width = Inches(3)
+        set_table_borders(table)
+
+        # Ajustar espacios en todas las celdas
+        for row_cells in table.rows:
+            for cell in row_cells.cells:
+                adjust_cell_spacing(cell)
+
+        # Celda izquierda: imagen y datos
+        left_cell = table.cell(0, 0)
+
+        # Hueco de la imagen: el esqueleto se construye con la variante con
+        # imagen (párrafo centrado y un run vacío) y se recorta si no la hay
+        p_imagen = left_cell.paragraphs[0]
+        p_imagen.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run_imagen = p_imagen.add_run()
+
+        # Tabla de datos
+        # La tabla ahora necesitará más filas para acomodar los merges y nuevos campos
+        # CÓDIGO (4) + REVISADO (2) + BLANCO (1) + RECEPCIONADO (1) + DESCRIPCIÓN (1) + CAJA (1) + CANTIDAD (1) = 11 filas
+        data_table = left_cell.add_table(rows=11, cols=1)
+        data_table.alignment = WD_TABLE_ALIGNMENT.CENTER
+        set_table_borders(data_table)
+
+        # Aplicar ajuste de espaciado a todas las celdas de data_table
+        for row_cells_dt in data_table.rows:
+            for cell_dt in row_cells_dt.cells:
+                adjust_cell_spacing(cell_dt)
+
+        # 1. Celda para CÓDIGO (ocupa 4 filas)
+        codigo_cell = data_table.cell(0, 0)
+
+        # Limpiar el contenido por defecto y añadir el nuevo con formato
+        codigo_cell.text = '' # Limpiar cualquier texto previo
+        p_codigo = codigo_cell.paragraphs[0]
+        p_codigo.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run_codigo = p_codigo.add_run('CODIGO')
+        run_codigo.font.size = Pt(33)
+        run_codigo.font.color.rgb = RGBColor(255, 0, 0) # Color Rojo
+
+        # Párrafo para el Código QR debajo del texto del código
+        p_qr = codigo_cell.add_paragraph()
+        p_qr.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run_qr = p_qr.add_run()
+
+        # Fusionar las celdas para CÓDIGO
+        codigo_cell.merge(data_table.cell(1, 0))
+        codigo_cell.merge(data_table.cell(2, 0))
+        codigo_cell.merge(data_table.cell(3, 0))
+
+        # Ajustar alineación vertical de la celda fusionada de CÓDIGO a 'center'
+        tcPr_codigo = codigo_cell._element.get_or_add_tcPr()
+        # Eliminar alineación vertical previa si existe (de adjust_cell_spacing)
+        existing_vAlign = tcPr_codigo.find(qn('w:vAlign'))
+        if existing_vAlign is not None:
+            tcPr_codigo.remove(existing_vAlign)
+        # Añadir nueva alineación vertical
+        vAlign_codigo = OxmlElement('w:vAlign')
+        vAlign_codigo.set(qn('w:val'), 'center') # Centrar verticalmente
+        tcPr_codigo.append(vAlign_codigo)
+
+        # 2. Celda para REVISADO POR (ocupa 2 filas)
+        revisado_cell = data_table.cell(4, 0)
+        revisado_cell.text = "REVISADO POR:"
+        revisado_cell.merge(data_table.cell(5, 0))
+
+        # 3. Celda en BLANCO (ocupa 1 fila)
+
+        # 4. Celda para RECEPCIONADO (ocupa 1 fila)
+        data_table.cell(7, 0).text = f"RECEPCIONADO: {fecha_recepcion}"
+
+        # 5, 6 y 7. Celdas para DESCRIPCIÓN, CAJA y CANTIDAD (una fila cada una)
+        data_table.cell(8, 0).text = "DESCRIPCIÓN"
+        data_table.cell(9, 0).text = "CAJA"
+        data_table.cell(10, 0).text = "CANTIDAD"
+        run_descripcion = data_table.cell(8, 0).paragraphs[0].runs[0]
+        run_caja = data_table.cell(9, 0).paragraphs[0].runs[0]
+        run_cantidad = data_table.cell(10, 0).paragraphs[0].runs[0]
+
+        # Celda derecha: tabla de registro
+        right_cell = table.cell(0, 1)
+
+        # Eliminar párrafo existente
+        if right_cell.paragraphs:
+            p = right_cell.paragraphs[0]
+            p._element.getparent().remove(p._element)
+
+        # Tabla interna
+        inner_table = right_cell.add_table(rows=22, cols=4)
+        inner_table.alignment = WD_TABLE_ALIGNMENT.CENTER
+        set_table_borders(inner_table)
+
+        for row_cells in inner_table.rows:
+            for cell in row_cells.cells:
+                adjust_cell_spacing(cell)
+
+        headers = ['FECHA DD/MM/AA', 'CANT.', 'RP.', 'FIRMA']
+        for j, header in enumerate(headers):
+            inner_table.cell(0, j).text = header
+
+        for i in range(1, 22):
+            for j in range(4):
+                inner_table.cell(i, j).text = ""
+
+        # Celda de observación
+        obs_cell = table.cell(1, 0)
+        obs_cell.merge(table.cell(1, 1))
+        obs_cell.text = "OBSERVACIÓN:"
+
+        # Aumentar altura de la celda de observación
+        tr = obs_cell._element.getparent()
+        trHeight = OxmlElement('w:trHeight')
+        trHeight.set(qn('w:val'), '800')
+        trHeight.set(qn('w:hRule'), 'atLeast')
+        trPr = tr.get_or_add_trPr()
+        trPr.append(trHeight)
+
+        # Salto de página que separa dos etiquetas
+        doc.add_page_break()
+        body = doc.element.body
+        self.salto_pagina = body[1]
+        self.tabla = table._tbl
+        # Separados del documento auxiliar, las copias solo arrastran las
+        # declaraciones de espacios de nombres que realmente usan
+        body.remove(self.tabla)
+        body.remove(self.salto_pagina)
+
+        # Rutas de los huecos variables dentro del esqueleto
+        self.rutas = {
+            nombre: _element_path(self.tabla, elemento)
+            for nombre, elemento in {
+                'imagen_p': p_imagen._p,
+                'imagen_jc': p_imagen._p.pPr.jc,
+                'imagen_run': run_imagen._r,
+                'codigo': run_codigo._r,
+                'qr': run_qr._r,
+                'descripcion': run_descripcion._r,
+                'caja': run_caja._r,
+                'cantidad': run_cantidad._r,
+            }.items()
+        }
+        self._dibujos = {}
+
+    def page_break(self):
+        return copy.deepcopy(self.salto_pagina)
+
+    def render(self, ids_formas, codigo, descripcion, num_caja, num_cajas, cantidad,
+               qr, imagen=None, error_imagen=None):
+        """Devuelve el elemento w:tbl de la etiqueta de una caja.
+
+        qr e imagen son imágenes ya registradas en el paquete (con su
+        relationship id); ids_formas es el contador de ids de dibujo del
+        documento.
+        """
+        tabla = copy.deepcopy(self.tabla)
+        # Resolver todos los huecos antes de modificar el árbol
+        huecos = {nombre: _follow_path(tabla, ruta) for nombre, ruta in self.rutas.items()}
+
+        huecos['codigo'].text = codigo
+        huecos['qr'].append(self._drawing(qr, ids_formas))
+        huecos['descripcion'].text = f"DESCRIPCIÓN: {descripcion}"
+        huecos['caja'].text = f"CAJA {num_caja} DE {num_cajas}"
+        huecos['cantidad'].text = f"CANTIDAD: {cantidad}"
+
+        if imagen is not None:
+            huecos['imagen_run'].append(self._drawing(imagen, ids_formas))
+        elif error_imagen is not None:
+            huecos['imagen_run'].text = f"Error al procesar imagen: {str(error_imagen)}"
+        else:
+            # Sin imagen el párrafo queda vacío y sin alineación
+            p_imagen = huecos['imagen_p']
+            p_imagen.remove(huecos['imagen_run'])
+            huecos['imagen_jc'].getparent().remove(huecos['imagen_jc'])
+        return tabla
+
+    def _drawing(self, imagen_registrada, ids_formas):
+        # El w:drawing de cada imagen registrada se construye una vez y se copia
+        dibujo = self._dibujos.get(imagen_registrada.rId)
+        if dibujo is None:
+            dibujo = OxmlElement('w:drawing')
+            dibujo.append(CT_Inline.new_pic_inline(
+                0,
+                imagen_registrada.rId,
+                imagen_registrada.filename,
+                imagen_registrada.cx,
+                imagen_registrada.cy,
+            ))
+            self._dibujos[imagen_registrada.rId] = dibujo
+        dibujo = copy.deepcopy(dibujo)
+        # Cada dibujo necesita un id único en el documento
+        dibujo[0].docPr.id = next(ids_formas)
+        return dibujo
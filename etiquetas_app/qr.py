@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import numpy as np
+import qrcode
+from PIL import Image
+from .archivos import write_atomic
+
+# Cambiar esta versión cuando cambie la forma de dibujar el QR, para que no se
+# reutilicen en disco imágenes generadas con el renderizador anterior
+VERSION_RENDER_QR = 'qr-v2'
+
+# Ancho impreso del QR en la etiqueta
+ANCHO_QR_PULGADAS = 2.0
+
+NIVELES_CORRECCION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+# Fracción del tamaño máximo que queda en disco tras una expulsión, para no
+# recorrer el directorio en cada escritura una vez alcanzado el límite
+FRACCION_TRAS_EXPULSION = 0.9
+
+# Bytes que ocupa cada directorio de caché según este proceso: se mide una
+# vez y después se suma lo que se escribe. Otros procesos también escriben
+# en él, así que cada expulsión lo vuelve a medir
+_tamano_disco = {}
+
+
+def render_qr(codigo, dpi=150, correccion='M', borde=4, png_optimizar=True):
+    """Genera el PNG de 1 bit del código QR para un CÓDIGO de producto.
+
+    La matriz de módulos se amplía con NumPy a un número entero de píxeles
+    por módulo, calculado para que el QR mida ANCHO_QR_PULGADAS al DPI
+    indicado; así Word no tiene que reescalar una imagen mayor de lo necesario.
+    """
+    qr = qrcode.QRCode(error_correction=NIVELES_CORRECCION[correccion], box_size=1, border=borde)
+    qr.add_data(codigo)
+    qr.make(fit=True)
+
+    # get_matrix incluye el borde; True indica un módulo oscuro
+    modulos = np.array(qr.get_matrix(), dtype=bool)
+    pixeles_por_modulo = max(1, round(ANCHO_QR_PULGADAS * dpi / modulos.shape[0]))
+    # En el modo '1' de Pillow True es blanco, por eso se invierte la matriz
+    pixeles = np.repeat(np.repeat(~modulos, pixeles_por_modulo, axis=0), pixeles_por_modulo, axis=1)
+    qr_img = Image.fromarray(pixeles)
+
+    qr_image_stream = io.BytesIO()
+    dpi_efectivo = pixeles.shape[1] / ANCHO_QR_PULGADAS
+    qr_img.save(qr_image_stream, format='PNG', optimize=png_optimizar, dpi=(dpi_efectivo, dpi_efectivo))
+    return qr_image_stream.getvalue()
+
+
+class QRCache:
+    """Caché de imágenes QR por CÓDIGO.
+
+    Si se indica un directorio, persiste los PNG en disco para reutilizarlos
+    entre trabajos. Dentro de un documento cada código se pide una sola vez,
+    porque todas sus etiquetas comparten la imagen registrada.
+    La caché en disco tiene un tamaño máximo y expulsa primero los archivos
+    usados hace más tiempo (se toma la fecha de modificación como último uso).
+    Solo se expulsa cuando una escritura supera el máximo, sin recorrer el
+    directorio en cada trabajo.
+    """
+
+    def __init__(self, directorio=None, max_bytes=None, **opciones_render):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        # Opciones de render_qr (dpi, correccion, borde, png_optimizar)
+        self.opciones_render = opciones_render
+        self.firma_render = '\0'.join(
+            f'{nombre}={valor}' for nombre, valor in sorted(opciones_render.items())
+        )
+        self.aciertos_disco = 0
+        self.fallos = 0
+
+    def get(self, codigo):
+        ruta = self._ruta(codigo) if self.directorio else None
+        if ruta:
+            blob = self._leer_disco(ruta)
+            if blob is not None:
+                self.aciertos_disco += 1
+                return blob
+
+        self.fallos += 1
+        blob = render_qr(codigo, **self.opciones_render)
+        if ruta:
+            self._escribir_disco(ruta, blob)
+        return blob
+
+    def estadisticas(self):
+        return {
+            'aciertos_disco': self.aciertos_disco,
+            'fallos': self.fallos,
+        }
+
+    def _ruta(self, codigo):
+        clave = hashlib.sha256(
+            f'{VERSION_RENDER_QR}\0{self.firma_render}\0{codigo}'.encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.directorio, clave[:2], f'{clave}.png')
+
+    def _leer_disco(self, ruta):
+        try:
+            with open(ruta, 'rb') as archivo:
+                blob = archivo.read()
+            # Marcar el archivo como usado recientemente para la expulsión LRU
+            os.utime(ruta)
+            return blob
+        except OSError:
+            return None
+
+    def _escribir_disco(self, ruta, blob):
+        # Escritura atómica: otro trabajo concurrente nunca lee un PNG a medias
+        try:
+            write_atomic(ruta, blob)
+        except OSError:
+            # La caché en disco es opcional; un fallo de escritura no detiene el trabajo
+            return
+        if not self.max_bytes:
+            return
+        total = _tamano_disco.get(self.directorio)
+        if total is None:
+            # La primera medida ya incluye el PNG recién escrito
+            total = sum(tamano for mtime, tamano, ruta in self._archivos())
+        else:
+            total += len(blob)
+        _tamano_disco[self.directorio] = total
+        if total > self.max_bytes:
+            self.evict()
+
+    def _archivos(self):
+        archivos = []
+        for root, dirs, files in os.walk(self.directorio):
+            for file_name in files:
+                ruta = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(ruta)
+                except OSError:
+                    continue
+                archivos.append((stat.st_mtime, stat.st_size, ruta))
+        return archivos
+
+    def evict(self):
+        """Si el disco supera el tamaño máximo, elimina los PNG usados hace más
+        tiempo hasta dejarlo en FRACCION_TRAS_EXPULSION del máximo. Devuelve
+        los archivos eliminados."""
+        if not self.directorio or not self.max_bytes or not os.path.isdir(self.directorio):
+            return 0
+        archivos = self._archivos()
+        total = sum(tamano for mtime, tamano, ruta in archivos)
+        eliminados = 0
+        if total > self.max_bytes:
+            for mtime, tamano, ruta in sorted(archivos):
+                if total <= self.max_bytes * FRACCION_TRAS_EXPULSION:
+                    break
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    continue
+                total -= tamano
+                eliminados += 1
+        _tamano_disco[self.directorio] = total
+        return eliminados
@@ -0,0 +1,73 @@
+"""Caché de documentos generados por contenido.
+
+Dos subidas con el mismo Excel, el mismo ZIP, la misma versión de la
+plantilla, las mismas opciones de salida y la misma fecha de recepción
+producen el mismo documento, así que la segunda reutiliza el trabajo de la
+primera: el que sigue en cola o generándose, o el documento ya terminado
+mientras no haya caducado. La caché no borra documentos; de eso se encarga
+limpiar_media (ver limpieza.py), que también los saca de la caché.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from django.db.models import Q
+from django.utils import timezone
+from .admision import live_jobs
+from .conf import OPCIONES_SALIDA, VERSION_PLANTILLA
+from .models import ArchivoGenerado
+
+
+def content_key(hash_excel, hash_zip, fecha_recepcion, opciones):
+    datos = {
+        'excel': hash_excel,
+        'zip': hash_zip,
+        'plantilla': VERSION_PLANTILLA,
+        'fecha': fecha_recepcion.isoformat(),
+        'opciones': {nombre: opciones[nombre] for nombre in OPCIONES_SALIDA},
+    }
+    return hashlib.sha256(json.dumps(datos, sort_keys=True).encode()).hexdigest()
+
+
+def find_cached_job(clave, opciones):
+    """Trabajo que ya genera o generó el documento de la clave, o None."""
+    if opciones['CACHE_RESULTADOS_HORAS'] is None:
+        return None
+    limite = timezone.now() - timedelta(hours=opciones['CACHE_RESULTADOS_HORAS'])
+    # Los trabajos en curso también caducan: uno en cola desde antes del
+    # límite o uno cuyo trabajador murió no van a terminar pronto, o nunca
+    candidatos = (
+        ArchivoGenerado.objects.filter(clave_contenido=clave)
+        .filter(
+            Q(estado=ArchivoGenerado.EN_COLA, fecha_creacion__gte=limite)
+            | Q(pk__in=live_jobs(opciones).values('pk'))
+            | Q(estado=ArchivoGenerado.COMPLETADO, fecha_fin__gte=limite)
+        )
+        .order_by('-fecha_creacion')
+    )
+    for trabajo in candidatos:
+        documento = trabajo.documento_generado
+        if trabajo.estado != ArchivoGenerado.COMPLETADO or documento.storage.exists(documento.name):
+            return trabajo
+        # El documento se borró por fuera de la caché; deja de ser reutilizable
+        _forget(trabajo)
+    return None
+
+
+def evict_results(opciones):
+    """Saca de la caché los documentos caducados y devuelve cuántos.
+
+    Solo se olvida su clave: el documento sigue disponible para su trabajo
+    hasta que limpiar_media lo borre según las opciones RETENCION_DOCUMENTOS_*.
+    """
+    if opciones['CACHE_RESULTADOS_HORAS'] is None:
+        return 0
+    limite = timezone.now() - timedelta(hours=opciones['CACHE_RESULTADOS_HORAS'])
+    return (
+        ArchivoGenerado.objects.filter(estado=ArchivoGenerado.COMPLETADO, fecha_fin__lt=limite)
+        .exclude(clave_contenido='')
+        .update(clave_contenido='')
+    )
+
+
+def _forget(trabajo):
+    ArchivoGenerado.objects.filter(pk=trabajo.pk).update(clave_contenido='')
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import time
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+
+# Directorio, relativo a MEDIA_ROOT, de cada campo de archivo del formulario
+DESTINOS = {
+    'excel_file': os.path.join('uploads', 'excel'),
+    'images_zip': os.path.join('uploads', 'zip'),
+}
+
+
+class ArchivoGuardado(UploadedFile):
+    """Archivo subido que ya está en su ruta definitiva, con su SHA-256."""
+
+    def __init__(self, ruta, relativa, huella, name, content_type, size, charset):
+        super().__init__(None, name, content_type, size, charset)
+        self.ruta = ruta
+        self.relativa = relativa
+        self.huella = huella
+
+    def temporary_file_path(self):
+        return self.ruta
+
+    def open(self, mode='rb'):
+        self.file = open(self.ruta, mode)
+        return self
+
+    def close(self):
+        # Solo hay un archivo abierto si alguien lo ha leído con open()
+        if self.file is not None:
+            self.file.close()
+
+
+class JobUploadHandler(FileUploadHandler):
+    """Escribe cada archivo del formulario directamente en la ruta del trabajo.
+
+    Sustituye a los manejadores de Django, que guardan la subida en memoria o
+    en un temporal para que luego la vista la copie: aquí cada bloque del
+    cuerpo de la petición se escribe una sola vez en media/uploads, se añade
+    a la huella SHA-256 del archivo y se comprueba contra el tamaño máximo
+    del campo. Si un archivo lo supera se borra y se deja de guardar la
+    subida; el motivo queda en error.
+    """
+
+    def __init__(self, request, unique_id, limites):
+        super().__init__(request)
+        self.unique_id = unique_id
+        # Tamaño máximo en bytes de cada campo; None sin límite
+        self.limites = limites
+        self.error = None
+        self.segundos = 0.0
+        self.rutas = []
+        self._destino = None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self._destino = None
+        if field_name not in DESTINOS:
+            # Campo desconocido: se descarta sin escribirlo
+            raise StopFutureHandlers()
+        inicio = time.perf_counter()
+        self.relativa = os.path.join(DESTINOS[field_name], f'{self.unique_id}_{file_name}')
+        ruta = os.path.join(settings.MEDIA_ROOT, self.relativa)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        self._destino = open(ruta, 'wb')
+        self.rutas.append(ruta)
+        self._huella = hashlib.sha256()
+        self._tamano = 0
+        self.segundos += time.perf_counter() - inicio
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self._destino is None:
+            return None
+        inicio = time.perf_counter()
+        self._tamano += len(raw_data)
+        limite = self.limites.get(self.field_name)
+        if limite is not None and self._tamano > limite:
+            self.error = (
+                f"El archivo '{self.file_name}' supera el tamaño máximo permitido "
+                f"({limite // (1024 * 1024)} MB)."
+            )
+            self.discard()
+            # Se lee el resto de la petición sin guardarlo para poder responder
+            raise StopUpload(connection_reset=False)
+        self._destino.write(raw_data)
+        self._huella.update(raw_data)
+        self.segundos += time.perf_counter() - inicio
+        return None
+
+    def file_complete(self, file_size):
+        if self._destino is None:
+            return None
+        self._destino.close()
+        self._destino = None
+        return ArchivoGuardado(
+            self.rutas[-1], self.relativa, self._huella.hexdigest(),
+            self.file_name, self.content_type, file_size, self.charset,
+        )
+
+    def upload_interrupted(self):
+        # El cliente cortó la conexión a mitad de la subida
+        self.discard()
+
+    def discard(self):
+        """Borra todo lo escrito por esta subida."""
+        if self._destino is not None:
+            self._destino.close()
+            self._destino = None
+        for ruta in self.rutas:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+        self.rutas = []
@@ -1,3 +1,1047 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock
+import pandas as pd
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadhandler import StopFutureHandlers, StopUpload
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from docx import Document
+from docx.oxml.ns import qn
+from docx.shared import Inches
+from lxml import etree
+from openpyxl import Workbook
+from openpyxl.utils.datetime import MAC_EPOCH
+from PIL import Image
+from .admision import live_jobs, lock_queue, memory_error, next_admissible, queue_error, stale_jobs
+from .almacenamiento import result_storage
+from .archivos import write_atomic
+from .conf import get_opciones
+from .descargas import document_response
+from .escritura import ImagenRegistrada, InMemoryDocxWriter, StreamingDocxWriter, append_shard
+from .estimacion import (
+    BYTES_BASE_DOCX,
+    MEMORIA_BASE_PROCESO,
+    RENDIMIENTO_INICIAL,
+    estimate_document,
+    record_throughput,
+)
+from .imagenes import DirectoryImageSource, ImageIndex, ZipImageSource, prepare_image
+from .lectura import read_label_sheet
+from .limpieza import sweep_media
+from .models import ArchivoGenerado, ColaGeneracion
+from .plantilla import LabelTemplate
+from .qr import ANCHO_QR_PULGADAS, FRACCION_TRAS_EXPULSION, QRCache, render_qr
+from .resultados import content_key, evict_results, find_cached_job
+from .subidas import JobUploadHandler
+from .trabajos import MENSAJE_INTERRUMPIDO, claim_next_job
+from .utils import _split_volumes, generate_word_document
+from .validacion import ValidacionError, validate_label_sheet
 
-# Create your tests here.
+CONTENIDO = bytes(range(256)) * 4
+
+
+def _excel(directorio, filas, formatos=None, epoca=None):
+    libro = Workbook()
+    if epoca is not None:
+        libro.epoch = epoca
+    hoja = libro.active
+    for fila in filas:
+        hoja.append(fila)
+    for (fila, columna), formato in (formatos or {}).items():
+        hoja.cell(row=fila, column=columna).number_format = formato
+    ruta = os.path.join(directorio, 'datos.xlsx')
+    libro.save(ruta)
+    return ruta
+
+
+def _trabajo(**campos):
+    campos.setdefault('documento_generado', 'output/prueba_documento.docx')
+    return ArchivoGenerado.objects.create(**campos)
+
+
+def _firma(ruta):
+    # Texto, imágenes y tamaños de las etiquetas en el orden del documento
+    documento = Document(ruta)
+    firma = []
+    for elemento in documento.element.body.iter(qn('w:t'), qn('a:blip'), qn('wp:extent'), qn('w:br')):
+        if elemento.tag == qn('a:blip'):
+            blob = documento.part.related_parts[elemento.get(qn('r:embed'))].blob
+            firma.append(hashlib.sha1(blob).hexdigest())
+        elif elemento.tag == qn('wp:extent'):
+            firma.append((elemento.get('cx'), elemento.get('cy')))
+        else:
+            firma.append(elemento.text or elemento.get(qn('w:type')))
+    return firma
+
+
+def _imagen(ruta, tamano=(40, 30), formato='PNG', modo='RGB'):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    Image.new(modo, tamano, 'red').save(ruta, formato)
+    return ruta
+
+
+class ImagenesTests(SimpleTestCase):
+    """Índice de imágenes del trabajo y fuentes de las que se leen."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+
+    def test_desempate_por_profundidad_y_nombre(self):
+        indice = ImageIndex([
+            'c/foto.png', 'a/x/foto.png', 'b/foto.png', 'B/Otra.JPG', 'a/otra.jpg', 'notas.txt',
+        ])
+        # Gana el menos anidado y, a igual profundidad, el primero en orden alfabético
+        self.assertEqual(indice.resolve('foto.png'), 'b/foto.png')
+        self.assertEqual(indice.resolve('FOTO'), 'b/foto.png')
+        self.assertEqual(indice.resolve(' otra '), 'a/otra.jpg')
+        # Con extensión solo vale el archivo exacto; sin ella, solo las extensiones de imagen
+        self.assertIsNone(indice.resolve('foto.jpg'))
+        self.assertEqual(indice.resolve('notas.txt'), 'notas.txt')
+        self.assertIsNone(indice.resolve('notas'))
+        self.assertIsNone(indice.resolve(''))
+
+    def test_fuente_zip(self):
+        foto = _imagen(os.path.join(self.directorio, 'foto.png'))
+        ruta_zip = os.path.join(self.directorio, 'imagenes.zip')
+        with zipfile.ZipFile(ruta_zip, 'w') as zip_ref:
+            zip_ref.write(foto, 'productos/foto.png')
+            zip_ref.writestr('productos/vacia/', '')
+        with ZipImageSource(ruta_zip) as fuente:
+            self.assertEqual(len(fuente.indice), 1)
+            clave = fuente.resolve('FOTO')
+            self.assertEqual(clave, 'productos/foto.png')
+            with open(foto, 'rb') as archivo:
+                self.assertEqual(fuente.open(clave).read(), archivo.read())
+        # Al salir del bloque se cierra el ZIP
+        self.assertIsNone(fuente.zip_ref.fp)
+
+    def _preparar(self, tamano, formato, modo='RGB'):
+        ruta = _imagen(os.path.join(self.directorio, f'imagen.{formato.lower()}'), tamano, formato, modo)
+        with open(ruta, 'rb') as archivo:
+            original = archivo.read()
+        preparada = prepare_image(io.BytesIO(original), dpi=100, calidad_jpeg=80, png_optimizar=True)
+        return original, preparada, Image.open(io.BytesIO(preparada.blob))
+
+    def test_reescalado_al_recuadro(self):
+        # 2,5 pulgadas de ancho a 100 ppp
+        _, preparada, imagen = self._preparar((1000, 600), 'JPEG')
+        self.assertEqual(imagen.size, (250, 150))
+        self.assertEqual(imagen.format, 'JPEG')
+        self.assertEqual((preparada.width_inches, preparada.height_inches), (2.5, 1.5))
+        # Las imágenes altas se limitan a 3 pulgadas de alto
+        _, preparada, imagen = self._preparar((100, 1000), 'JPEG')
+        self.assertEqual(imagen.size, (30, 300))
+        self.assertAlmostEqual(preparada.height_inches, 3.0)
+
+    def test_transparencia_se_conserva_en_png(self):
+        _, _, imagen = self._preparar((1000, 600), 'PNG', 'RGBA')
+        self.assertEqual(imagen.format, 'PNG')
+        self.assertEqual(imagen.mode, 'RGBA')
+        self.assertEqual(imagen.size, (250, 150))
+
+    def test_imagen_que_cabe(self):
+        # Un JPEG o PNG que ya cabe se incrusta tal cual; otro formato se recodifica
+        original, preparada, _ = self._preparar((40, 30), 'PNG')
+        self.assertEqual(preparada.blob, original)
+        _, _, imagen = self._preparar((40, 30), 'BMP')
+        self.assertEqual((imagen.format, imagen.size), ('JPEG', (40, 30)))
+
+
+class QRTests(SimpleTestCase):
+    """Códigos QR y su caché en disco."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+
+    def _archivos(self):
+        return sorted(
+            os.path.join(root, nombre) for root, dirs, nombres in os.walk(self.directorio) for nombre in nombres
+        )
+
+    def test_qr_de_un_bit_al_ancho_impreso(self):
+        imagen = Image.open(io.BytesIO(render_qr('A1', dpi=150, borde=4)))
+        self.assertEqual(imagen.mode, '1')
+        # 21 módulos más 4 de borde a cada lado, a un número entero de píxeles por módulo
+        self.assertEqual(imagen.size, (290, 290))
+        self.assertAlmostEqual(imagen.info['dpi'][0], 290 / ANCHO_QR_PULGADAS, places=1)
+        self.assertEqual(imagen.getpixel((39, 39)), 255)
+        self.assertEqual(imagen.getpixel((40, 40)), 0)
+
+    def test_opciones_de_render_en_la_clave(self):
+        QRCache(self.directorio, dpi=100).get('A1')
+        blob = QRCache(self.directorio, dpi=300).get('A1')
+        self.assertEqual(len(self._archivos()), 2)
+        self.assertEqual(blob, render_qr('A1', dpi=300))
+
+    def test_aciertos_en_disco(self):
+        cache = QRCache(self.directorio)
+        blob = cache.get('A1')
+        self.assertEqual(blob, render_qr('A1'))
+        self.assertEqual(cache.estadisticas(), {'aciertos_disco': 0, 'fallos': 1})
+        self.assertEqual(len(self._archivos()), 1)
+        # Otro trabajo lee el PNG del disco en lugar de volver a generarlo
+        otra = QRCache(self.directorio)
+        self.assertEqual(otra.get('A1'), blob)
+        self.assertEqual(otra.estadisticas(), {'aciertos_disco': 1, 'fallos': 0})
+
+    def test_expulsa_los_usados_hace_mas_tiempo(self):
+        cache = QRCache(self.directorio)
+        rutas = {}
+        for antiguedad, codigo in enumerate(['C', 'B', 'A']):
+            cache.get(codigo)
+            rutas[codigo] = cache._ruta(codigo)
+            instante = 1_000_000 - antiguedad * 100
+            os.utime(rutas[codigo], (instante, instante))
+        # Leer A de disco lo marca como usado: el menos usado pasa a ser B
+        QRCache(self.directorio).get('A')
+        total = sum(os.path.getsize(ruta) for ruta in rutas.values())
+        self.assertEqual(QRCache(self.directorio, max_bytes=total - 1).evict(), 1)
+        self.assertEqual(self._archivos(), sorted([rutas['A'], rutas['C']]))
+        self.assertEqual(QRCache(self.directorio, max_bytes=total).evict(), 0)
+
+    def test_expulsa_al_superar_el_maximo_al_escribir(self):
+        tamanos = {codigo: len(render_qr(codigo)) for codigo in 'CBA'}
+        # Al escribir A se supera el máximo, y quitar C basta para bajar de la fracción
+        maximo = math.ceil((tamanos['B'] + tamanos['A']) / FRACCION_TRAS_EXPULSION)
+        cache = QRCache(self.directorio, max_bytes=maximo)
+        with mock.patch('etiquetas_app.qr.os.walk', wraps=os.walk) as recorrido:
+            for antiguedad, codigo in enumerate('CB'):
+                cache.get(codigo)
+                instante = 1_000_000 + antiguedad * 100
+                os.utime(cache._ruta(codigo), (instante, instante))
+            # Solo se mide el directorio con la primera escritura
+            self.assertEqual(recorrido.call_count, 1)
+            cache.get('A')
+        self.assertEqual(self._archivos(), sorted([cache._ruta('A'), cache._ruta('B')]))
+
+
+class PlantillaTests(SimpleTestCase):
+    """Etiquetas clonadas del esqueleto de la plantilla."""
+
+    def setUp(self):
+        self.plantilla = LabelTemplate('05/01/2024')
+        self.qr = ImagenRegistrada('rId7', 'qr.png', 100, 100)
+        self.ids_formas = itertools.count(1)
+
+    def _render(self, **campos):
+        campos = {
+            'codigo': 'A1', 'descripcion': 'Tornillo', 'num_caja': 2, 'num_cajas': 3, 'cantidad': '10',
+            'qr': self.qr, **campos,
+        }
+        return self.plantilla.render(self.ids_formas, **campos)
+
+    def _textos(self, tabla):
+        return [texto.text for texto in tabla.iter(qn('w:t')) if texto.text]
+
+    def test_rellena_solo_los_huecos(self):
+        esqueleto = etree.tostring(self.plantilla.tabla)
+        tabla = self._render(imagen=ImagenRegistrada('rId8', 'foto.png', 200, 150))
+        textos = self._textos(tabla)
+        for texto in ('A1', 'DESCRIPCIÓN: Tornillo', 'CAJA 2 DE 3', 'CANTIDAD: 10', 'RECEPCIONADO: 05/01/2024'):
+            self.assertIn(texto, textos)
+        self.assertNotIn('CODIGO', textos)
+        # La imagen va encima de la tabla de datos y el QR dentro de ella
+        self.assertEqual([blip.get(qn('r:embed')) for blip in tabla.iter(qn('a:blip'))], ['rId8', 'rId7'])
+        self.assertEqual(sorted(doc_pr.get('id') for doc_pr in tabla.iter(qn('wp:docPr'))), ['1', '2'])
+        # El esqueleto no cambia al rellenar una etiqueta
+        self.assertEqual(etree.tostring(self.plantilla.tabla), esqueleto)
+        otra = self._render(codigo='B2', num_caja=3)
+        self.assertIn('CAJA 3 DE 3', self._textos(otra))
+        self.assertEqual([doc_pr.get('id') for doc_pr in otra.iter(qn('wp:docPr'))], ['3'])
+
+    def test_sin_imagen_y_con_error(self):
+        sin_imagen = self._render()
+        self.assertEqual(len(list(sin_imagen.iter(qn('a:blip')))), 1)
+        con_error = self._render(error_imagen=ValueError('imagen dañada'))
+        self.assertIn('Error al procesar imagen: imagen dañada', self._textos(con_error))
+
+
+class EscrituraTests(SimpleTestCase):
+    """Escritores del .docx en memoria y en streaming."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        self.plantilla = LabelTemplate('05/01/2024')
+        with open(_imagen(os.path.join(self.directorio, 'foto.png'), (300, 200)), 'rb') as archivo:
+            self.foto = archivo.read()
+
+    def _escribir(self, documento, numeros=range(1, 4), total=3, salto_final=False):
+        with documento:
+            foto = documento.register_picture(self.foto, width=Inches(2.5))
+            for numero in numeros:
+                # Registrar de nuevo una imagen idéntica reutiliza su parte
+                qr = documento.register_picture(render_qr(f'A{numero % 2}'), width=Inches(ANCHO_QR_PULGADAS))
+                documento.append(self.plantilla.render(
+                    documento.ids_formas, codigo=f'A{numero % 2}', descripcion='Tornillo', num_caja=numero,
+                    num_cajas=total, cantidad='10', qr=qr, imagen=foto if numero % 2 else None,
+                ))
+                if salto_final or numero < numeros[-1]:
+                    documento.append(self.plantilla.page_break())
+            documento.save()
+        return documento.output_path
+
+    def _medios(self, ruta):
+        with zipfile.ZipFile(ruta) as paquete:
+            return [nombre for nombre in paquete.namelist() if nombre.startswith('word/media/')]
+
+    def test_streaming_igual_que_en_memoria(self):
+        en_memoria = self._escribir(InMemoryDocxWriter(os.path.join(self.directorio, 'memoria.docx')))
+        streaming = self._escribir(
+            StreamingDocxWriter(os.path.join(self.directorio, 'streaming.docx'), self.directorio),
+        )
+        self.assertEqual(_firma(streaming), _firma(en_memoria))
+        # Una parte por imagen distinta: la foto y los dos QR
+        self.assertEqual(len(self._medios(streaming)), 3)
+        # El temporal de word/document.xml se borra al guardar
+        self.assertEqual(sorted(os.listdir(self.directorio)), ['foto.png', 'memoria.docx', 'streaming.docx'])
+
+    def test_union_de_parciales(self):
+        completo = self._escribir(
+            InMemoryDocxWriter(os.path.join(self.directorio, 'completo.docx')), range(1, 6), 5,
+        )
+        # El primer parcial termina con salto de página porque el documento sigue en el segundo
+        parciales = [
+            self._escribir(
+                StreamingDocxWriter(os.path.join(self.directorio, f'parcial_{numero}.docx'), self.directorio),
+                numeros, 5, salto_final=numero == 0,
+            )
+            for numero, numeros in enumerate([range(1, 3), range(3, 6)])
+        ]
+        unido = os.path.join(self.directorio, 'unido.docx')
+        with StreamingDocxWriter(unido, self.directorio) as documento:
+            for parcial in parciales:
+                append_shard(documento, parcial)
+            documento.save()
+        self.assertEqual(_firma(unido), _firma(completo))
+        self.assertEqual(len(self._medios(unido)), 3)
+        cuerpo = Document(unido).element.body
+        ids = [doc_pr.get('id') for doc_pr in cuerpo.iter(qn('wp:docPr'))]
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(len(set(ids)), 8)
+
+
+class GeneracionTests(SimpleTestCase):
+    """Generación completa de documentos pequeños."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        self.imagenes = os.path.join(self.directorio, 'imagenes')
+        self.tornillo = _imagen(os.path.join(self.imagenes, 'fotos', 'tornillo.png'))
+        # Nada de lo que genera la prueba se escribe en MEDIA_ROOT
+        self.opciones = {
+            'QR_CACHE_DIR': os.path.join(self.directorio, 'qr'),
+            'DIRECTORIO_TEMPORAL': self.directorio,
+            'RENDIMIENTO_ARCHIVO': os.path.join(self.directorio, 'rendimiento.json'),
+        }
+
+    def _generar(self, filas, nombre='documento.docx', opciones=None, **argumentos):
+        excel = _excel(self.directorio, [['CODIGO', 'DESCRIPCION', 'CANTIDAD', 'CONTEO_CAJAS', 'IMAGEN'], *filas])
+        salida = os.path.join(self.directorio, nombre)
+        return generate_word_document(excel, self.imagenes, salida, opciones={**self.opciones, **(opciones or {})},
+                                      **argumentos)
+
+    def test_informe_de_imagenes_no_encontradas(self):
+        resumen = self._generar([
+            ['A1', 'Tornillo', 10, 1, 'tornillo'],
+            ['A2', 'Tuerca', 5, 1, 'tuerca.png'],
+            ['A3', 'Tuerca', 5, 1, 'tuerca.png'],
+            ['A4', 'Arandela', 5, 1, None],
+        ])
+        # Cada nombre sin resolver se informa una sola vez
+        self.assertEqual(resumen['imagenes_no_encontradas'], ['tuerca.png'])
+
+    def test_imagen_registrada_una_vez(self):
+        self._generar([
+            ['A1', 'Tornillo', 10, 3, 'tornillo'],
+            ['A2', 'Tornillo largo', 10, 1, 'tornillo.png'],
+        ])
+        documento = Document(os.path.join(self.directorio, 'documento.docx'))
+        with open(self.tornillo, 'rb') as archivo:
+            blob = archivo.read()
+        cuerpo = documento.element.body
+        rids = [blip.get(qn('r:embed')) for blip in cuerpo.iter(qn('a:blip'))]
+        # Las cuatro cajas apuntan a la misma relación de la imagen del producto
+        del_producto = [rid for rid in rids if documento.part.related_parts[rid].blob == blob]
+        self.assertEqual(len(del_producto), 4)
+        self.assertEqual(len(set(del_producto)), 1)
+        # Cada dibujo conserva su propio identificador
+        ids = [doc_pr.get('id') for doc_pr in cuerpo.iter(qn('wp:docPr'))]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_filas_sin_cajas(self):
+        tuerca = _imagen(os.path.join(self.imagenes, 'fotos', 'tuerca.png'), (60, 20))
+        resumen = self._generar([['A1', 'Tornillo', 10, 0, 'tornillo'], ['A2', 'Tuerca', 5, 2, 'tuerca']])
+        self.assertEqual(resumen['etiquetas'], 2)
+        documento = Document(os.path.join(self.directorio, 'documento.docx'))
+        self.assertEqual(len(documento.tables), 2)
+        # La imagen de la fila sin cajas no se prepara ni ocupa el lugar de la siguiente
+        with open(tuerca, 'rb') as archivo:
+            blob = archivo.read()
+        blobs = {documento.part.related_parts[blip.get(qn('r:embed'))].blob
+                 for blip in documento.element.body.iter(qn('a:blip'))}
+        self.assertEqual(len(blobs), 2)
+        self.assertIn(blob, blobs)
+
+    def test_regeneracion_incremental(self):
+        filas = [['A1', 'Tornillo', 10, 2, 'tornillo'], ['A2', 'Tuerca', 5, 1, None]]
+        fecha = datetime.date(2024, 1, 5)
+        resumen = self._generar(filas, 'anterior.docx', fecha_recepcion=fecha)
+        self.assertEqual(resumen['etiquetas_copiadas'], 0)
+        anterior = os.path.join(self.directorio, 'anterior.docx')
+        self.assertTrue(os.path.exists(os.path.join(self.directorio, 'anterior.manifiesto.json')))
+
+        filas[1][1] = 'Tuerca M8'
+        resumen = self._generar(filas, 'nuevo.docx', fecha_recepcion=fecha, documento_base=anterior)
+        # Solo se vuelve a generar la fila que cambió
+        self.assertEqual(resumen['etiquetas_copiadas'], 2)
+        self._generar(filas, 'completo.docx', fecha_recepcion=fecha)
+        self.assertEqual(
+            _firma(os.path.join(self.directorio, 'nuevo.docx')),
+            _firma(os.path.join(self.directorio, 'completo.docx')),
+        )
+        # Con otra fecha de recepción no se reutiliza ninguna etiqueta
+        resumen = self._generar(filas, 'otra_fecha.docx', fecha_recepcion=fecha + timedelta(days=1),
+                                documento_base=anterior)
+        self.assertEqual(resumen['etiquetas_copiadas'], 0)
+
+    def test_reparto_en_volumenes(self):
+        df = pd.DataFrame({'CODIGO': 'A', 'CONTEO_CAJAS': [3, 2, 4, 1, 6]})
+        sin_imagenes = dict.fromkeys(df.index)
+        opciones = get_opciones(**self.opciones, VOLUMEN_ETIQUETAS=5, VOLUMEN_MAX_BYTES=None)
+        # Los cortes van entre filas; una fila que supera el límite ocupa un volumen entero
+        self.assertEqual(_split_volumes(df, sin_imagenes, None, opciones), [(0, 2), (2, 4), (4, 5)])
+        df = pd.DataFrame({'CODIGO': 'A', 'CONTEO_CAJAS': [4, 6, 1]})
+        maximo = (
+            BYTES_BASE_DOCX + RENDIMIENTO_INICIAL['bytes_por_qr'] + 10 * RENDIMIENTO_INICIAL['bytes_por_etiqueta']
+        )
+        opciones = get_opciones(**self.opciones, VOLUMEN_ETIQUETAS=None, VOLUMEN_MAX_BYTES=maximo)
+        self.assertEqual(_split_volumes(df, dict.fromkeys(df.index), None, opciones), [(0, 2), (2, 3)])
+
+    def test_volumenes_en_un_zip(self):
+        resumen = self._generar(
+            [['A1', 'Tornillo', 10, 2, 'tornillo'], ['A2', 'Tuerca', 5, 2, None], ['A3', 'Arandela', 5, 1, None]],
+            'volumenes.zip', opciones={'VOLUMEN_ETIQUETAS': 2, 'GENERACION_PROCESOS': 1},
+        )
+        self.assertEqual(resumen['volumenes'], 3)
+        with zipfile.ZipFile(os.path.join(self.directorio, 'volumenes.zip')) as paquete:
+            self.assertEqual(
+                paquete.namelist(), ['etiquetas_001.docx', 'etiquetas_002.docx', 'etiquetas_003.docx'],
+            )
+
+    def test_streaming_si_no_cabe_en_memoria(self):
+        filas = [['A1', 'Tornillo', 10, 2, 'tornillo']]
+        with mock.patch('etiquetas_app.escritura.StreamingDocxWriter', wraps=StreamingDocxWriter) as streaming:
+            self._generar(filas, opciones={'ESCRITURA_STREAMING': False, 'GENERACION_MEMORIA_MAX_BYTES': None})
+            self.assertFalse(streaming.called)
+            self._generar(filas, opciones={'ESCRITURA_STREAMING': False, 'GENERACION_MEMORIA_MAX_BYTES': 1})
+            self.assertTrue(streaming.called)
+
+class LecturaTests(SimpleTestCase):
+    """Lectura en streaming de las columnas de la etiqueta."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+
+    def test_columnas_de_la_etiqueta(self):
+        ruta = _excel(self.directorio, [
+            ['EXTRA', 'CODIGO', 'DESCRIPCION', 'CANTIDAD', 'IMAGEN', 'OTRA'],
+            ['x', 'A1', 'Tornillo', 12, ' foto.jpg ', 'y'],
+            [None, None, None, None, None, 'solo extra'],
+            ['x', 1001, 'Tuerca', 2.0, None, 'y'],
+        ])
+        df = read_label_sheet(ruta)
+        self.assertEqual(list(df.columns), ['CODIGO', 'DESCRIPCION', 'CANTIDAD', 'CONTEO_CAJAS', 'IMAGEN'])
+        # Índice con el número de fila en el Excel; la fila sin datos de la etiqueta se ignora
+        self.assertEqual(list(df.index), [2, 4])
+        self.assertEqual(list(df['CODIGO']), ['A1', '1001'])
+        self.assertEqual(list(df['CANTIDAD']), ['12', '2'])
+        self.assertEqual(list(df['IMAGEN']), ['foto.jpg', ''])
+        self.assertEqual(list(df['CONTEO_CAJAS']), [1, 1])
+
+    def test_falta_columna_obligatoria(self):
+        ruta = _excel(self.directorio, [['CODIGO', 'DESCRIPCION'], ['A1', 'Tornillo']])
+        with self.assertRaises(ValidacionError) as contexto:
+            read_label_sheet(ruta)
+        self.assertEqual([error.columna for error in contexto.exception.errores], ['CANTIDAD'])
+
+    def test_fechas_como_pandas(self):
+        filas = [
+            ['CODIGO', 'DESCRIPCION', 'CANTIDAD'],
+            ['A', datetime.datetime(2024, 1, 5), 1],
+            ['B', datetime.datetime(2024, 1, 5, 10, 30), 1],
+            ['C', datetime.time(10, 30), 1],
+            ['D', datetime.timedelta(hours=30), 1],
+            ['E', 45296, 1],
+        ]
+        formatos = {(2, 2): 'yyyy-mm-dd', (3, 2): 'dd/mm/yyyy hh:mm', (4, 2): 'h:mm', (5, 2): '[h]:mm:ss'}
+        esperado = ['2024-01-05 00:00:00', '2024-01-05 10:30:00', '10:30:00', '1 day, 6:00:00', '45296']
+        for epoca in (None, MAC_EPOCH):
+            with self.subTest(epoca=epoca):
+                df = read_label_sheet(_excel(self.directorio, filas, formatos, epoca))
+                self.assertEqual(list(df['DESCRIPCION']), esperado)
+
+
+class ValidacionTests(SimpleTestCase):
+    """Validación de toda la hoja antes de generar."""
+
+    def setUp(self):
+        self.opciones = get_opciones(MAX_CAJAS_POR_FILA=10, IMAGENES_FALTANTES_ERROR=False)
+
+    def _hoja(self, filas):
+        # filas: (CODIGO, CONTEO_CAJAS, IMAGEN); el índice es la fila del Excel
+        codigos, conteos, imagenes = zip(*filas)
+        return pd.DataFrame({
+            'CODIGO': codigos, 'DESCRIPCION': 'Tornillo', 'CANTIDAD': '1', 'CONTEO_CAJAS': conteos,
+            'IMAGEN': imagenes,
+        }, index=pd.Index(range(2, len(filas) + 2), name='FILA'))
+
+    def test_informe_por_fila(self):
+        df = self._hoja([
+            ('A1', 2, ''), ('', 1, ''), ('A3', 'dos', ''), ('A4', 1.5, ''), ('A5', -1, ''), ('A6', 11, ''),
+        ])
+        with self.assertRaises(ValidacionError) as contexto:
+            validate_label_sheet(df, dict.fromkeys(df.index), self.opciones)
+        errores = contexto.exception.errores
+        self.assertEqual([(error.fila, error.columna) for error in errores], [
+            (3, 'CODIGO'), (4, 'CONTEO_CAJAS'), (5, 'CONTEO_CAJAS'), (6, 'CONTEO_CAJAS'), (7, 'CONTEO_CAJAS'),
+        ])
+        self.assertEqual(errores[1].valor, 'dos')
+        self.assertIn('5 errores', str(contexto.exception))
+        with self.assertRaisesMessage(ValidacionError, 'El Excel tiene 1 error: fila 2'):
+            validate_label_sheet(self._hoja([('', 1, '')]), {2: None}, self.opciones)
+
+    def test_filas_sin_cajas(self):
+        df = self._hoja([('A1', 0, 'foto.png'), ('A2', 2, ''), ('A3', '0', '')])
+        df, advertencias = validate_label_sheet(df, {2: 'foto.png', 3: None, 4: None}, self.opciones)
+        # Como antes de validar, una fila de 0 cajas no genera etiquetas ni error
+        self.assertEqual(list(df.index), [3])
+        self.assertEqual(list(df['CONTEO_CAJAS']), [2])
+
+    def test_imagenes_faltantes(self):
+        df = self._hoja([('A1', None, 'foto.png'), ('A2', '', 'falta.png'), ('A3', '3', '')])
+        imagen_por_fila = {2: 'foto.png', 3: None, 4: None}
+        df, advertencias = validate_label_sheet(df, imagen_por_fila, self.opciones)
+        # Las celdas vacías cuentan como una caja
+        self.assertEqual(list(df['CONTEO_CAJAS']), [1, 1, 3])
+        self.assertEqual([(advertencia.fila, advertencia.valor) for advertencia in advertencias], [(3, 'falta.png')])
+        with self.assertRaises(ValidacionError):
+            validate_label_sheet(df, imagen_por_fila, {**self.opciones, 'IMAGENES_FALTANTES_ERROR': True})
+
+
+class ArchivosTests(SimpleTestCase):
+    """Escritura atómica de los archivos compartidos entre trabajos."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        self.ruta = os.path.join(self.directorio, 'estadisticas', 'rendimiento.json')
+
+    def test_escribe_y_sustituye(self):
+        write_atomic(self.ruta, b'uno')
+        write_atomic(self.ruta, b'dos')
+        with open(self.ruta, 'rb') as archivo:
+            self.assertEqual(archivo.read(), b'dos')
+        self.assertEqual(os.listdir(os.path.dirname(self.ruta)), ['rendimiento.json'])
+
+    def test_fallo_conserva_el_anterior(self):
+        write_atomic(self.ruta, b'uno')
+        with mock.patch('etiquetas_app.archivos.os.replace', side_effect=OSError('disco lleno')):
+            with self.assertRaises(OSError):
+                write_atomic(self.ruta, b'dos')
+        with open(self.ruta, 'rb') as archivo:
+            self.assertEqual(archivo.read(), b'uno')
+        # No queda ningún temporal
+        self.assertEqual(os.listdir(os.path.dirname(self.ruta)), ['rendimiento.json'])
+
+
+class EstimacionTests(SimpleTestCase):
+    """Estimación del documento a partir del rendimiento medido."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        self.foto = _imagen(os.path.join(self.directorio, 'fotos', 'foto.png'))
+        self.rendimiento = os.path.join(self.directorio, 'estadisticas', 'rendimiento.json')
+        self.opciones = get_opciones(RENDIMIENTO_ARCHIVO=self.rendimiento, GENERACION_PROCESOS=1)
+        self.df = pd.DataFrame({'CODIGO': ['A1', 'A2', 'A1'], 'CONTEO_CAJAS': [2, 3, 5]})
+        self.imagen_por_fila = {0: self.foto, 1: None, 2: self.foto}
+
+    def _estimar(self):
+        with DirectoryImageSource(self.directorio) as fuente:
+            return estimate_document(self.df, self.imagen_por_fila, fuente, self.opciones)
+
+    def _medidas(self, **medidas):
+        return {
+            'segundos': 2.0, 'segundos_imagenes': 0.0, 'segundos_qr': 0.0, 'etiquetas': 100,
+            'imagenes': 0, 'qr_generados': 0, 'qr_registrados': 0, 'bytes_qr': 0, 'bytes_imagenes': 0,
+            'bytes_imagenes_origen': 0, 'bytes_documento': 50_000, **medidas,
+        }
+
+    def test_sin_mediciones(self):
+        estimacion = self._estimar()
+        self.assertEqual(
+            (estimacion['etiquetas'], estimacion['paginas'], estimacion['imagenes'], estimacion['codigos_qr']),
+            (10, 10, 1, 2),
+        )
+        tamano = (
+            BYTES_BASE_DOCX + 10 * RENDIMIENTO_INICIAL['bytes_por_etiqueta'] + 2 * RENDIMIENTO_INICIAL['bytes_por_qr']
+            + os.path.getsize(self.foto) * RENDIMIENTO_INICIAL['proporcion_imagenes']
+        )
+        self.assertEqual(estimacion['tamano_bytes'], int(tamano))
+
+    def test_con_mediciones(self):
+        sin_medir = self._estimar()
+        # La primera medida sustituye al valor inicial; las siguientes se promedian
+        record_throughput(self.rendimiento, self._medidas())
+        record_throughput(self.rendimiento, self._medidas(bytes_documento=100_000))
+        estimacion = self._estimar()
+        bytes_por_etiqueta = 0.7 * 500 + 0.3 * 1000
+        self.assertEqual(
+            estimacion['tamano_bytes'] - sin_medir['tamano_bytes'],
+            int(10 * (bytes_por_etiqueta - RENDIMIENTO_INICIAL['bytes_por_etiqueta'])),
+        )
+        # Las etapas sin medir conservan el valor inicial
+        with open(self.rendimiento, encoding='utf-8') as archivo:
+            self.assertEqual(set(json.load(archivo)), {'etiquetas_por_segundo', 'bytes_por_etiqueta'})
+
+
+    def test_escritura_en_streaming_si_no_cabe_en_memoria(self):
+        self.opciones.update(ESCRITURA_STREAMING=False, GENERACION_MEMORIA_MAX_BYTES=None)
+        en_memoria = self._estimar()
+        self.assertFalse(en_memoria['escritura_streaming'])
+        self.assertGreater(en_memoria['memoria_bytes'], MEMORIA_BASE_PROCESO)
+        # Con un límite por debajo de lo que ocupa en memoria, se estima con el escritor en streaming
+        self.opciones['GENERACION_MEMORIA_MAX_BYTES'] = en_memoria['memoria_bytes'] - 1
+        streaming = self._estimar()
+        self.assertTrue(streaming['escritura_streaming'])
+        self.assertEqual(streaming['memoria_bytes'], MEMORIA_BASE_PROCESO)
+        self.opciones['GENERACION_MEMORIA_MAX_BYTES'] = en_memoria['memoria_bytes']
+        self.assertFalse(self._estimar()['escritura_streaming'])
+
+class ResultadosTests(TestCase):
+    """Clave de contenido y reutilización de trabajos idénticos."""
+
+    def setUp(self):
+        self.opciones = get_opciones(CACHE_RESULTADOS_HORAS=24, TRABAJO_LATIDO_MAX_SEGUNDOS=120)
+        self.fecha = datetime.date(2024, 1, 5)
+        self.hace_dos_dias = timezone.now() - timedelta(days=2)
+
+    def test_clave_de_contenido(self):
+        clave = content_key('excel', 'zip', self.fecha, self.opciones)
+        self.assertEqual(clave, content_key('excel', 'zip', self.fecha, dict(self.opciones)))
+        self.assertEqual(len(clave), 64)
+        self.assertNotEqual(clave, content_key('otro', 'zip', self.fecha, self.opciones))
+        self.assertNotEqual(clave, content_key('excel', 'zip', self.fecha + timedelta(days=1), self.opciones))
+        # Solo cuentan las opciones que cambian el documento
+        self.assertNotEqual(clave, content_key('excel', 'zip', self.fecha, {**self.opciones, 'QR_DPI': 300}))
+        self.assertEqual(
+            clave, content_key('excel', 'zip', self.fecha, {**self.opciones, 'ESCRITURA_STREAMING': True}),
+        )
+
+    def test_cache_desactivada(self):
+        _trabajo(clave_contenido='k')
+        self.assertEqual(find_cached_job('k', self.opciones).clave_contenido, 'k')
+        self.assertIsNone(find_cached_job('k', {**self.opciones, 'CACHE_RESULTADOS_HORAS': None}))
+
+    def test_trabajo_en_cola(self):
+        en_cola = _trabajo(clave_contenido='k')
+        self.assertEqual(find_cached_job('k', self.opciones), en_cola)
+        ArchivoGenerado.objects.filter(pk=en_cola.pk).update(fecha_creacion=self.hace_dos_dias)
+        self.assertIsNone(find_cached_job('k', self.opciones))
+
+    def test_trabajo_en_proceso_con_latido(self):
+        trabajo = _trabajo(
+            clave_contenido='k', estado=ArchivoGenerado.PROCESANDO,
+            fecha_inicio=timezone.now(), latido=timezone.now(),
+        )
+        self.assertEqual(find_cached_job('k', self.opciones), trabajo)
+        ArchivoGenerado.objects.filter(pk=trabajo.pk).update(latido=self.hace_dos_dias)
+        self.assertIsNone(find_cached_job('k', self.opciones))
+
+    def test_trabajo_completado(self):
+        trabajo = _trabajo(clave_contenido='k', estado=ArchivoGenerado.COMPLETADO, fecha_fin=timezone.now())
+        almacen = ArchivoGenerado._meta.get_field('documento_generado').storage
+        with mock.patch.object(almacen, 'exists', return_value=True):
+            self.assertEqual(find_cached_job('k', self.opciones), trabajo)
+        # Sin el documento deja de reutilizarse
+        with mock.patch.object(almacen, 'exists', return_value=False):
+            self.assertIsNone(find_cached_job('k', self.opciones))
+        trabajo.refresh_from_db()
+        self.assertEqual(trabajo.clave_contenido, '')
+
+    def test_expulsion_conserva_el_documento(self):
+        caducado = _trabajo(clave_contenido='a', estado=ArchivoGenerado.COMPLETADO, fecha_fin=self.hace_dos_dias)
+        reciente = _trabajo(clave_contenido='b', estado=ArchivoGenerado.COMPLETADO, fecha_fin=timezone.now())
+        self.assertEqual(evict_results(self.opciones), 1)
+        caducado.refresh_from_db()
+        reciente.refresh_from_db()
+        self.assertEqual(caducado.clave_contenido, '')
+        self.assertEqual(caducado.documento_generado.name, 'output/prueba_documento.docx')
+        self.assertEqual(reciente.clave_contenido, 'b')
+
+
+class SubidasTests(SimpleTestCase):
+    """Subidas escritas directamente en la ruta del trabajo."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        ajustes = override_settings(MEDIA_ROOT=self.directorio)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        self.manejador = JobUploadHandler(None, 'trabajo', {'excel_file': 10, 'images_zip': None})
+
+    def _subir(self, campo, nombre, bloques):
+        with self.assertRaises(StopFutureHandlers):
+            self.manejador.new_file(campo, nombre, 'application/octet-stream', None)
+        for bloque in bloques:
+            self.manejador.receive_data_chunk(bloque, 0)
+        return self.manejador.file_complete(sum(len(bloque) for bloque in bloques))
+
+    def test_archivo_guardado_con_su_huella(self):
+        archivo = self._subir('images_zip', 'fotos.zip', [b'PK' * 10, b'resto'])
+        self.assertEqual(archivo.relativa, os.path.join('uploads', 'zip', 'trabajo_fotos.zip'))
+        self.assertEqual(archivo.huella, hashlib.sha256(b'PK' * 10 + b'resto').hexdigest())
+        with open(archivo.temporary_file_path(), 'rb') as guardado:
+            self.assertEqual(guardado.read(), b'PK' * 10 + b'resto')
+        # Los campos desconocidos no se guardan
+        self.assertIsNone(self._subir('otro', 'x.txt', [b'datos']))
+
+    def test_limite_de_tamano_descarta_la_subida(self):
+        zip_guardado = self._subir('images_zip', 'fotos.zip', [b'PK'])
+        self.assertIsNotNone(self._subir('excel_file', 'datos.xlsx', [b'0123456789']))
+        with self.assertRaises(StopUpload):
+            self._subir('excel_file', 'otro.xlsx', [b'0123456789', b'!'])
+        self.assertIn("'otro.xlsx' supera el tamaño máximo", self.manejador.error)
+        # Se borra todo lo escrito por la subida, no solo el archivo que no cabía
+        self.assertFalse(os.path.exists(zip_guardado.ruta))
+        self.assertEqual(os.listdir(os.path.join(self.directorio, 'uploads', 'excel')), [])
+
+
+class AlmacenamientoTests(SimpleTestCase):
+    """Almacenamiento de los documentos generados."""
+
+    def test_alias_resultados(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        almacenes = {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'resultados': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': directorio},
+            },
+        }
+        with self.settings(STORAGES=almacenes):
+            self.assertEqual(result_storage().path('output/doc.docx'), os.path.join(directorio, 'output', 'doc.docx'))
+        # Sin el alias se usa el almacenamiento predeterminado
+        del almacenes['resultados']
+        with self.settings(STORAGES=almacenes):
+            self.assertIs(result_storage(), default_storage)
+
+
+class DescargasTests(SimpleTestCase):
+    """Respuestas de document_response: completas, parciales y condicionales."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        self.almacen = FileSystemStorage(location=self.directorio)
+        os.makedirs(os.path.join(self.directorio, 'output'))
+        with open(os.path.join(self.directorio, 'output', 'doc.docx'), 'wb') as archivo:
+            archivo.write(CONTENIDO)
+        self.factory = RequestFactory()
+
+    def _get(self, opciones=None, **cabeceras):
+        request = self.factory.get('/', headers=cabeceras)
+        return document_response(
+            request, self.almacen, 'output/doc.docx', 'documento.docx', get_opciones(**(opciones or {})),
+        )
+
+    def _contenido(self, respuesta):
+        return b''.join(respuesta.streaming_content)
+
+    def test_documento_completo(self):
+        respuesta = self._get()
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(self._contenido(respuesta), CONTENIDO)
+        self.assertEqual(respuesta['Accept-Ranges'], 'bytes')
+        self.assertEqual(respuesta['Cache-Control'], 'private')
+        self.assertIn('filename="documento.docx"', respuesta['Content-Disposition'])
+        self.assertTrue(respuesta['Content-Type'].startswith('application/vnd.openxmlformats'))
+
+    def test_intervalos(self):
+        casos = {
+            'bytes=0-9': (0, 9),
+            'bytes=1000-': (1000, 1023),
+            'bytes=-24': (1000, 1023),
+            'bytes=1000-5000': (1000, 1023),
+            'bytes=-5000': (0, 1023),
+        }
+        for rango, (inicio, fin) in casos.items():
+            with self.subTest(rango=rango):
+                respuesta = self._get(Range=rango)
+                self.assertEqual(respuesta.status_code, 206)
+                self.assertEqual(respuesta['Content-Range'], f'bytes {inicio}-{fin}/1024')
+                self.assertEqual(respuesta['Content-Length'], str(fin - inicio + 1))
+                self.assertEqual(self._contenido(respuesta), CONTENIDO[inicio:fin + 1])
+
+    def test_intervalo_abre_el_archivo_al_enviarlo(self):
+        with mock.patch.object(self.almacen, 'open', wraps=self.almacen.open) as abrir:
+            respuesta = self._get(Range='bytes=0-9')
+            # Una respuesta que no se llega a enviar no deja ningún archivo abierto
+            self.assertFalse(abrir.called)
+            self.assertEqual(self._contenido(respuesta), CONTENIDO[:10])
+            self.assertEqual(abrir.call_count, 1)
+
+    def test_intervalo_no_satisfacible(self):
+        for rango in ('bytes=1024-', 'bytes=5000-6000', 'bytes=-0'):
+            with self.subTest(rango=rango):
+                respuesta = self._get(Range=rango)
+                self.assertEqual(respuesta.status_code, 416)
+                self.assertEqual(respuesta['Content-Range'], 'bytes */1024')
+
+    def test_intervalo_no_admitido_envia_todo(self):
+        # Varios intervalos, intervalos al revés y unidades desconocidas
+        for rango in ('bytes=0-1,5-6', 'bytes=9-0', 'items=0-1', 'bytes=-'):
+            with self.subTest(rango=rango):
+                respuesta = self._get(Range=rango)
+                self.assertEqual(respuesta.status_code, 200)
+                self.assertEqual(self._contenido(respuesta), CONTENIDO)
+
+    def test_if_none_match(self):
+        etag = self._get()['ETag']
+        self.assertEqual(self._get(If_None_Match=etag).status_code, 304)
+        self.assertEqual(self._get(If_None_Match='"otro"').status_code, 200)
+
+    def test_if_modified_since(self):
+        modificado = self._get()['Last-Modified']
+        self.assertEqual(self._get(If_Modified_Since=modificado).status_code, 304)
+
+    def test_if_range(self):
+        respuesta = self._get()
+        etag, modificado = respuesta['ETag'], respuesta['Last-Modified']
+        self.assertEqual(self._get(Range='bytes=0-9', If_Range=etag).status_code, 206)
+        self.assertEqual(self._get(Range='bytes=0-9', If_Range=modificado).status_code, 206)
+        # El documento cambió desde que se empezó a descargar: se envía entero
+        self.assertEqual(self._get(Range='bytes=0-9', If_Range='"otro"').status_code, 200)
+
+    def test_descarga_delegada(self):
+        respuesta = self._get({'DESCARGA_DELEGADA': 'x-accel-redirect', 'DESCARGA_PREFIJO_INTERNO': '/interno/'})
+        self.assertEqual(respuesta['X-Accel-Redirect'], '/interno/output/doc.docx')
+        self.assertEqual(respuesta.content, b'')
+        respuesta = self._get({'DESCARGA_DELEGADA': 'x-sendfile'})
+        self.assertEqual(respuesta['X-Sendfile'], os.path.join(self.directorio, 'output', 'doc.docx'))
+        with self.assertRaises(ValueError):
+            self._get({'DESCARGA_DELEGADA': 'otra'})
+
+
+class AdmisionTests(TestCase):
+    """Límites de la cola y de las generaciones simultáneas."""
+
+    def setUp(self):
+        self.ana = User.objects.create_user('ana')
+        self.luis = User.objects.create_user('luis')
+        self.hace_un_rato = timezone.now() - timedelta(minutes=10)
+
+    def _opciones(self, **cambios):
+        return get_opciones(**{
+            'GENERACION_MAX_SIMULTANEAS': None,
+            'GENERACION_MAX_POR_USUARIO': None,
+            'GENERACION_MEMORIA_MAX_BYTES': None,
+            'COLA_MAX_TRABAJOS': None,
+            'COLA_MAX_POR_USUARIO': None,
+            'TRABAJO_LATIDO_MAX_SEGUNDOS': 120,
+            **cambios,
+        })
+
+    def _en_proceso(self, latido=None, **campos):
+        ahora = timezone.now()
+        return _trabajo(estado=ArchivoGenerado.PROCESANDO, fecha_inicio=ahora, latido=latido or ahora, **campos)
+
+    def test_cola_llena(self):
+        _trabajo(usuario=self.ana)
+        _trabajo(usuario=self.luis, estado=ArchivoGenerado.COMPLETADO)
+        self.assertIsNotNone(queue_error(self.ana, [], self._opciones(COLA_MAX_TRABAJOS=1)))
+        self.assertIsNone(queue_error(self.ana, [], self._opciones(COLA_MAX_TRABAJOS=2)))
+
+    def test_cola_por_usuario(self):
+        trabajo = _trabajo(usuario=self.ana)
+        opciones = self._opciones(COLA_MAX_POR_USUARIO=1)
+        self.assertIsNotNone(queue_error(self.ana, [], opciones))
+        self.assertIsNone(queue_error(self.luis, [], opciones))
+        # Los anónimos se cuentan por los trabajos de su sesión
+        self.assertIsNotNone(queue_error(AnonymousUser(), [trabajo.pk], opciones))
+        self.assertIsNone(queue_error(AnonymousUser(), [], opciones))
+
+    def test_memoria(self):
+        opciones = self._opciones(GENERACION_MEMORIA_MAX_BYTES=100)
+        self.assertIsNone(memory_error(100, opciones))
+        self.assertIsNotNone(memory_error(101, opciones))
+        self.assertIsNone(memory_error(10 ** 12, self._opciones()))
+
+    def test_orden_de_llegada(self):
+        primero = _trabajo()
+        _trabajo()
+        self.assertEqual(next_admissible(self._opciones()), primero)
+
+    def test_maximo_simultaneas(self):
+        self._en_proceso()
+        en_cola = _trabajo()
+        self.assertIsNone(next_admissible(self._opciones(GENERACION_MAX_SIMULTANEAS=1)))
+        self.assertEqual(next_admissible(self._opciones(GENERACION_MAX_SIMULTANEAS=2)), en_cola)
+
+    def test_maximo_por_usuario_deja_pasar_a_otros(self):
+        self._en_proceso(usuario=self.ana)
+        _trabajo(usuario=self.ana)
+        de_luis = _trabajo(usuario=self.luis)
+        self.assertEqual(next_admissible(self._opciones(GENERACION_MAX_POR_USUARIO=1)), de_luis)
+
+    def test_memoria_libre(self):
+        self._en_proceso(memoria_estimada=60)
+        grande = _trabajo(memoria_estimada=50)
+        _trabajo(memoria_estimada=10)
+        # El más antiguo no cabe: se espera en lugar de adelantar al pequeño
+        self.assertIsNone(next_admissible(self._opciones(GENERACION_MEMORIA_MAX_BYTES=100)))
+        self.assertEqual(next_admissible(self._opciones(GENERACION_MEMORIA_MAX_BYTES=110)), grande)
+
+    def test_sin_estimar_no_empieza(self):
+        _trabajo()
+        self.assertIsNone(next_admissible(self._opciones(GENERACION_MEMORIA_MAX_BYTES=100)))
+
+
+    def test_latido_caducado(self):
+        vivo = self._en_proceso()
+        muerto = self._en_proceso(latido=self.hace_un_rato)
+        anterior_al_latido = _trabajo(estado=ArchivoGenerado.PROCESANDO, fecha_inicio=self.hace_un_rato)
+        opciones = self._opciones()
+        self.assertEqual(set(live_jobs(opciones)), {vivo})
+        self.assertEqual(set(stale_jobs(opciones)), {muerto, anterior_al_latido})
+        sin_caducidad = self._opciones(TRABAJO_LATIDO_MAX_SEGUNDOS=None)
+        self.assertEqual(live_jobs(sin_caducidad).count(), 3)
+        self.assertFalse(stale_jobs(sin_caducidad).exists())
+
+    def test_trabajos_muertos_no_ocupan_sitio(self):
+        self._en_proceso(latido=self.hace_un_rato, memoria_estimada=100)
+        en_cola = _trabajo(memoria_estimada=100)
+        opciones = self._opciones(GENERACION_MAX_SIMULTANEAS=1, GENERACION_MEMORIA_MAX_BYTES=100)
+        self.assertEqual(next_admissible(opciones), en_cola)
+
+    def test_bloqueo_recrea_la_fila(self):
+        ColaGeneracion.objects.all().delete()
+        with transaction.atomic():
+            lock_queue()
+        self.assertTrue(ColaGeneracion.objects.filter(pk=1).exists())
+
+    def test_trabajos_interrumpidos_fallan(self):
+        muerto = self._en_proceso(
+            latido=self.hace_un_rato, clave_contenido='k', excel_original='uploads/excel/no_existe.xlsx',
+            zip_original='uploads/zip/no_existe.zip',
+        )
+        self.assertIsNone(claim_next_job())
+        muerto.refresh_from_db()
+        self.assertEqual((muerto.estado, muerto.error), (ArchivoGenerado.FALLIDO, MENSAJE_INTERRUMPIDO))
+        # Su documento a medias no se reutiliza
+        self.assertEqual(muerto.clave_contenido, '')
+
+
+class LimpiezaTests(TestCase):
+    """Retención de subidas, documentos y temporales."""
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+        almacenes = {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'resultados': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': self.directorio},
+            },
+        }
+        ajustes = override_settings(MEDIA_ROOT=self.directorio, STORAGES=almacenes)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        self.temporal = os.path.join(self.directorio, 'temp')
+        self.opciones = get_opciones(
+            RETENCION_SUBIDAS_HORAS=24, RETENCION_DOCUMENTOS_HORAS=24, RETENCION_DOCUMENTOS_MAX_BYTES=None,
+            RETENCION_TEMPORALES_HORAS=1, DIRECTORIO_TEMPORAL=self.temporal,
+        )
+        self.hace_dos_dias = timezone.now() - timedelta(days=2)
+
+    def _archivo(self, relativa, horas=0):
+        # Archivo de 10 bytes modificado hace las horas indicadas
+        ruta = os.path.join(self.directorio, relativa)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'wb') as archivo:
+            archivo.write(b'0123456789')
+        instante = time.time() - horas * 3600
+        os.utime(ruta, (instante, instante))
+        return relativa
+
+    def _existe(self, relativa):
+        return os.path.exists(os.path.join(self.directorio, relativa))
+
+    def test_subidas_de_trabajos_terminados(self):
+        terminado = _trabajo(
+            estado=ArchivoGenerado.COMPLETADO, fecha_fin=self.hace_dos_dias,
+            excel_original=self._archivo('uploads/excel/a_datos.xlsx'), zip_original=self._archivo('uploads/zip/a.zip'),
+        )
+        en_cola = _trabajo(excel_original=self._archivo('uploads/excel/b_datos.xlsx'), zip_original='')
+        informe = sweep_media(self.opciones)
+        self.assertEqual(informe['subidas'], {'archivos': 2, 'bytes': 20})
+        self.assertFalse(self._existe('uploads/zip/a.zip'))
+        self.assertTrue(self._existe(en_cola.excel_original))
+        terminado.refresh_from_db()
+        self.assertEqual((terminado.excel_original, terminado.zip_original), ('', ''))
+
+    def test_documentos_caducados_y_fallidos(self):
+        caducado = _trabajo(
+            estado=ArchivoGenerado.COMPLETADO, fecha_fin=self.hace_dos_dias, clave_contenido='k',
+            documento_generado=self._archivo('output/viejo.docx'),
+        )
+        self._archivo('output/viejo.manifiesto.json')
+        reciente = _trabajo(
+            estado=ArchivoGenerado.COMPLETADO, fecha_fin=timezone.now(),
+            documento_generado=self._archivo('output/nuevo.docx'),
+        )
+        _trabajo(estado=ArchivoGenerado.FALLIDO, fecha_fin=timezone.now(),
+                 documento_generado=self._archivo('output/parcial.docx'))
+        # Simulando solo se cuenta
+        self.assertEqual(sweep_media(self.opciones, simular=True)['documentos'], {'archivos': 3, 'bytes': 30})
+        self.assertTrue(self._existe('output/viejo.docx'))
+        self.assertEqual(sweep_media(self.opciones)['documentos'], {'archivos': 3, 'bytes': 30})
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directorio, 'output'))), ['nuevo.docx'])
+        caducado.refresh_from_db()
+        self.assertEqual((caducado.documento_generado.name, caducado.clave_contenido), ('', ''))
+        self.assertEqual(ArchivoGenerado.objects.get(pk=reciente.pk).documento_generado.name, 'output/nuevo.docx')
+
+    def test_huerfanos_y_temporales(self):
+        self._archivo('uploads/excel/huerfano.xlsx', horas=2)
+        self._archivo('uploads/zip/recibiendose.zip')
+        self._archivo('output/sin_trabajo.docx', horas=2)
+        self._archivo('temp/tmpabc/shard_0.docx', horas=2)
+        os.utime(os.path.join(self.temporal, 'tmpabc'), (time.time() - 7200,) * 2)
+        self._archivo('temp/en_curso.tmp')
+        informe = sweep_media(self.opciones)
+        self.assertEqual(informe['huerfanos'], {'archivos': 2, 'bytes': 20})
+        self.assertEqual(informe['temporales'], {'archivos': 1, 'bytes': 10})
+        # Lo modificado hace menos del margen se conserva
+        self.assertTrue(self._existe('uploads/zip/recibiendose.zip'))
+        self.assertEqual(os.listdir(self.temporal), ['en_curso.tmp'])
@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+import zipfile
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .admision import lock_queue, memory_error, next_admissible, stale_jobs
+from .conf import get_opciones
+from .metricas import Instrumentacion, log_metrics
+from .models import ArchivoGenerado, MetricaEtapa
+from .resultados import evict_results
+
+logger = logging.getLogger(__name__)
+
+# Errores de validación que se guardan en el resumen del trabajo
+MAX_ERRORES_GUARDADOS = 500
+
+# Segundos mínimos entre dos actualizaciones del avance en la base de datos
+INTERVALO_PROGRESO = 1.0
+
+MENSAJE_INTERRUMPIDO = (
+    "La generación se interrumpió porque el proceso que la ejecutaba terminó "
+    "inesperadamente. Vuelve a subir los archivos para intentarlo de nuevo."
+)
+
+
+def claim_next_job():
+    """Toma el trabajo en cola más antiguo que los límites de admisión dejan
+    empezar y lo marca como en proceso; None si no hay ninguno.
+
+    La decisión se toma con la cola bloqueada, así que aunque haya varios
+    procesos trabajadores solo uno de ellos se queda con cada trabajo y
+    ninguno supera los límites contando con los que empiezan los demás.
+    Antes se marcan como fallidos los trabajos cuyo trabajador murió.
+    """
+    opciones = get_opciones()
+    _estimate_queued_jobs(opciones)
+    with transaction.atomic():
+        lock_queue()
+        _fail_stale_jobs(opciones)
+        trabajo = next_admissible(opciones)
+        if trabajo is None:
+            return None
+        trabajo.estado = ArchivoGenerado.PROCESANDO
+        trabajo.fecha_inicio = trabajo.latido = timezone.now()
+        trabajo.save(update_fields=['estado', 'fecha_inicio', 'latido'])
+    return trabajo
+
+
+def _fail_stale_jobs(opciones):
+    # Sin ellos el trabajo se quedaría en proceso para siempre. No se vuelven
+    # a encolar: si el proceso murió por falta de memoria, volvería a morir
+    caducados = list(stale_jobs(opciones))
+    if not caducados:
+        return
+    ArchivoGenerado.objects.filter(pk__in=[trabajo.pk for trabajo in caducados]).update(
+        estado=ArchivoGenerado.FALLIDO, error=MENSAJE_INTERRUMPIDO, fecha_fin=timezone.now(),
+        clave_contenido='',
+    )
+    for trabajo in caducados:
+        logger.warning("Trabajo %s interrumpido: sin latido desde %s", trabajo.pk, trabajo.latido)
+        _discard_uploads(trabajo)
+
+
+def _estimate_queued_jobs(opciones):
+    """Estima la memoria de los trabajos en cola que aún no la tienen y
+    rechaza los que no caben en la memoria permitida. Los que solo caben con
+    el escritor en streaming se estiman con él, y run_job los genera así."""
+    if opciones['GENERACION_MEMORIA_MAX_BYTES'] is None:
+        return
+    from .utils import generate_word_document
+
+    sin_estimar = ArchivoGenerado.objects.filter(estado=ArchivoGenerado.EN_COLA, memoria_estimada=None)
+    for trabajo in sin_estimar.order_by('fecha_creacion', 'pk'):
+        try:
+            estimacion = generate_word_document(
+                os.path.join(settings.MEDIA_ROOT, trabajo.excel_original),
+                os.path.join(settings.MEDIA_ROOT, trabajo.zip_original),
+                None, simular=True,
+            )
+            memoria = estimacion['memoria_bytes']
+        except Exception:
+            # El error se mostrará al generar; la estimación no lo adelanta
+            memoria = 0
+        mensaje = memory_error(memoria, opciones)
+        if mensaje is None:
+            ArchivoGenerado.objects.filter(pk=trabajo.pk).update(memoria_estimada=memoria)
+            continue
+        # Solo si sigue en cola: otro trabajador puede haberlo estimado ya
+        rechazado = ArchivoGenerado.objects.filter(pk=trabajo.pk, estado=ArchivoGenerado.EN_COLA).update(
+            estado=ArchivoGenerado.FALLIDO, error=mensaje, memoria_estimada=memoria, fecha_fin=timezone.now(),
+        )
+        if rechazado:
+            logger.info("Trabajo %s rechazado: %s", trabajo.pk, mensaje)
+            _discard_uploads(trabajo)
+
+
+def run_job(trabajo):
+    # La generación se importa con el primer trabajo, no al arrancar el trabajador
+    from .utils import generate_word_document
+    from .validacion import ValidacionError
+
+    excel_path = os.path.join(settings.MEDIA_ROOT, trabajo.excel_original)
+    zip_path = os.path.join(settings.MEDIA_ROOT, trabajo.zip_original)
+    output_path = trabajo.documento_generado.path
+    opciones = get_opciones()
+    # Se crea aquí para conservar las métricas también si la generación falla
+    instrumentacion = Instrumentacion(opciones['METRICAS_TRACEMALLOC'])
+    latido = _start_heartbeat(trabajo, opciones)
+
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # La fecha de recepción es la del día de la subida, que forma parte de
+        # la clave de la caché de resultados
+        resumen = generate_word_document(
+            excel_path, zip_path, output_path, instrumentacion=instrumentacion,
+            fecha_recepcion=timezone.localtime(trabajo.fecha_creacion).date(),
+            documento_base=_base_document(trabajo), progreso=_progress_recorder(trabajo),
+        )
+    except zipfile.BadZipFile:
+        _fail(trabajo, "El archivo ZIP subido está corrupto o no es un ZIP válido.")
+    except ValidacionError as e:
+        # El informe completo se guarda para mostrarlo fila por fila
+        trabajo.resumen = {
+            'errores': [error._asdict() for error in e.errores[:MAX_ERRORES_GUARDADOS]],
+            'total_errores': len(e.errores),
+        }
+        _fail(trabajo, str(e))
+    except Exception as e:
+        logger.exception("Error al generar el documento del trabajo %s", trabajo.pk)
+        _fail(trabajo, f"Error general al procesar los archivos: {str(e)}")
+    else:
+        trabajo.estado = ArchivoGenerado.COMPLETADO
+        # Las métricas se guardan aparte, en MetricaEtapa
+        resumen.pop('metricas')
+        trabajo.resumen = resumen
+        trabajo.etiquetas = resumen['etiquetas']
+        trabajo.duracion_segundos = resumen['segundos']
+        trabajo.fecha_fin = timezone.now()
+        trabajo.save(update_fields=['estado', 'resumen', 'etiquetas', 'duracion_segundos', 'fecha_fin'])
+        evict_results(opciones)
+    finally:
+        latido.set()
+        resultados = instrumentacion.results()
+        MetricaEtapa.save_results(trabajo, resultados)
+        log_metrics(resultados, trabajo=trabajo.pk, etiquetas=trabajo.etiquetas)
+        _discard_uploads(trabajo)
+    return trabajo
+
+
+def _discard_uploads(trabajo):
+    if trabajo.usuario_id is None:
+        # Sin usuario no hay historial que conserve los archivos originales
+        for relativa in (trabajo.excel_original, trabajo.zip_original):
+            archivo = os.path.join(settings.MEDIA_ROOT, relativa)
+            if os.path.exists(archivo):
+                os.remove(archivo)
+
+
+def _start_heartbeat(trabajo, opciones):
+    """Renueva el latido del trabajo en un hilo aparte mientras se genera,
+    también durante las etapas que no informan de su avance (preparación de
+    imágenes, bloques en otros procesos, guardado). Devuelve el evento que
+    lo detiene."""
+    parar = threading.Event()
+    if opciones['TRABAJO_LATIDO_MAX_SEGUNDOS'] is None:
+        return parar
+
+    def latir():
+        try:
+            while not parar.wait(opciones['TRABAJO_LATIDO_MAX_SEGUNDOS'] / 3):
+                ArchivoGenerado.objects.filter(pk=trabajo.pk).update(latido=timezone.now())
+        finally:
+            # La conexión es propia del hilo
+            connection.close()
+
+    threading.Thread(target=latir, name=f'latido-{trabajo.pk}', daemon=True).start()
+    return parar
+
+
+def _progress_recorder(trabajo):
+    """Función de progreso que guarda el avance del trabajo, como mucho una
+    vez por INTERVALO_PROGRESO salvo los cambios de etapa y el final. Cada
+    actualización renueva también el latido."""
+    ultimo = {'etapa': None, 'instante': 0.0}
+
+    def progreso(etapa, hechas, total):
+        ahora = time.monotonic()
+        if etapa == ultimo['etapa'] and hechas != total and ahora - ultimo['instante'] < INTERVALO_PROGRESO:
+            return
+        ultimo.update(etapa=etapa, instante=ahora)
+        ArchivoGenerado.objects.filter(pk=trabajo.pk).update(
+            etapa_actual=etapa, etiquetas_hechas=hechas, etiquetas=total, latido=timezone.now(),
+        )
+
+    return progreso
+
+
+def _base_document(trabajo):
+    # Documento del trabajo anterior, si sigue disponible para copiar etiquetas
+    base = trabajo.trabajo_base
+    if base is None or base.estado != ArchivoGenerado.COMPLETADO or not base.documento_generado:
+        return None
+    return base.documento_generado.path
+
+
+def _fail(trabajo, mensaje):
+    trabajo.estado = ArchivoGenerado.FALLIDO
+    trabajo.error = mensaje
+    trabajo.fecha_fin = timezone.now()
+    trabajo.save(update_fields=['estado', 'error', 'resumen', 'fecha_fin'])
@@ -5,5 +5,8 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('procesar/', views.procesar_archivos, name='procesar_archivos'),
     path('descargar/', views.descargar, name='descargar'),
-    path('obtener-documento/', views.obtener_documento, name='obtener_documento'),
+    path('descargar/<int:trabajo_id>/', views.descargar, name='descargar'),
+    path('estado/<int:trabajo_id>/', views.estado_trabajo, name='estado_trabajo'),
+    path('progreso/<int:trabajo_id>/', views.progreso_trabajo, name='progreso_trabajo'),
+    path('obtener-documento/<int:trabajo_id>/', views.obtener_documento, name='obtener_documento'),
 ]
\ No newline at end of file
@@ -1,303 +1,521 @@
-import os
-import pandas as pd
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor # <--- Añadir RGBColor
-from docx.enum.table import WD_TABLE_ALIGNMENT
-from docx.oxml import OxmlElement, parse_xml
-from docx.oxml.ns import qn
-from docx.enum.table import WD_ALIGN_VERTICAL
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.shared import Inches
 from datetime import datetime # <--- Añadir esta importación
-import qrcode # <--- Añadir esta importación
-import io     # <--- Añadir esta importación
-from PIL import Image
+import contextlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from .conf import get_opciones, splits_volumes
+from .escritura import (
+    ReusableLabels,
+    StreamingDocxWriter,
+    append_shard,
+    document_xml_size,
+    open_writer,
+)
+from .estimacion import BYTES_BASE_DOCX, estimate_document, load_throughput, record_throughput
+from .lectura import iter_label_rows, read_label_sheet
+from .manifiesto import label_hashes, manifest_header, reusable_labels, write_manifest
+from .metricas import Avance, Instrumentacion
+from .imagenes import iter_prepared_images, open_image_source
+from .plantilla import (
+    LabelTemplate,
+    adjust_cell_spacing,
+    configure_margins,
+    remove_paragraph_spacing,
+    set_table_borders,
+)
+from .qr import ANCHO_QR_PULGADAS, QRCache
+from .validacion import validate_label_sheet
 
-def set_table_borders(table):
-    # Tu código existente para configurar bordes
-    tbl = table._element
-    tblPr = tbl.xpath("w:tblPr")
-    if not tblPr:
-        tblPr = OxmlElement('w:tblPr')
-        tbl.insert(0, tblPr)
-    else:
-        tblPr = tblPr[0]
-    tblBorders = OxmlElement('w:tblBorders')
-    for border_name in ['top', 'left', 'bottom', 'right', 'insideH', 'insideV']:
-        border = OxmlElement(f'w:{border_name}')
-        border.set(qn('w:val'), 'single')
-        border.set(qn('w:sz'), '8')
-        border.set(qn('w:space'), '0')
-        border.set(qn('w:color'), '000000')
-        tblBorders.append(border)
-    tblPr.append(tblBorders)
+logger = logging.getLogger(__name__)
 
-def remove_paragraph_spacing(paragraph):
-    # Tu código existente para eliminar espacios
-    if paragraph:
-        p = paragraph._p
-        pPr = p.get_or_add_pPr()
-        spacing = OxmlElement('w:spacing')
-        spacing.set(qn('w:before'), '20')
-        spacing.set(qn('w:after'), '20')
-        pPr.append(spacing)
+def generate_word_document(excel_path, images_source, output_path, opciones=None, simular=False,
+                           instrumentacion=None, fecha_recepcion=None, documento_base=None, progreso=None):
+    # images_source puede ser el ZIP subido o un directorio de imágenes. Con
+    # simular=True solo se valida el Excel y se devuelve la estimación del
+    # documento, sin generarlo. fecha_recepcion es la fecha impresa en las
+    # etiquetas; por defecto, la de hoy. Las etiquetas que no han cambiado
+    # respecto a documento_base (un .docx generado antes, con su manifiesto)
+    # se copian de él en lugar de volver a generarse. progreso(etapa, hechas,
+    # total) recibe el avance del trabajo a medida que se generan las etiquetas
+    opciones = get_opciones(**(opciones or {}))
+    instrumentacion = instrumentacion or Instrumentacion(opciones['METRICAS_TRACEMALLOC'])
+    fecha_recepcion = fecha_recepcion or datetime.now().date()
+    try:
+        return _generate(
+            excel_path, images_source, output_path, opciones, simular, instrumentacion,
+            fecha_recepcion.strftime("%d/%m/%Y"), documento_base, Avance(progreso),
+        )
+    finally:
+        instrumentacion.close()
 
-def adjust_cell_spacing(cell):
-    # Tu código existente para ajustar espacios en celdas
-    tcPr = cell._element.tcPr
-    if tcPr is None:
-        tcPr = OxmlElement('w:tcPr')
-        cell._element.append(tcPr)
-    
-    tblCellMar = OxmlElement('w:tcMar')
-    margins = {'top': '40', 'left': '60', 'bottom': '40', 'right': '60'}
-    for margin, value in margins.items():
-        mar = OxmlElement(f'w:{margin}')
-        mar.set(qn('w:w'), value)
-        mar.set(qn('w:type'), 'dxa')
-        tblCellMar.append(mar)
-    
-    existing_mar = tcPr.find(qn('w:tcMar'))
-    if existing_mar is not None:
-        tcPr.remove(existing_mar)
-    tcPr.append(tblCellMar)
-    
-    tcVAlign = OxmlElement('w:vAlign')
-    tcVAlign.set(qn('w:val'), 'top')
-    tcPr.append(tcVAlign)
-    
-    for paragraph in cell.paragraphs:
-        remove_paragraph_spacing(paragraph)
+def _generate(excel_path, images_source, output_path, opciones, simular, instrumentacion, fecha_recepcion,
+              documento_base, avance):
+    inicio = time.perf_counter()
+    # Leer solo las columnas de la etiqueta del archivo Excel
+    avance.etapa('lectura_excel')
+    with instrumentacion.etapa('lectura_excel'):
+        df = read_label_sheet(excel_path)
+    with instrumentacion.etapa('indice_imagenes'):
+        fuente_imagenes = open_image_source(images_source)
+    with fuente_imagenes:
+        with instrumentacion.etapa('busqueda_imagenes'):
+            imagen_por_fila, imagenes_no_encontradas = _resolve_images(df, fuente_imagenes)
+        # Validar todo el Excel antes de generar nada; lanza ValidacionError con el informe por fila
+        avance.etapa('validacion')
+        with instrumentacion.etapa('validacion'):
+            df, advertencias = validate_label_sheet(df, imagen_por_fila, opciones)
+        # Las filas de 0 cajas ya no están en el DataFrame; sus imágenes no se preparan
+        imagen_por_fila = {index: imagen_por_fila[index] for index in df.index}
+        estimacion = estimate_document(df, imagen_por_fila, fuente_imagenes, opciones)
+        if simular:
+            estimacion['imagenes_no_encontradas'] = imagenes_no_encontradas
+            return estimacion
+        if estimacion['escritura_streaming']:
+            # El documento en memoria no cabe: se genera en streaming, como se estimó al admitirlo
+            opciones = dict(opciones, ESCRITURA_STREAMING=True)
+        avance.total = int(df['CONTEO_CAJAS'].sum())
+        avance.etapa('construccion_tablas')
+        cabecera = manifest_header(fecha_recepcion, opciones)
+        volumenes = None
+        if splits_volumes(opciones):
+            # output_path es un ZIP con un .docx independiente por volumen
+            volumenes = _split_volumes(df, imagen_por_fila, fuente_imagenes, opciones)
+            medidas = _build_volumes(
+                df, volumenes, imagen_por_fila, fuente_imagenes, images_source, fecha_recepcion,
+                output_path, opciones, instrumentacion, avance,
+            )
+        else:
+            with _open_reusable(documento_base, cabecera, instrumentacion) as reutilizables:
+                procesos = opciones['GENERACION_PROCESOS'] or os.cpu_count() or 1
+                if reutilizables:
+                    # La regeneración incremental se hace en un solo proceso y con el
+                    # escritor en streaming, que añade las imágenes copiadas sin
+                    # recorrer las partes del paquete cada vez
+                    procesos = 1
+                    opciones = dict(opciones, ESCRITURA_STREAMING=True)
+                shards = _split_rows(df, procesos)
+                if len(shards) <= 1:
+                    medidas = _build_document(
+                        df, imagen_por_fila, fuente_imagenes, fecha_recepcion, output_path, opciones,
+                        instrumentacion, reutilizables=reutilizables, avance=avance,
+                    )
+                else:
+                    medidas = _build_document_parallel(
+                        df, shards, imagen_por_fila, images_source, fecha_recepcion, output_path, opciones,
+                        instrumentacion, avance,
+                    )
+    medidas.update(
+        segundos=time.perf_counter() - inicio,
+        segundos_imagenes=instrumentacion.seconds('carga_imagenes'),
+        segundos_qr=instrumentacion.seconds('generacion_qr'),
+        etiquetas=int(df['CONTEO_CAJAS'].sum()),
+    )
+    manifiesto = medidas.pop('manifiesto')
+    if volumenes is None:
+        medidas['bytes_documento'] = document_xml_size(output_path)
+        # Los volúmenes no admiten regeneración incremental: no llevan manifiesto
+        write_manifest(output_path, cabecera, manifiesto)
+    # El rendimiento medido alimenta las estimaciones de los próximos trabajos;
+    # una regeneración incremental no es representativa
+    if not medidas['etiquetas_copiadas']:
+        record_throughput(opciones['RENDIMIENTO_ARCHIVO'], medidas)
+    logger.info("Caché de QR para %s: %s", output_path, medidas['qr_cache'])
+    return {
+        'output_path': output_path,
+        'imagenes_no_encontradas': imagenes_no_encontradas,
+        'advertencias': [advertencia._asdict() for advertencia in advertencias],
+        'qr_cache': medidas['qr_cache'],
+        'etiquetas': medidas['etiquetas'],
+        'etiquetas_copiadas': medidas['etiquetas_copiadas'],
+        'volumenes': len(volumenes) if volumenes else None,
+        'segundos': round(medidas['segundos'], 1),
+        'metricas': instrumentacion.results(),
+    }
+
+def _open_reusable(documento_base, cabecera, instrumentacion):
+    # Etiquetas del documento anterior que se pueden copiar; None si no hay ninguna
+    posicion_por_huella = reusable_labels(documento_base, cabecera) if documento_base else {}
+    if not posicion_por_huella:
+        return contextlib.nullcontext()
+    with instrumentacion.etapa('copia_etiquetas'):
+        return ReusableLabels(documento_base, posicion_por_huella)
 
-def generate_word_document(excel_path, images_dir, output_path):
-    # Leer el archivo Excel
-    df = pd.read_excel(excel_path)
-    doc = Document()
+def _resolve_images(df, fuente_imagenes):
+    # Resolver la imagen de cada fila contra el índice de la fuente; cada
+    # nombre distinto se busca una sola vez
+    rutas = {}
+    imagenes_no_encontradas = []
+    for imagen_nombre in df['IMAGEN'].unique():
+        if imagen_nombre: # La columna ya viene sin espacios; se ignoran las celdas vacías
+            rutas[imagen_nombre] = fuente_imagenes.resolve(imagen_nombre)
+            if rutas[imagen_nombre] is None:
+                imagenes_no_encontradas.append(imagen_nombre)
+    imagen_por_fila = {
+        index: rutas.get(imagen_nombre) for index, imagen_nombre in df['IMAGEN'].items()
+    }
+    return imagen_por_fila, imagenes_no_encontradas
+
+def _new_qr_cache(opciones):
+    return QRCache(
+        opciones['QR_CACHE_DIR'],
+        opciones['QR_CACHE_MAX_BYTES'],
+        dpi=opciones['QR_DPI'],
+        correccion=opciones['QR_CORRECCION'],
+        borde=opciones['QR_BORDE'],
+        png_optimizar=opciones['IMAGEN_PNG_OPTIMIZAR'],
+    )
+
+def _new_measures():
+    # Contadores de lo producido por cada etapa; los tiempos los lleva la instrumentación
+    return {
+        'imagenes': 0,
+        'bytes_imagenes': 0,
+        'bytes_imagenes_origen': 0,
+        'qr_registrados': 0,
+        'qr_generados': 0,
+        'bytes_qr': 0,
+        'etiquetas_copiadas': 0,
+        # (fila, caja, huella) de cada etiqueta, en el orden del documento
+        'manifiesto': [],
+    }
+
+def _build_document(df, imagen_por_fila, fuente_imagenes, fecha_recepcion, output_path, opciones,
+                    instrumentacion, salto_final=False, reutilizables=None, avance=None):
+    # Los parciales que se generan en otro proceso no comunican su avance
+    avance = avance or Avance()
+    medidas = _new_measures()
+    # La huella de cada etiqueta incluye la de su imagen, que sale del índice
+    # de la fuente sin leer la imagen
+    huellas_imagen = {
+        ruta: f'{ruta}:{fuente_imagenes.fingerprint(ruta)}'
+        for ruta in dict.fromkeys(imagen_por_fila.values()) if ruta
+    }
+    huellas_por_fila = {
+        row.Index: label_hashes(row, huellas_imagen.get(imagen_por_fila[row.Index], ''))
+        for row in iter_label_rows(df)
+    }
+    # Filas cuyas etiquetas están todas en el documento anterior
+    copiadas = set()
+    if reutilizables is not None:
+        copiadas = {
+            fila for fila, huellas in huellas_por_fila.items()
+            if all(huella in reutilizables for huella in huellas)
+        }
+
+    claves = dict.fromkeys(
+        ruta for fila, ruta in imagen_por_fila.items() if ruta and fila not in copiadas
+    )
+    medidas['bytes_imagenes_origen'] = sum(fuente_imagenes.size(clave) for clave in claves)
+
+    # Reescalar y recodificar cada imagen referenciada una sola vez. Las
+    # imágenes llegan en el orden de su primera aparición en el Excel
+    imagenes_preparadas = iter_prepared_images(fuente_imagenes, claves, opciones)
     
-    # Configurar márgenes del documento
-    sections = doc.sections
-    for section in sections:
-        section.top_margin = Inches(0.3)
-        section.bottom_margin = Inches(0.3)
-        section.left_margin = Inches(0.5)
-        section.right_margin = Inches(0.5)
+    qr_cache = _new_qr_cache(opciones)
+
+    # El esqueleto de la etiqueta se construye una sola vez por trabajo
+    plantilla = LabelTemplate(fecha_recepcion)
     
-    # Procesar cada fila del Excel
-    for index, row in df.iterrows():
-        # Buscar la imagen correspondiente en el directorio de imágenes
-        imagen_path = None
-        if 'IMAGEN' in row and pd.notna(row['IMAGEN']):
-            imagen_nombre = str(row['IMAGEN']).strip() # Obtener el valor del Excel y limpiar espacios
+    try:
+        with open_writer(output_path, opciones) as documento:
+            _write_labels(
+                documento, df, imagen_por_fila, imagenes_preparadas, plantilla, qr_cache, medidas,
+                instrumentacion, huellas_por_fila, copiadas, reutilizables, avance, salto_final,
+            )
+            # Guardar el documento
+            avance.etapa('guardado')
+            with instrumentacion.etapa('guardado'):
+                documento.save()
+    finally:
+        imagenes_preparadas.close()
+    medidas['qr_generados'] = qr_cache.fallos
+    medidas['qr_cache'] = qr_cache.estadisticas()
+    return medidas
 
-            if imagen_nombre: # Solo proceder si imagen_nombre no está vacío después de strip()
-                # Definir extensiones de imagen soportadas
-                extensiones_imagen = ['.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp']
-                
-                # Si imagen_nombre no contiene un punto (es decir, no tiene extensión), buscar con todas las extensiones
-                if '.' not in imagen_nombre:
-                    # Buscar el archivo con cualquiera de las extensiones soportadas
-                    for root, dirs, files_in_current_dir in os.walk(images_dir):
-                        for file_name in files_in_current_dir:
-                            # Obtener el nombre base del archivo sin extensión
-                            nombre_base, extension = os.path.splitext(file_name)
-                            # Comparar el nombre base con imagen_nombre (ignorando mayúsculas/minúsculas)
-                            if (nombre_base.lower() == imagen_nombre.lower() and 
-                                extension.lower() in extensiones_imagen):
-                                imagen_path = os.path.join(root, file_name)
-                                break # Imagen encontrada, salir del bucle de archivos
-                        if imagen_path:
-                            break # Imagen encontrada, salir del bucle de directorios
-                else:
-                    # Si ya tiene extensión, buscar exactamente ese archivo
-                    for root, dirs, files_in_current_dir in os.walk(images_dir):
-                        for file_name in files_in_current_dir:
-                            # Comparar el nombre del archivo encontrado con imagen_nombre (ignorando mayúsculas/minúsculas)
-                            if file_name.lower() == imagen_nombre.lower():
-                                imagen_path = os.path.join(root, file_name)
-                                break # Imagen encontrada, salir del bucle de archivos
-                        if imagen_path:
-                            break # Imagen encontrada, salir del bucle de directorios
-        
-        # Obtener el número de cajas
-        num_cajas = int(row.get('CONTEO_CAJAS', 1))
-        
-        # Generar una tabla para cada caja
-        for num_caja in range(1, num_cajas + 1):
-            # Crear tabla principal
-            table = doc.add_table(rows=2, cols=2)
-            table.alignment = WD_TABLE_ALIGNMENT.CENTER
-            table.autofit = False
-            table.columns[0].width = Inches(3)
-            table.columns[1].width = Inches(3)
-            set_table_borders(table)
-            
-            # Ajustar espacios en todas las celdas
-            for row_cells in table.rows:
-                for cell in row_cells.cells:
-                    adjust_cell_spacing(cell)
-            
-            # Celda izquierda: imagen y datos
-            left_cell = table.cell(0, 0)
-            
-            # Modificar la parte donde se inserta la imagen (alrededor de la línea 120)
-            # Agregar imagen si existe
-            if imagen_path and os.path.exists(imagen_path):
-                try:
-                    p = left_cell.paragraphs[0]
-                    p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-                    run = p.add_run()
-                    
-                    # Obtener dimensiones originales de la imagen
-                    with Image.open(imagen_path) as img:
-                        width_orig, height_orig = img.size
-                        ratio = height_orig / width_orig
-                    
-                    # Establecer ancho fijo y calcular altura proporcional
-                    width_inches = 2.5  # Ancho fijo en pulgadas
-                    
-                    # Establecer un límite máximo para la altura (por ejemplo, 3 pulgadas)
-                    max_height_inches = 3.0
-                    
-                    # Calcular altura proporcional
-                    height_inches = width_inches * ratio
-                    
-                    # Si la altura calculada excede el máximo, ajustar proporcionalmente
-                    if height_inches > max_height_inches:
-                        height_inches = max_height_inches
-                        width_inches = height_inches / ratio
-                    
-                    # Insertar imagen con las dimensiones calculadas
-                    run.add_picture(imagen_path, width=Inches(width_inches), height=Inches(height_inches))
-                except Exception as e:
-                    p = left_cell.paragraphs[0]
-                    p.text = f"Error al procesar imagen: {str(e)}"
-            
-            # Tabla de datos
-            # La tabla ahora necesitará más filas para acomodar los merges y nuevos campos
-            # CÓDIGO (4) + REVISADO (2) + BLANCO (1) + RECEPCIONADO (1) + DESCRIPCIÓN (1) + CAJA (1) + CANTIDAD (1) = 11 filas
-            data_table = left_cell.add_table(rows=11, cols=1)
-            data_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-            set_table_borders(data_table)
-            
-            # Aplicar ajuste de espaciado a todas las celdas de data_table
-            for r_idx, row_cells_dt in enumerate(data_table.rows):
-                for c_idx, cell_dt in enumerate(row_cells_dt.cells):
-                    adjust_cell_spacing(cell_dt)
-            
-            # 1. Celda para CÓDIGO (ocupa 4 filas)
-            codigo_cell = data_table.cell(0, 0)
-            
-            # Limpiar el contenido por defecto y añadir el nuevo con formato
-            codigo_cell.text = '' # Limpiar cualquier texto previo
-            
-            # Párrafo para el texto del CÓDIGO
-            p_codigo = codigo_cell.paragraphs[0] # Usar el párrafo existente o añadir uno nuevo si es necesario
-            if not codigo_cell.paragraphs: # Asegurar que haya al menos un párrafo
-                 p_codigo = codigo_cell.add_paragraph()
-            else:
-                 p_codigo = codigo_cell.paragraphs[0]
-            
-            p_codigo.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-            run_codigo = p_codigo.add_run(str(row['CODIGO']))
-            run_codigo.font.size = Pt(33)
-            run_codigo.font.color.rgb = RGBColor(255, 0, 0) # Color Rojo
+def _split_rows(df, procesos):
+    """Reparte las filas en bloques contiguos con un número parecido de etiquetas.
 
-            # Generar y añadir el Código QR debajo del texto del código
-            qr_data = str(row['CODIGO'])
-            qr_img = qrcode.make(qr_data)
-            
-            # Guardar QR en un stream en memoria
-            qr_image_stream = io.BytesIO()
-            qr_img.save(qr_image_stream, format='PNG')
-            qr_image_stream.seek(0) # Rebobinar el stream al principio
+    Cada fila genera CONTEO_CAJAS etiquetas, así que el corte se hace sobre
+    la suma acumulada de cajas y no sobre el número de filas.
+    """
+    acumulado = df['CONTEO_CAJAS'].clip(lower=0).cumsum().to_numpy()
+    total = int(acumulado[-1]) if len(acumulado) else 0
+    procesos = max(1, min(procesos, len(df)))
+    shards = []
+    inicio = 0
+    for numero in range(1, procesos + 1):
+        # Primera fila a partir de la cual se supera la parte proporcional de etiquetas
+        fin = len(df) if numero == procesos else int((acumulado < total * numero / procesos).sum()) + 1
+        fin = min(max(fin, inicio + 1), len(df))
+        if inicio < fin:
+            shards.append((inicio, fin))
+            inicio = fin
+    return shards
 
-            # Añadir un nuevo párrafo para el QR en la misma celda
-            p_qr = codigo_cell.add_paragraph() 
-            p_qr.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-            run_qr = p_qr.add_run()
-            # Ajusta el tamaño del QR según necesites, por ejemplo Inches(1.0) o Inches(1.5)
-            run_qr.add_picture(qr_image_stream, width=Inches(2.0)) 
+def _build_document_parallel(df, shards, imagen_por_fila, images_source, fecha_recepcion, output_path, opciones,
+                             instrumentacion, avance):
+    """Genera cada bloque de filas en un proceso y une los parciales en orden.
 
-            # Fusionar las celdas para CÓDIGO (esto ya lo tenías)
-            codigo_cell.merge(data_table.cell(1, 0))
-            codigo_cell.merge(data_table.cell(2, 0))
-            codigo_cell.merge(data_table.cell(3, 0))
-            
-            # Ajustar alineación vertical de la celda fusionada de CÓDIGO a 'center'
-            tcPr_codigo = codigo_cell._element.get_or_add_tcPr()
-            # Eliminar alineación vertical previa si existe (de adjust_cell_spacing)
-            existing_vAlign = tcPr_codigo.find(qn('w:vAlign'))
-            if existing_vAlign is not None:
-                tcPr_codigo.remove(existing_vAlign)
-            # Añadir nueva alineación vertical
-            vAlign_codigo = OxmlElement('w:vAlign')
-            vAlign_codigo.set(qn('w:val'), 'center') # Centrar verticalmente
-            tcPr_codigo.append(vAlign_codigo)
+    Los parciales y el documento final se escriben siempre con el escritor
+    en streaming, de modo que la unión no carga ningún parcial completo en
+    memoria. Cada parcial termina con salto de página salvo el último, lo
+    que mantiene la regla de no saltar después de la última etiqueta.
+    """
+    opciones_shard = dict(opciones, ESCRITURA_STREAMING=True)
+    if not opciones_shard['PREPARACION_HILOS']:
+        # Repartir los hilos de preparación de imágenes entre los procesos
+        opciones_shard['PREPARACION_HILOS'] = max(1, ((os.cpu_count() or 1) + 4) // len(shards))
 
-            # 2. Celda para REVISADO POR (ocupa 2 filas)
-            revisado_cell = data_table.cell(4, 0)
-            revisado_cell.text = "REVISADO POR:"
-            # Fusionar las celdas para REVISADO POR
-            revisado_cell.merge(data_table.cell(5, 0))
+    medidas = _new_measures()
+    medidas['qr_cache'] = {}
+    # spawn evita heredar con fork los hilos y conexiones del proceso del servidor
+    contexto = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(dir=opciones['DIRECTORIO_TEMPORAL']) as directorio_shards, \
+            ProcessPoolExecutor(max_workers=len(shards), mp_context=contexto) as executor:
+        futuros = []
+        for numero, (inicio, fin) in enumerate(shards):
+            df_shard = df.iloc[inicio:fin]
+            futuros.append(executor.submit(
+                _render_shard,
+                df_shard,
+                {index: imagen_por_fila[index] for index in df_shard.index},
+                images_source,
+                fecha_recepcion,
+                os.path.join(directorio_shards, f'shard_{numero}.docx'),
+                opciones_shard,
+                numero < len(shards) - 1,
+            ))
 
-            # 3. Celda en BLANCO (ocupa 1 fila)
-            # data_table.cell(6, 0).text = "" # Ya está vacía por defecto
+        with StreamingDocxWriter(output_path, opciones['DIRECTORIO_TEMPORAL']) as documento:
+            # Los parciales se unen en orden a medida que terminan
+            for futuro in futuros:
+                shard_path, medidas_shard, metricas_shard = futuro.result()
+                with instrumentacion.etapa('union_parciales'):
+                    append_shard(documento, shard_path)
+                os.remove(shard_path)
+                # Los tiempos de los parciales se solapan: se reparten entre los procesos
+                instrumentacion.merge(metricas_shard, procesos=len(shards))
+                _add_measures(medidas, medidas_shard)
+                avance.add(len(medidas_shard['manifiesto']), 'union_parciales')
+            avance.etapa('guardado')
+            with instrumentacion.etapa('guardado'):
+                documento.save()
+    return medidas
 
-            # 4. Celda para RECEPCIONADO (ocupa 1 fila)
-            current_date = datetime.now().strftime("%d/%m/%Y")
-            data_table.cell(7, 0).text = f"RECEPCIONADO: {current_date}"
-            
-            # 5. Celda para DESCRIPCIÓN (ocupa 1 fila)
-            data_table.cell(8, 0).text = f"DESCRIPCIÓN: {row['DESCRIPCION']}"
-            
-            # 6. Celda para CAJA (ocupa 1 fila)
-            data_table.cell(9, 0).text = f"CAJA {num_caja} DE {num_cajas}"
-            
-            # 7. Celda para CANTIDAD (ocupa 1 fila)
-            data_table.cell(10, 0).text = f"CANTIDAD: {row['CANTIDAD']}"
-            
-            # Celda derecha: tabla de registro
-            right_cell = table.cell(0, 1)
-            
-            # Eliminar párrafo existente
-            if right_cell.paragraphs:
-                p = right_cell.paragraphs[0]
-                p._element.getparent().remove(p._element)
-                p._p = None
-            
-            # Tabla interna
-            inner_table = right_cell.add_table(rows=22, cols=4)
-            inner_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-            set_table_borders(inner_table)
-            
-            for row_cells in inner_table.rows:
-                for cell in row_cells.cells:
-                    adjust_cell_spacing(cell)
-            
-            headers = ['FECHA DD/MM/AA', 'CANT.', 'RP.', 'FIRMA']
-            for j, header in enumerate(headers):
-                inner_table.cell(0, j).text = header
-            
-            for i in range(1, 22):
-                for j in range(4):
-                    inner_table.cell(i, j).text = ""
-            
-            # Celda de observación
-            obs_cell = table.cell(1, 0)
-            obs_cell.merge(table.cell(1, 1))
-            obs_cell.text = "OBSERVACIÓN:"
-            
-            # Aumentar altura de la celda de observación
-            tr = obs_cell._element.getparent()
-            trHeight = OxmlElement('w:trHeight')
-            trHeight.set(qn('w:val'), '800')
-            trHeight.set(qn('w:hRule'), 'atLeast')
-            trPr = tr.get_or_add_trPr()
-            trPr.append(trHeight)
+def _add_measures(medidas, medidas_parcial):
+    # Suma las medidas de un parcial o un volumen a las del trabajo
+    for nombre, valor in medidas_parcial.pop('qr_cache').items():
+        medidas['qr_cache'][nombre] = medidas['qr_cache'].get(nombre, 0) + valor
+    for nombre, valor in medidas_parcial.items():
+        medidas[nombre] += valor
+
+def _split_volumes(df, imagen_por_fila, fuente_imagenes, opciones):
+    """Reparte las filas en volúmenes de como máximo VOLUMEN_ETIQUETAS
+    etiquetas y VOLUMEN_MAX_BYTES bytes estimados.
+
+    Los cortes se hacen entre filas, así que todas las cajas de una fila van
+    en el mismo volumen; una fila que por sí sola supera el límite ocupa un
+    volumen entero. El tamaño se estima como en estimate_document, contando
+    cada imagen y cada QR una vez por volumen, ya que cada volumen es un
+    documento independiente.
+    """
+    max_etiquetas = opciones['VOLUMEN_ETIQUETAS'] or float('inf')
+    max_bytes = opciones['VOLUMEN_MAX_BYTES'] or float('inf')
+    rendimiento = load_throughput(opciones['RENDIMIENTO_ARCHIVO'])
+
+    def coste(row, ruta):
+        tamano = row.CONTEO_CAJAS * rendimiento['bytes_por_etiqueta']
+        if ruta and ruta not in imagenes:
+            tamano += fuente_imagenes.size(ruta) * rendimiento['proporcion_imagenes']
+        if row.CODIGO not in codigos:
+            tamano += rendimiento['bytes_por_qr']
+        return tamano
+
+    volumenes = []
+    inicio = 0
+    etiquetas, tamano, imagenes, codigos = 0, BYTES_BASE_DOCX, set(), set()
+    for posicion, row in enumerate(iter_label_rows(df)):
+        ruta = imagen_por_fila[row.Index]
+        tamano_fila = coste(row, ruta)
+        if posicion > inicio and (etiquetas + row.CONTEO_CAJAS > max_etiquetas or tamano + tamano_fila > max_bytes):
+            volumenes.append((inicio, posicion))
+            inicio = posicion
+            etiquetas, tamano, imagenes, codigos = 0, BYTES_BASE_DOCX, set(), set()
+            tamano_fila = coste(row, ruta)
+        etiquetas += row.CONTEO_CAJAS
+        tamano += tamano_fila
+        imagenes.add(ruta)
+        codigos.add(row.CODIGO)
+    if inicio < len(df):
+        volumenes.append((inicio, len(df)))
+    return volumenes
+
+def _build_volumes(df, volumenes, imagen_por_fila, fuente_imagenes, images_source, fecha_recepcion, output_path,
+                   opciones, instrumentacion, avance):
+    """Genera un .docx independiente por volumen y los empaqueta en un ZIP.
+
+    Con más de un proceso los volúmenes se generan en paralelo en el mismo
+    pool que los parciales, y cada uno se añade al ZIP en orden en cuanto
+    termina. Los .docx ya van comprimidos, así que se guardan sin volver a
+    comprimirlos. Ningún volumen termina con salto de página.
+    """
+    procesos = min(opciones['GENERACION_PROCESOS'] or os.cpu_count() or 1, len(volumenes))
+    medidas = _new_measures()
+    medidas['qr_cache'] = {}
+    medidas['bytes_documento'] = 0
+    with tempfile.TemporaryDirectory(dir=opciones['DIRECTORIO_TEMPORAL']) as directorio, \
+            zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as paquete:
+        partes = []
+        for numero, (inicio, fin) in enumerate(volumenes, 1):
+            df_volumen = df.iloc[inicio:fin]
+            partes.append((
+                df_volumen,
+                {index: imagen_por_fila[index] for index in df_volumen.index},
+                os.path.join(directorio, f'etiquetas_{numero:03d}.docx'),
+            ))
+        if procesos > 1:
+            resultados = _render_volumes_parallel(partes, images_source, fecha_recepcion, opciones, procesos)
+        else:
+            resultados = (
+                (ruta, _build_document(
+                    df_volumen, imagenes_volumen, fuente_imagenes, fecha_recepcion, ruta, opciones,
+                    instrumentacion, avance=avance,
+                ), None)
+                for df_volumen, imagenes_volumen, ruta in partes
+            )
+        for ruta, medidas_volumen, metricas_volumen in resultados:
+            with instrumentacion.etapa('empaquetado'):
+                medidas['bytes_documento'] += document_xml_size(ruta)
+                paquete.write(ruta, os.path.basename(ruta))
+            os.remove(ruta)
+            if metricas_volumen is not None:
+                instrumentacion.merge(metricas_volumen, procesos=procesos)
+                avance.add(len(medidas_volumen['manifiesto']), 'empaquetado')
+            _add_measures(medidas, medidas_volumen)
+    return medidas
+
+def _render_volumes_parallel(partes, images_source, fecha_recepcion, opciones, procesos):
+    # Produce (ruta, medidas, métricas) de cada volumen, en orden
+    opciones_volumen = dict(opciones)
+    if not opciones_volumen['PREPARACION_HILOS']:
+        opciones_volumen['PREPARACION_HILOS'] = max(1, ((os.cpu_count() or 1) + 4) // procesos)
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as executor:
+        futuros = [
+            executor.submit(
+                _render_shard, df_volumen, imagenes_volumen, images_source, fecha_recepcion, ruta,
+                opciones_volumen, False,
+            )
+            for df_volumen, imagenes_volumen, ruta in partes
+        ]
+        for futuro in futuros:
+            yield futuro.result()
+
+def _render_shard(df, imagen_por_fila, images_source, fecha_recepcion, shard_path, opciones, salto_final):
+    # Se ejecuta en un proceso del pool: abre su propia fuente de imágenes
+    instrumentacion = Instrumentacion(opciones['METRICAS_TRACEMALLOC'])
+    try:
+        with instrumentacion.etapa('indice_imagenes'):
+            fuente_imagenes = open_image_source(images_source)
+        with fuente_imagenes:
+            medidas = _build_document(
+                df, imagen_por_fila, fuente_imagenes, fecha_recepcion, shard_path, opciones,
+                instrumentacion, salto_final=salto_final,
+            )
+    finally:
+        instrumentacion.close()
+    return shard_path, medidas, instrumentacion.results()
+
+def _write_labels(documento, df, imagen_por_fila, imagenes_preparadas, plantilla, qr_cache, medidas,
+                  instrumentacion, huellas_por_fila, copiadas, reutilizables, avance, salto_final=False):
+    imagenes_registradas = {}
+    qrs_registrados = {}
+
+    # Procesar cada fila del Excel
+    for posicion, row in enumerate(iter_label_rows(df)):
+        imagen_path = imagen_por_fila[row.Index]
+        
+        # Obtener el número de cajas
+        num_cajas = row.CONTEO_CAJAS
+
+        huellas = huellas_por_fila[row.Index]
+        medidas['manifiesto'].extend(
+            (row.Index, num_caja, huella) for num_caja, huella in enumerate(huellas, 1)
+        )
+        if row.Index in copiadas:
+            # La fila no ha cambiado: sus etiquetas se copian tal cual del
+            # documento anterior, sin preparar su imagen ni su QR
+            for num_caja, huella in enumerate(huellas, 1):
+                with instrumentacion.etapa('copia_etiquetas'):
+                    documento.append(reutilizables.copy(documento, huella))
+                    if salto_final or not (posicion == len(df) - 1 and num_caja == num_cajas):
+                        documento.append(plantilla.page_break())
+                avance.add(1)
+            medidas['etiquetas_copiadas'] += num_cajas
+            continue
+        
+        # Las imágenes y el QR del producto se registran en el paquete una sola
+        # vez; todas sus cajas reutilizan la misma relación
+        imagen_registrada = None
+        error_imagen = None
+        if imagen_path:
+            if imagen_path not in imagenes_registradas:
+                # La primera aparición de una imagen coincide con la siguiente
+                # imagen preparada; el blob se libera al registrarlo
+                with instrumentacion.etapa('carga_imagenes'):
+                    clave, imagen = next(imagenes_preparadas)
+                    if not isinstance(imagen, Exception):
+                        medidas['imagenes'] += 1
+                        medidas['bytes_imagenes'] += len(imagen.blob)
+                        try:
+                            imagen = documento.register_picture(
+                                imagen.blob,
+                                width=Inches(imagen.width_inches),
+                                height=Inches(imagen.height_inches),
+                            )
+                        except Exception as e:
+                            imagen = e
+                    imagenes_registradas[clave] = imagen
+            imagen_registrada = imagenes_registradas[imagen_path]
+            if isinstance(imagen_registrada, Exception):
+                error_imagen = imagen_registrada
+                imagen_registrada = None
+
+        # El QR de cada código se obtiene de la caché
+        qr_data = row.CODIGO
+        if qr_data not in qrs_registrados:
+            with instrumentacion.etapa('generacion_qr'):
+                qr_blob = qr_cache.get(qr_data)
+                qrs_registrados[qr_data] = documento.register_picture(
+                    qr_blob,
+                    width=Inches(ANCHO_QR_PULGADAS),
+                )
+            medidas['qr_registrados'] += 1
+            medidas['bytes_qr'] += len(qr_blob)
+        
+        # Generar una tabla para cada caja clonando la plantilla de la etiqueta
+        for num_caja in range(1, num_cajas + 1):
+            with instrumentacion.etapa('construccion_tablas'):
+                tabla = plantilla.render(
+                    documento.ids_formas,
+                    codigo=row.CODIGO,
+                    descripcion=row.DESCRIPCION,
+                    num_caja=num_caja,
+                    num_cajas=num_cajas,
+                    cantidad=row.CANTIDAD,
+                    qr=qrs_registrados[qr_data],
+                    imagen=imagen_registrada,
+                    error_imagen=error_imagen,
+                )
+                documento.append(tabla)
             
-            # Agregar salto de página excepto en la última tabla
-            if not (index == len(df) - 1 and num_caja == num_cajas):
-                doc.add_page_break()
-    
-    # Guardar el documento
-    doc.save(output_path)
-    return output_path
\ No newline at end of file
+                # Agregar salto de página excepto en la última tabla (salvo que
+                # el documento sea un parcial que continúa en otro)
+                if salto_final or not (posicion == len(df) - 1 and num_caja == num_cajas):
+                    documento.append(plantilla.page_break())
+            avance.add(1)
\ No newline at end of file
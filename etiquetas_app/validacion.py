@@ -0,0 +1,80 @@
+from collections import namedtuple
+import pandas as pd
+
+# Una incidencia de la validación; fila es el número de fila en el Excel
+Incidencia = namedtuple('Incidencia', ['fila', 'columna', 'valor', 'mensaje'])
+
+# Máximo de incidencias que se citan en el mensaje de la excepción
+INCIDENCIAS_EN_MENSAJE = 5
+
+
+class ValidacionError(Exception):
+    """El Excel tiene errores que impiden generar las etiquetas.
+
+    errores contiene todas las incidencias encontradas, ordenadas por fila,
+    para poder mostrar el informe completo y no solo el primer fallo.
+    """
+
+    def __init__(self, errores):
+        self.errores = errores
+        detalle = '; '.join(
+            f"fila {error.fila}: {error.mensaje}" for error in errores[:INCIDENCIAS_EN_MENSAJE]
+        )
+        if len(errores) > INCIDENCIAS_EN_MENSAJE:
+            detalle += f"; y {len(errores) - INCIDENCIAS_EN_MENSAJE} más"
+        plural = 'error' if len(errores) == 1 else 'errores'
+        super().__init__(f"El Excel tiene {len(errores)} {plural}: {detalle}")
+
+
+def validate_label_sheet(df, imagen_por_fila, opciones):
+    """Comprueba todo el Excel antes de empezar a generar el documento.
+
+    Todas las comprobaciones se hacen por columnas sobre el DataFrame
+    completo. Si hay errores lanza ValidacionError con el informe por fila;
+    si no, devuelve el DataFrame con CONTEO_CAJAS convertido a entero, sin
+    las filas de 0 cajas (no tienen etiquetas), y la lista de advertencias
+    (imágenes que no están en el ZIP).
+    """
+    errores = []
+    advertencias = []
+
+    codigos_vacios = df['CODIGO'].str.strip() == ''
+    _add(errores, df, codigos_vacios, 'CODIGO', "El CODIGO está vacío")
+
+    # Una celda vacía cuenta como una caja, igual que si faltara la columna
+    conteo_original = df['CONTEO_CAJAS']
+    conteo = pd.to_numeric(conteo_original, errors='coerce')
+    vacias = conteo_original.isna() | (conteo_original.astype(str).str.strip() == '')
+    conteo = conteo.mask(vacias, 1)
+    no_numericas = conteo.isna()
+    _add(errores, df, no_numericas, 'CONTEO_CAJAS', "CONTEO_CAJAS no es un número")
+    no_enteras = ~no_numericas & (conteo % 1 != 0)
+    _add(errores, df, no_enteras, 'CONTEO_CAJAS', "CONTEO_CAJAS debe ser un número entero")
+    validas = ~no_numericas & ~no_enteras
+    _add(errores, df, validas & (conteo < 0), 'CONTEO_CAJAS', "CONTEO_CAJAS no puede ser negativo")
+    maximo = opciones['MAX_CAJAS_POR_FILA']
+    if maximo:
+        _add(
+            errores, df, validas & (conteo > maximo), 'CONTEO_CAJAS',
+            f"CONTEO_CAJAS supera el máximo de {maximo} cajas por fila",
+        )
+
+    sin_imagen = (df['IMAGEN'] != '') & pd.Series(imagen_por_fila).reindex(df.index).isna()
+    destino = errores if opciones['IMAGENES_FALTANTES_ERROR'] else advertencias
+    _add(destino, df, sin_imagen, 'IMAGEN', "La imagen no está en el ZIP")
+
+    if errores:
+        errores.sort(key=lambda error: error.fila)
+        raise ValidacionError(errores)
+
+    df = df.assign(CONTEO_CAJAS=conteo.astype(int))
+    return df[df['CONTEO_CAJAS'] > 0], advertencias
+
+
+def _add(incidencias, df, mascara, columna, mensaje):
+    filas = df.index[mascara.to_numpy()]
+    valores = df.loc[filas, columna] if columna in df else [None] * len(filas)
+    incidencias.extend(
+        Incidencia(int(fila), columna, None if valor is None else str(valor), mensaje)
+        for fila, valor in zip(filas, valores)
+    )
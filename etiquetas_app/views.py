@@ -1,148 +1,299 @@
+import asyncio
+import json
 import os
 import uuid
 import zipfile
-import shutil
-# tempfile no es estrictamente necesario si TEMP_DIR se define en settings
 from django.shortcuts import render, redirect
-from django.conf import settings
-from django.http import FileResponse # HttpResponse no se usa directamente en procesar_archivos
+from django.http import JsonResponse, StreamingHttpResponse # HttpResponse no se usa directamente en procesar_archivos
 from django.contrib import messages
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from .admision import queue_error
+from .conf import get_opciones, splits_volumes
+from .descargas import document_response
 from .forms import UploadForm
-from .models import ArchivoGenerado
-from .utils import generate_word_document
+from .metricas import Instrumentacion, log_metrics
+from .models import ArchivoGenerado, MetricaEtapa
+from .resultados import content_key, find_cached_job
+from .subidas import JobUploadHandler
+
+# Texto de la página de descarga para cada etapa de la generación
+MENSAJES_ETAPA = {
+    'lectura_excel': "Leyendo el archivo Excel...",
+    'validacion': "Validando las filas del Excel...",
+    'construccion_tablas': "Generando etiquetas...",
+    'union_parciales': "Uniendo las partes del documento...",
+    'empaquetado': "Empaquetando los documentos...",
+    'guardado': "Guardando el documento...",
+}
+
+# Segundos entre dos consultas del avance y entre dos comentarios que
+# mantienen abierta la conexión del flujo de progreso
+INTERVALO_PROGRESO = 1
+INTERVALO_KEEPALIVE = 15
+
+# Trabajos que se recuerdan en la sesión, del más antiguo al más reciente
+MAX_TRABAJOS_SESION = 20
 
 def index(request):
     form = UploadForm()
-    return render(request, 'index.html', {'form': form})
+    recientes = ArchivoGenerado.objects.filter(pk__in=request.session.get('trabajos', [])).order_by('-fecha_creacion')
+    return render(request, 'index.html', {'form': form, 'trabajos': recientes})
 
+@csrf_exempt
 def procesar_archivos(request):
+    # Los archivos se escriben en su ruta definitiva mientras se recibe la
+    # petición. El manejador de subida tiene que instalarse antes de que nada
+    # lea request.POST, incluida la comprobación CSRF, que por eso se hace
+    # después, en _procesar_archivos
+    unique_id = str(uuid.uuid4())
+    opciones = get_opciones()
+    manejador = JobUploadHandler(request, unique_id, {
+        'excel_file': opciones['SUBIDA_MAX_BYTES_EXCEL'],
+        'images_zip': opciones['SUBIDA_MAX_BYTES_ZIP'],
+    })
+    request.upload_handlers = [manejador]
+    respuesta = _procesar_archivos(request, unique_id, manejador, opciones)
+    if respuesta.status_code == 403:
+        # La comprobación CSRF falló después de recibir los archivos
+        manejador.discard()
+    return respuesta
+
+@csrf_protect
+def _procesar_archivos(request, unique_id, manejador, opciones):
     if request.method == 'POST':
+        # Al leer request.POST y request.FILES se recibe la subida
         form = UploadForm(request.POST, request.FILES)
+        if manejador.error:
+            messages.error(request, manejador.error)
+            return redirect('index')
         if form.is_valid():
-            unique_id = str(uuid.uuid4())
             excel_file_uploaded = request.FILES['excel_file']
             zip_file_uploaded = request.FILES['images_zip']
+            excel_path = excel_file_uploaded.ruta
+            zip_path = zip_file_uploaded.ruta
 
-            excel_filename = f"{unique_id}_{excel_file_uploaded.name}"
-            zip_filename = f"{unique_id}_{zip_file_uploaded.name}"
-
-            # Definir rutas base
-            base_uploads_excel_path = os.path.join(settings.MEDIA_ROOT, 'uploads', 'excel')
-            base_uploads_zip_path = os.path.join(settings.MEDIA_ROOT, 'uploads', 'zip')
-            base_output_path = os.path.join(settings.MEDIA_ROOT, 'output')
+            try:
+                # La escritura de las subidas se midió mientras se recibían
+                instrumentacion = Instrumentacion()
+                instrumentacion.add('escritura_subida', manejador.segundos, llamadas=2)
 
-            excel_path = os.path.join(base_uploads_excel_path, excel_filename)
-            zip_path = os.path.join(base_uploads_zip_path, zip_filename)
-            output_filename = f"{unique_id}_documento.docx"
-            output_path = os.path.join(base_output_path, output_filename)
+                if form.cleaned_data['solo_estimar']:
+                    return _estimar(request, excel_path, zip_path, zip_file_uploaded.name)
 
-            temp_dir = None  # Inicializar temp_dir para el bloque finally
-            archivos_a_limpiar = []  # Lista para seguimiento de archivos a eliminar
+                # Una subida idéntica a otra reciente reutiliza su trabajo
+                clave = content_key(
+                    excel_file_uploaded.huella, zip_file_uploaded.huella, timezone.localdate(), opciones,
+                )
+                trabajo = find_cached_job(clave, opciones)
+                if trabajo is not None:
+                    manejador.discard()
+                    _remember_job(request, trabajo)
+                    messages.success(request, "Estos archivos ya se habían subido; se reutiliza su documento.")
+                    return redirect('descargar', trabajo_id=trabajo.pk)
 
-            try:
-                # Asegurar que los directorios de carga y salida existan
-                os.makedirs(base_uploads_excel_path, exist_ok=True)
-                os.makedirs(base_uploads_zip_path, exist_ok=True)
-                os.makedirs(base_output_path, exist_ok=True)
-
-                # Guardar archivos subidos
-                with open(excel_path, 'wb+') as destination:
-                    for chunk in excel_file_uploaded.chunks():
-                        destination.write(chunk)
-                archivos_a_limpiar.append(excel_path)  # Añadir a la lista de limpieza
-                
-                with open(zip_path, 'wb+') as destination:
-                    for chunk in zip_file_uploaded.chunks():
-                        destination.write(chunk)
-                archivos_a_limpiar.append(zip_path)  # Añadir a la lista de limpieza
-
-                # Verificar la configuración de TEMP_DIR
-                if not hasattr(settings, 'TEMP_DIR') or not settings.TEMP_DIR:
-                    messages.error(request, "Error de configuración: TEMP_DIR no está definido en settings.py.")
-                    # Limpiar archivos subidos si no podemos proceder
-                    for archivo in archivos_a_limpiar:
-                        if os.path.exists(archivo): 
-                            os.remove(archivo)
+                # Con la cola o los trabajos pendientes del usuario llenos se
+                # rechaza ya, sin encolar nada
+                error = queue_error(request.user, request.session.get('trabajos', []), opciones)
+                if error is not None:
+                    manejador.discard()
+                    messages.error(request, error)
                     return redirect('index')
+
+                # El documento lo genera en segundo plano el comando
+                # procesar_trabajos; aquí solo se encola el trabajo. Si el
+                # usuario ya generó otro documento, las etiquetas que no han
+                # cambiado se copian de él
+                trabajo_anterior = _ultimo_trabajo(request)
+                if trabajo_anterior is not None and trabajo_anterior.estado != ArchivoGenerado.COMPLETADO:
+                    trabajo_anterior = None
+                trabajo = ArchivoGenerado.objects.create(
+                    usuario=request.user if request.user.is_authenticated else None,
+                    excel_original=excel_file_uploaded.relativa,
+                    zip_original=zip_file_uploaded.relativa,
+                    documento_generado=os.path.join('output', _output_filename(unique_id, opciones)),
+                    clave_contenido=clave,
+                    trabajo_base=trabajo_anterior,
+                )
                 
-                # Crear directorio temporal para la extracción de imágenes
-                temp_dir = os.path.join(settings.TEMP_DIR, unique_id)
-                os.makedirs(temp_dir, exist_ok=True)
-                
-                # Extraer archivos ZIP
-                try:
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
-                except zipfile.BadZipFile:
-                    messages.error(request, f"El archivo ZIP '{zip_file_uploaded.name}' está corrupto o no es un ZIP válido.")
-                    raise # Re-lanzar para ser capturado por el try-except principal y limpiar temp_dir
-                except Exception as e_zip:
-                    messages.error(request, f"Error al descomprimir el archivo ZIP '{zip_file_uploaded.name}': {str(e_zip)}")
-                    raise # Re-lanzar
-
-                # Generar documento Word
-                generate_word_document(excel_path, temp_dir, output_path)
-                
-                # Guardar referencia en la base de datos si el usuario está autenticado
-                if request.user.is_authenticated:
-                    ArchivoGenerado.objects.create(
-                        usuario=request.user,
-                        excel_original=os.path.join('uploads', 'excel', excel_filename),
-                        zip_original=os.path.join('uploads', 'zip', zip_filename),
-                        documento_generado=os.path.join('output', output_filename)
-                    )
-                else:
-                    # Si el usuario no está autenticado, podemos eliminar los archivos originales
-                    # ya que no hay referencia en la base de datos
-                    for archivo in archivos_a_limpiar:
-                        if os.path.exists(archivo):
-                            os.remove(archivo)
+                MetricaEtapa.save_results(trabajo, instrumentacion.results())
+                log_metrics(instrumentacion.results(), trabajo=trabajo.pk)
                 
-                request.session['documento_generado'] = output_path
-                messages.success(request, "Archivos procesados y documento generado exitosamente.")
-                return redirect('descargar')
+                _remember_job(request, trabajo)
+                messages.success(request, "Archivos recibidos. El documento se está generando.")
+                return redirect('descargar', trabajo_id=trabajo.pk)
 
             except Exception as e:
+                manejador.discard()
                 messages.error(request, f"Error general al procesar los archivos: {str(e)}")
                 return redirect('index')
-            
-            finally:
-                # Limpiar el directorio temporal si fue creado
-                if temp_dir and os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir)
-                    
-                # Opcionalmente, limpiar archivos originales si no se guardaron en la base de datos
-                # Esto se puede habilitar si se desea una limpieza agresiva
-                # if not request.user.is_authenticated:
-                #     for archivo in archivos_a_limpiar:
-                #         if os.path.exists(archivo):
-                #             os.remove(archivo)
 
         else:
             # Si el formulario no es válido, mostrar errores en la página de subida
             # Los mensajes de error del formulario se mostrarán automáticamente por la plantilla
+            manejador.discard()
             return render(request, 'index.html', {'form': form})
     
     # Si no es POST, redirigir a la página principal
     return redirect('index')
 
-def descargar(request):
-    if 'documento_generado' not in request.session:
+def _output_filename(unique_id, opciones):
+    # Con volúmenes el resultado es un ZIP con un documento por volumen
+    if splits_volumes(opciones):
+        return f"{unique_id}_documentos.zip"
+    return f"{unique_id}_documento.docx"
+
+def _estimar(request, excel_path, zip_path, zip_nombre):
+    # La estimación no genera el documento, así que se calcula en la propia
+    # petición y los archivos subidos se eliminan al terminar. La generación
+    # (pandas, python-docx, qrcode...) se importa aquí y no al cargar las URLs
+    from .utils import generate_word_document
+    from .validacion import ValidacionError
+
+    contexto = {}
+    try:
+        contexto['estimacion'] = generate_word_document(excel_path, zip_path, None, simular=True)
+    except zipfile.BadZipFile:
+        messages.error(request, f"El archivo ZIP '{zip_nombre}' está corrupto o no es un ZIP válido.")
+        return redirect('index')
+    except ValidacionError as e:
+        contexto['errores'] = e.errores
+        contexto['mensaje_error'] = str(e)
+    finally:
+        for archivo in (excel_path, zip_path):
+            if os.path.exists(archivo):
+                os.remove(archivo)
+    return render(request, 'estimacion.html', contexto)
+
+def _remember_job(request, trabajo):
+    trabajos = [pk for pk in request.session.get('trabajos', []) if pk != trabajo.pk]
+    trabajos.append(trabajo.pk)
+    request.session['trabajos'] = trabajos[-MAX_TRABAJOS_SESION:]
+
+def _ultimo_trabajo(request):
+    trabajos = request.session.get('trabajos')
+    if not trabajos:
+        return None
+    return ArchivoGenerado.objects.filter(pk=trabajos[-1]).first()
+
+def _puede_ver(trabajos_sesion, usuario, trabajo_id, usuario_trabajo_id):
+    # Un trabajo lo pueden ver las sesiones que lo crearon o reutilizaron y su usuario
+    return trabajo_id in trabajos_sesion or (
+        usuario.is_authenticated and usuario_trabajo_id == usuario.pk
+    )
+
+def _trabajo_permitido(request, trabajo_id):
+    # El trabajo se busca por su id en la base de datos, así que cualquier
+    # nodo puede servirlo; None si no existe o no es de este usuario
+    trabajo = ArchivoGenerado.objects.filter(pk=trabajo_id).first()
+    if trabajo is None or not _puede_ver(
+        request.session.get('trabajos', []), request.user, trabajo.pk, trabajo.usuario_id,
+    ):
+        return None
+    return trabajo
+
+def descargar(request, trabajo_id=None):
+    if trabajo_id is None:
+        # Sin id, el último trabajo de la sesión
+        trabajo = _ultimo_trabajo(request)
+        if trabajo is not None:
+            return redirect('descargar', trabajo_id=trabajo.pk)
+    else:
+        trabajo = _trabajo_permitido(request, trabajo_id)
+    if trabajo is None:
         messages.error(request, "No hay documento disponible para descargar")
         return redirect('index')
     
-    return render(request, 'download.html')
+    # El flujo de progreso solo es en vivo servido con ASGI: con WSGI, Django
+    # consume la vista asíncrona entera antes de enviar nada y ocupa un hilo
+    # por pestaña abierta, así que la página consulta el estado periódicamente
+    return render(request, 'download.html', {
+        'trabajo': trabajo,
+        'progreso_en_vivo': isinstance(request, ASGIRequest),
+    })
+
+def estado_trabajo(request, trabajo_id):
+    # Consultado periódicamente por la página de descarga
+    trabajo = _trabajo_permitido(request, trabajo_id)
+    if trabajo is None:
+        return JsonResponse({'error': "No hay ningún trabajo en curso"}, status=404)
+    return JsonResponse({
+        'estado': trabajo.estado,
+        'error': trabajo.error,
+        'imagenes_no_encontradas': trabajo.resumen.get('imagenes_no_encontradas', []),
+        **_datos_progreso(trabajo.etapa_actual, trabajo.etiquetas_hechas, trabajo.etiquetas),
+    })
+
+def _datos_progreso(etapa, hechas, total):
+    return {
+        'etapa': etapa,
+        'mensaje': MENSAJES_ETAPA.get(etapa, ''),
+        'hechas': hechas,
+        'total': total,
+    }
+
+async def progreso_trabajo(request, trabajo_id):
+    """Avance de un trabajo como Server-Sent Events.
+
+    La vista es asíncrona: servida con ASGI, cada cliente que sigue su trabajo
+    espera con asyncio.sleep entre consulta y consulta en lugar de ocupar un
+    hilo. Se envía un evento cada vez que cambia el avance y el flujo termina
+    cuando el trabajo se completa o falla. La página de descarga solo la usa
+    servida con ASGI.
+    """
+    valores = await ArchivoGenerado.objects.filter(pk=trabajo_id).values('usuario_id').afirst()
+    if valores is None or not _puede_ver(
+        await request.session.aget('trabajos', []), await request.auser(), trabajo_id, valores['usuario_id'],
+    ):
+        return JsonResponse({'error': "No hay ningún trabajo en curso"}, status=404)
+
+    async def eventos():
+        anterior = None
+        silencio = 0
+        while True:
+            valores = await ArchivoGenerado.objects.filter(pk=trabajo_id).values(
+                'estado', 'etapa_actual', 'etiquetas_hechas', 'etiquetas',
+            ).afirst()
+            if valores is None:
+                return
+            datos = {
+                'estado': valores['estado'],
+                **_datos_progreso(valores['etapa_actual'], valores['etiquetas_hechas'], valores['etiquetas']),
+            }
+            if datos != anterior:
+                anterior = datos
+                silencio = 0
+                yield f"data: {json.dumps(datos)}\n\n"
+            elif silencio >= INTERVALO_KEEPALIVE:
+                silencio = 0
+                yield ": keepalive\n\n"
+            if datos['estado'] in (ArchivoGenerado.COMPLETADO, ArchivoGenerado.FALLIDO):
+                return
+            await asyncio.sleep(INTERVALO_PROGRESO)
+            silencio += INTERVALO_PROGRESO
+
+    respuesta = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+    respuesta['Cache-Control'] = 'no-cache'
+    # Que un proxy como nginx no acumule los eventos antes de enviarlos
+    respuesta['X-Accel-Buffering'] = 'no'
+    return respuesta
 
-def obtener_documento(request):
-    if 'documento_generado' not in request.session:
+def obtener_documento(request, trabajo_id):
+    trabajo = _trabajo_permitido(request, trabajo_id)
+    if trabajo is None:
         messages.error(request, "No hay documento disponible para descargar")
         return redirect('index')
+    if trabajo.estado != ArchivoGenerado.COMPLETADO:
+        messages.error(request, "El documento todavía no está listo")
+        return redirect('descargar', trabajo_id=trabajo.pk)
     
-    file_path = request.session['documento_generado']
-    if os.path.exists(file_path):
-        response = FileResponse(open(file_path, 'rb'))
-        response['Content-Disposition'] = f'attachment; filename="documento.docx"'
-        return response
+    # El documento se lee a través del almacenamiento de resultados
+    almacen = trabajo.documento_generado.storage
+    nombre_almacen = trabajo.documento_generado.name
+    if nombre_almacen and almacen.exists(nombre_almacen):
+        nombre = 'documentos.zip' if nombre_almacen.endswith('.zip') else 'documento.docx'
+        return document_response(request, almacen, nombre_almacen, nombre, get_opciones())
     else:
         messages.error(request, "El archivo no existe")
         return redirect('index')
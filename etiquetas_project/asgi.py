@@ -5,6 +5,11 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+The live progress stream (``progreso/``) is an async view: serve the project
+with an ASGI server such as uvicorn or daphne over
+``etiquetas_project.asgi:application`` so that watching clients do not each
+hold a worker thread.
 """
 
 import os
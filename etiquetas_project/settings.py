@@ -132,7 +132,42 @@ UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'uploads')
 TEMP_DIR = os.path.join(MEDIA_ROOT, 'temp')
 OUTPUT_DIR = os.path.join(MEDIA_ROOT, 'output')
 
+# Almacenamiento de los documentos generados (ver etiquetas_app/almacenamiento.py).
+# Con varios nodos, MEDIA_ROOT debe ser un directorio compartido por todos ellos
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'resultados': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'OPTIONS': {'location': MEDIA_ROOT},
+    },
+}
+
 # Crear directorios si no existen
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Opciones de generación de etiquetas: solo las que cambian el valor por
+# defecto de etiquetas_app/conf.py, donde está la lista completa
+ETIQUETAS = {
+    'QR_CACHE_DIR': os.path.join(MEDIA_ROOT, 'cache', 'qr'),
+    'ESCRITURA_STREAMING': True,
+    'DIRECTORIO_TEMPORAL': TEMP_DIR,
+    'RENDIMIENTO_ARCHIVO': os.path.join(MEDIA_ROOT, 'estadisticas', 'rendimiento.json'),
+    'CACHE_RESULTADOS_HORAS': 24,
+    'SUBIDA_MAX_BYTES_EXCEL': 100 * 1024 * 1024,
+    'SUBIDA_MAX_BYTES_ZIP': 4 * 1024 * 1024 * 1024,
+    'IMPORTACION_MAX_MS': 500,
+    'GENERACION_MAX_SIMULTANEAS': 2,
+    'GENERACION_MAX_POR_USUARIO': 1,
+    'GENERACION_MEMORIA_MAX_BYTES': 3 * 1024 * 1024 * 1024,
+    'COLA_MAX_TRABAJOS': 50,
+    'COLA_MAX_POR_USUARIO': 3,
+    'RETENCION_SUBIDAS_HORAS': 7 * 24,
+    'RETENCION_DOCUMENTOS_HORAS': 30 * 24,
+    'RETENCION_DOCUMENTOS_MAX_BYTES': 20 * 1024 * 1024 * 1024,
+    'RETENCION_TEMPORALES_HORAS': 24,
+    # En producción detrás de nginx, DESCARGA_DELEGADA='x-accel-redirect' con
+    # una location internal en DESCARGA_PREFIJO_INTERNO que apunte a MEDIA_ROOT
+}